@@ -0,0 +1,74 @@
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+# Uses the same ENVIRONMENT, ENV_VAR_FOLDER and SECRETS settings as main.py,
+# and needs a populated database with the ANN index built (python -m api.vector_index).
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+import time
+import argparse
+from sqlalchemy import select, func
+from instarest import get_db
+from aimbase.db.vector import AllMiniVectorStore
+from api.vector_index import build_search_settings
+from onnx_benchmark import percentiles
+
+
+def nearest_neighbor_ids(db, query_embedding, k: int, similarity_measure: str, settings: list) -> list:
+    # settings are transaction local, the rollback resets them for the next query
+    try:
+        for setting in settings:
+            db.execute(setting)
+
+        distance = getattr(AllMiniVectorStore.embedding, similarity_measure)(query_embedding)
+        return db.execute(
+            select(AllMiniVectorStore.id).order_by(distance).limit(k)
+        ).scalars().all()
+    finally:
+        db.rollback()
+
+
+def run_benchmark(queries: int, k: int, similarity_measure: str, ef_searches: list[int], probes: list[int]) -> None:
+    db = next(get_db())
+    try:
+        # stored chunk embeddings stand in for query embeddings, no models needed
+        query_embeddings = db.execute(
+            select(AllMiniVectorStore.embedding).order_by(func.random()).limit(queries)
+        ).scalars().all()
+
+        # exact search, the planner cannot use the index with index scans off
+        exact_settings = [select(func.set_config("enable_indexscan", "off", True))]
+        exact_latencies, exact_results = [], []
+        for query_embedding in query_embeddings:
+            start_time = time.perf_counter()
+            exact_results.append(
+                set(nearest_neighbor_ids(db, query_embedding, k, similarity_measure, exact_settings))
+            )
+            exact_latencies.append(time.perf_counter() - start_time)
+
+        print(f"Queries: {len(query_embeddings)}, k: {k}, measure: {similarity_measure}")
+        print(f"exact: {percentiles(exact_latencies)}")
+
+        sweep = [("ef_search", value, build_search_settings(ef_search=value)) for value in ef_searches]
+        sweep += [("probes", value, build_search_settings(probes=value)) for value in probes]
+        for name, value, settings in sweep:
+            latencies, recalls = [], []
+            for query_embedding, exact_ids in zip(query_embeddings, exact_results):
+                start_time = time.perf_counter()
+                ids = nearest_neighbor_ids(db, query_embedding, k, similarity_measure, settings)
+                latencies.append(time.perf_counter() - start_time)
+                recalls.append(len(exact_ids.intersection(ids)) / len(exact_ids) if exact_ids else 1.0)
+
+            print(f"{name}={value}: recall@{k} {sum(recalls) / len(recalls):.3f}, {percentiles(latencies)}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    # usage: python ann_benchmark.py --queries 100 --k 10 --ef-search 40 100 200
+    parser = argparse.ArgumentParser(description="Recall@k of the ANN index against exact kNN search")
+    parser.add_argument("--queries", type=int, default=100, help="embeddings sampled from the DB")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--similarity-measure", default="max_inner_product")
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[20, 40, 100, 200])
+    parser.add_argument("--probes", type=int, nargs="*", default=[])
+    args = parser.parse_args()
+
+    run_benchmark(args.queries, args.k, args.similarity_measure, args.ef_search, args.probes)
@@ -0,0 +1,302 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+# per client token bucket, refilled at this many requests per second up to the burst size
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", 5))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 20))
+
+# chat sessions get their own, slower buckets, each message runs several LLM round trips
+CHAT_RATE_LIMIT_PER_SECOND = float(os.environ.get("CHAT_RATE_LIMIT_PER_SECOND", 0.5))
+CHAT_RATE_LIMIT_BURST = int(os.environ.get("CHAT_RATE_LIMIT_BURST", 5))
+
+# searches (encode, kNN and rerank) running at once across the process, and waiting for a slot
+MAX_CONCURRENT_SEARCHES = int(os.environ.get("MAX_CONCURRENT_SEARCHES", 8))
+MAX_QUEUED_SEARCHES = int(os.environ.get("MAX_QUEUED_SEARCHES", 32))
+
+# chat agent runs at once, and waiting for a slot
+MAX_CONCURRENT_CHATS = int(os.environ.get("MAX_CONCURRENT_CHATS", 16))
+MAX_QUEUED_CHATS = int(os.environ.get("MAX_QUEUED_CHATS", 32))
+
+# a queued request is rejected rather than wait longer than this for a slot
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 2))
+
+# largest k accepted by the kNN endpoints, every neighbor is reranked so this bounds the rerank too
+MAX_KNN_K = int(os.environ.get("MAX_KNN_K", 200))
+
+# largest candidate_k taken from each side of a hybrid search before fusion
+MAX_CANDIDATE_K = int(os.environ.get("MAX_CANDIDATE_K", 200))
+
+# (query, document) pairs reranked per batch kNN chunk, fewer queries go in a chunk as k grows
+MAX_RERANK_PAIRS = int(os.environ.get("MAX_RERANK_PAIRS", 8192))
+
+# header naming the client when behind a proxy, e.g. X-Forwarded-For, otherwise the peer address
+ADMISSION_CLIENT_HEADER = os.environ.get("ADMISSION_CLIENT_HEADER")
+
+# token buckets kept, the least recently seen clients are forgotten past this
+MAX_TRACKED_CLIENTS = 10000
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is shed, the API answers it with a 429.
+
+    **Parameters**
+
+    * `reason`: Why the request was shed
+    * `retry_after`: Seconds the client should wait before retrying
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """
+    Thread-safe token bucket per client.
+
+    **Parameters**
+
+    * `rate`: Tokens added per second
+    * `burst`: Most tokens a bucket holds
+    * `max_clients`: Least recently seen clients are dropped past this
+    """
+
+    def __init__(self, rate: float, burst: int, max_clients: int = MAX_TRACKED_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+
+        self._buckets = OrderedDict()  # client id -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, client_id: str) -> float:
+        """
+        Take a token for client_id. Returns 0 if one was taken, otherwise the
+        seconds until one will be available.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(client_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+
+            wait_seconds = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait_seconds = (1 - tokens) / self.rate
+
+            self._buckets[client_id] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+            return wait_seconds
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class AdmissionController:
+    """
+    Per client rate limiting plus a global concurrency limit with a bounded queue, so
+    overload is shed with a quick rejection instead of piling up latency. Slots are
+    acquired on the event loop and may be released from any thread.
+
+    **Parameters**
+
+    * `name`: Name in logs and stats
+    * `max_concurrent`: Requests holding a slot at once
+    * `max_queued`: Requests waiting for a slot, more are rejected at once
+    * `queue_timeout`: Seconds a request waits for a slot before it is rejected
+    * `rate`: Per client requests per second
+    * `burst`: Per client burst size
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrent: int,
+        max_queued: int,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        rate: float = RATE_LIMIT_PER_SECOND,
+        burst: int = RATE_LIMIT_BURST,
+    ):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.buckets = TokenBuckets(rate, burst)
+
+        self.admitted = 0
+        self.rate_limited = 0
+        self.queue_full = 0
+        self.queue_timeouts = 0
+
+        # internal only
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()  # [loop, future, granted], oldest first
+
+    def check_rate(self, client_id: str | None) -> None:
+        """
+        Take a token from the client's bucket, or raise AdmissionRejected.
+        Internal callers without a client id are not rate limited.
+        """
+
+        if client_id is None:
+            return
+
+        wait_seconds = self.buckets.take(client_id)
+        if wait_seconds > 0:
+            with self._lock:
+                self.rate_limited += 1
+            raise AdmissionRejected(f"Rate limit exceeded for {self.name}", wait_seconds)
+
+    async def acquire(self) -> None:
+        """
+        Wait for a slot, or raise AdmissionRejected if the queue is full or the
+        wait times out. Every successful acquire must be paired with a release.
+        """
+
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                self.admitted += 1
+                return
+
+            if len(self._waiters) >= self.max_queued:
+                self.queue_full += 1
+                raise AdmissionRejected(f"Too many {self.name} requests queued", self.queue_timeout)
+
+            waiter = [asyncio.get_running_loop(), asyncio.get_running_loop().create_future(), False]
+            self._waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                # a release may have handed the slot over just as the wait ended
+                if not waiter[2]:
+                    self._waiters.remove(waiter)
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.queue_timeouts += 1
+                        raise AdmissionRejected(
+                            f"Timed out waiting for a {self.name} slot", self.queue_timeout
+                        )
+                    raise e
+
+            if isinstance(e, asyncio.CancelledError):
+                self.release()
+                raise e
+
+        with self._lock:
+            self.admitted += 1
+
+    def release(self) -> None:
+        """
+        Free a slot, handing it straight to the oldest waiter if there is one.
+        """
+
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter[2] = True
+                waiter[0].call_soon_threadsafe(_grant, waiter[1])
+            else:
+                self._active -= 1
+
+    async def admit(self, client_id: str | None) -> None:
+        self.check_rate(client_id)
+        await self.acquire()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": len(self._waiters),
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "admitted": self.admitted,
+                "rate_limited": self.rate_limited,
+                "queue_full": self.queue_full,
+                "queue_timeouts": self.queue_timeouts,
+                "tracked_clients": len(self.buckets),
+            }
+
+
+class SlotRelease:
+    """
+    Releases one admitted slot at most once, for a slot that more than one code path
+    may end, e.g. a streamed response the client can drop before it starts.
+
+    **Parameters**
+
+    * `controller`: Controller the slot was acquired from
+    """
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+
+        # internal only
+        self._lock = threading.Lock()
+        self._released = False
+
+    def __call__(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.controller.release()
+
+
+# shared by the kNN routes and the chainlit retrieval tool
+search_admission = AdmissionController(
+    "search",
+    max_concurrent=MAX_CONCURRENT_SEARCHES,
+    max_queued=MAX_QUEUED_SEARCHES,
+)
+
+# chainlit messages, each one runs the agent
+chat_admission = AdmissionController(
+    "chat",
+    max_concurrent=MAX_CONCURRENT_CHATS,
+    max_queued=MAX_QUEUED_CHATS,
+    rate=CHAT_RATE_LIMIT_PER_SECOND,
+    burst=CHAT_RATE_LIMIT_BURST,
+)
+
+
+def get_client_id(request) -> str:
+    """
+    Rate limiting key of a FastAPI request.
+    """
+
+    if ADMISSION_CLIENT_HEADER:
+        forwarded = request.headers.get(ADMISSION_CLIENT_HEADER)
+        if forwarded:
+            # the first hop is the original client
+            return forwarded.split(",")[0].strip()
+
+    return request.client.host if request.client else "unknown"
+
+
+def get_admission_status() -> dict:
+    return {
+        "search": search_admission.stats(),
+        "chat": chat_admission.stats(),
+        "max_knn_k": MAX_KNN_K,
+        "max_candidate_k": MAX_CANDIDATE_K,
+        "max_rerank_pairs": MAX_RERANK_PAIRS,
+    }
+
+
+############################ PRIVATE METHODS ############################
+def _grant(future: asyncio.Future) -> None:
+    # the waiter may have given up already, it sees the grant flag instead
+    if not future.done():
+        future.set_result(None)
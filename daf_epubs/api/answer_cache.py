@@ -0,0 +1,190 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy import select
+from instarest import get_db, LogConfig
+from aimbase.db.vector import DocumentModel
+
+# skip the agent for a question close enough to one answered before
+ANSWER_CACHE = os.environ.get("ANSWER_CACHE", "True") == "True"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", 86400))
+
+# cosine similarity of the all-MiniLM-L6-v2 question embeddings needed for a hit, rewordings
+# of the same question usually score above 0.95 while related but different ones fall below
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+
+logger = LogConfig(LOGGER_NAME="AnswerCache").build_logger()
+
+
+class CachedAnswer:
+    """
+    Agent answer to one question, with the ranked neighbors it cited.
+
+    **Parameters**
+
+    * `question`: Question as the user asked it
+    * `answer`: Agent answer, before the sources are appended
+    * `ranked_neighbors`: RankedNeighbor list the retrieval tool returned, or None
+    * `expires_at`: time.monotonic() after which the answer is a miss
+    """
+
+    def __init__(self, question: str, answer: str, ranked_neighbors: list | None, expires_at: float):
+        self.question = question
+        self.answer = answer
+        self.ranked_neighbors = ranked_neighbors
+        self.expires_at = expires_at
+
+        # re-ingesting a publication replaces its chunks, so these going missing means it changed
+        self.document_ids = {item.document.id for item in ranked_neighbors or []}
+
+
+class SemanticAnswerCache:
+    """
+    Cache of agent answers looked up by the embedding of the question, so a near
+    duplicate of an answered question skips the LLM round trips. Answers whose cited
+    chunks were replaced or deleted by an ingest run are dropped on revalidate.
+
+    **Parameters**
+
+    * `max_entries`: Least recently used answers are dropped past this size
+    * `ttl_seconds`: Time after which an answer counts as a miss
+    * `similarity_threshold`: Minimum cosine similarity of the questions for a hit
+    """
+
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_SIZE,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
+        # internal only
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CachedAnswer
+        self._embeddings = {}  # key -> unit length question embedding
+        self._next_key = 0
+
+        # stacked embeddings and their keys, rebuilt on the next lookup after a change
+        self._matrix = None
+        self._matrix_keys = []
+
+    def get(self, embedding) -> CachedAnswer | None:
+        """
+        The unexpired answer to the most similar question above the threshold, if any.
+        """
+
+        query = _to_unit_vector(embedding)
+        with self._lock:
+            if self._entries:
+                if self._matrix is None:
+                    self._matrix_keys = list(self._embeddings)
+                    self._matrix = np.stack([self._embeddings[key] for key in self._matrix_keys])
+
+                similarities = self._matrix @ query
+                best = int(np.argmax(similarities))
+                key = self._matrix_keys[best]
+                entry = self._entries[key]
+
+                if similarities[best] >= self.similarity_threshold:
+                    if entry.expires_at >= time.monotonic():
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return entry
+
+                    self._pop(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, embedding, question: str, answer: str, ranked_neighbors: list | None) -> None:
+        entry = CachedAnswer(
+            question, answer, ranked_neighbors, time.monotonic() + self.ttl_seconds
+        )
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = entry
+            self._embeddings[key] = _to_unit_vector(embedding)
+            self._matrix = None
+
+            while len(self._entries) > self.max_entries:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def revalidate(self) -> None:
+        """
+        Drop the answers citing chunks that no longer exist, and those that cited none
+        since the new chunks may now answer them. Called after each ingest commit.
+        """
+
+        with self._lock:
+            entries = list(self._entries.items())
+
+        cited_ids = set().union(*(entry.document_ids for _, entry in entries))
+        existing_ids = set()
+        if cited_ids:
+            db = next(get_db())
+            try:
+                existing_ids = set(
+                    db.execute(select(DocumentModel.id).where(DocumentModel.id.in_(cited_ids))).scalars()
+                )
+            except Exception as e:
+                db.rollback()
+                raise e
+            finally:
+                db.close()
+
+        with self._lock:
+            for key, entry in entries:
+                stale = not entry.document_ids or not entry.document_ids <= existing_ids
+                if stale and key in self._entries:
+                    self._pop(key)
+            self.revalidations += 1
+
+        logger.info(f"Revalidated answer cache, kept {len(self._entries)} of {len(entries)} answers")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._embeddings.clear()
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "revalidations": self.revalidations,
+                "similarity_threshold": self.similarity_threshold,
+            }
+
+    ############################ PRIVATE METHODS ############################
+    def _pop(self, key) -> None:
+        self._entries.pop(key)
+        self._embeddings.pop(key)
+        self._matrix = None
+
+
+# shared by every chat session in this process
+answer_cache = SemanticAnswerCache()
+
+
+############################ PRIVATE METHODS ############################
+def _to_unit_vector(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), np.finfo(np.float32).tiny)
@@ -0,0 +1,250 @@
+import os
+import ssl
+import asyncio
+from datetime import datetime
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from instarest.core.config import get_core_settings
+from api.model_registry import model_registry
+from api.retrieval_cache import retrieval_cache, build_result_key
+from api.vector_index import build_search_settings
+from api.vector_snapshot import search_vector_snapshot
+from api.tracing import trace_stage
+from api.retrieval_crud import (
+    RetrievedDocument,
+    HYBRID_SEARCH,
+    HYBRID_CANDIDATE_K,
+    build_nearest_neighbors_statement,
+    build_text_search_statement,
+    build_documents_by_ids_statement,
+    reciprocal_rank_fusion,
+    rows_to_documents,
+)
+
+# retrievals allowed in flight at once, the rest wait their turn
+MAX_CONCURRENT_RETRIEVALS = int(os.environ.get("MAX_CONCURRENT_RETRIEVALS", 16))
+
+
+def build_async_database_uri() -> str:
+    """
+    Same database as instarest's engine, through the asyncpg driver.
+    """
+
+    uri = str(get_core_settings().sqlalchemy_database_uri)
+    return uri.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def build_connect_args() -> dict:
+    # asyncpg takes an ssl context instead of libpq's sslrootcert / sslmode
+    if get_core_settings().db_rootcert_path is None:
+        return {}
+
+    return {"ssl": ssl.create_default_context(cafile=get_core_settings().db_rootcert_path)}
+
+
+async_engine = create_async_engine(
+    build_async_database_uri(),
+    connect_args=build_connect_args(),
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+_retrieval_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RETRIEVALS)
+
+
+async def get_documents_by_nearest_neighbors(
+    *,
+    query_embedding: list[float],
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+    similarity_measure: str = "max_inner_product",
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[RetrievedDocument]:
+    """
+    Async version of CRUDRetrievalVectorStore.get_documents_by_source_metadata_and_nearest_neighbors.
+    Returns the documents, with their sources, as detached objects.
+    """
+
+    # numpy releases the GIL for the matrix products, so the search runs off the loop
+    document_ids = await asyncio.to_thread(
+        search_vector_snapshot,
+        query_embedding,
+        k=k,
+        titles=titles,
+        downloaded_datetime_start=downloaded_datetime_start,
+        downloaded_datetime_end=downloaded_datetime_end,
+        similarity_measure=similarity_measure,
+    )
+    if document_ids is not None:
+        documents = await get_documents_by_ids(document_ids)
+        return [documents[document_id] for document_id in document_ids if document_id in documents]
+
+    stmt = build_nearest_neighbors_statement(
+        query_embedding=query_embedding,
+        k=k,
+        titles=titles,
+        downloaded_datetime_start=downloaded_datetime_start,
+        downloaded_datetime_end=downloaded_datetime_end,
+        similarity_measure=similarity_measure,
+    )
+
+    with trace_stage("knn_sql"):
+        async with AsyncSessionLocal() as db:
+            # same transaction as the kNN query, so the settings end with it
+            for setting in build_search_settings(ef_search, probes):
+                await db.execute(setting)
+
+            result = await db.execute(stmt)
+            return rows_to_documents(result.all())
+
+
+async def get_documents_by_text_search(
+    *,
+    query: str,
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+) -> list[RetrievedDocument]:
+    """
+    Async version of CRUDRetrievalVectorStore.get_documents_by_source_metadata_and_text_search.
+    """
+
+    stmt = build_text_search_statement(
+        query=query,
+        k=k,
+        titles=titles,
+        downloaded_datetime_start=downloaded_datetime_start,
+        downloaded_datetime_end=downloaded_datetime_end,
+    )
+
+    with trace_stage("text_search_sql"):
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(stmt)
+            return rows_to_documents(result.all())
+
+
+async def get_documents_by_ids(document_ids: list) -> dict:
+    """
+    Document id -> document, with sources, for the ids that still exist.
+    """
+
+    with trace_stage("document_load"):
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(build_documents_by_ids_statement(document_ids))
+            return {document.id: document for document in rows_to_documents(result.all())}
+
+
+async def aretrieve(
+    query: str,
+    *,
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+    similarity_measure: str = "max_inner_product",
+    ef_search: int | None = None,
+    probes: int | None = None,
+    hybrid: bool = HYBRID_SEARCH,
+    candidate_k: int = HYBRID_CANDIDATE_K,
+) -> list[tuple[RetrievedDocument, float]]:
+    """
+    kNN search and cross encoder rerank without blocking the event loop.
+    With hybrid set, the top candidate_k of the kNN and of a full text search are
+    fused down to k documents before the rerank.
+    Returns (document, score) pairs sorted by decreasing score.
+    """
+
+    # a repeated question only needs its documents loaded
+    result_key = build_result_key(
+        query,
+        k,
+        titles,
+        downloaded_datetime_start,
+        downloaded_datetime_end,
+        similarity_measure,
+        ef_search,
+        probes,
+        hybrid,
+        candidate_k,
+    )
+    ranked_ids = retrieval_cache.get_results(result_key)
+    if ranked_ids is not None:
+        documents = await get_documents_by_ids([document_id for document_id, _ in ranked_ids])
+        return [
+            (documents[document_id], score)
+            for document_id, score in ranked_ids
+            if document_id in documents
+        ]
+
+    async with _retrieval_semaphore:
+        # wait for the models off the loop if they are still warming up
+        if not model_registry.is_ready():
+            with trace_stage("model_init"):
+                await asyncio.to_thread(model_registry.warm_up)
+
+        source_filters = {
+            "titles": titles,
+            "downloaded_datetime_start": downloaded_datetime_start,
+            "downloaded_datetime_end": downloaded_datetime_end,
+        }
+
+        # the text search does not need the embedding, so it runs while the query is encoded
+        text_search = None
+        if hybrid:
+            text_search = asyncio.create_task(
+                get_documents_by_text_search(query=query, k=candidate_k, **source_filters)
+            )
+
+        try:
+            # Calculate embedding for the query. encoding and reranking are CPU bound, so
+            # they run on the models' batching threads, combined with other sessions' queries
+            query_embedding = retrieval_cache.get_embedding(query)
+            if query_embedding is None:
+                with trace_stage("encode"):
+                    embeddings = await asyncio.wrap_future(
+                        model_registry.get_embedding_model().encode_future([query])
+                    )
+                query_embedding = embeddings[0]
+                retrieval_cache.put_embedding(query, query_embedding)
+
+            documents = await get_documents_by_nearest_neighbors(
+                query_embedding=query_embedding,
+                k=candidate_k if hybrid else k,
+                similarity_measure=similarity_measure,
+                ef_search=ef_search,
+                probes=probes,
+                **source_filters,
+            )
+            if text_search is not None:
+                documents = reciprocal_rank_fusion([documents, await text_search], k)
+        finally:
+            # an encode or kNN failure must not leave the text search holding its session,
+            # or its own error unretrieved
+            if text_search is not None:
+                if not text_search.done():
+                    text_search.cancel()
+                elif not text_search.cancelled():
+                    text_search.exception()
+
+        # If no documents are retrieved, return empty list
+        if len(documents) == 0:
+            retrieval_cache.put_results(result_key, [])
+            return []
+
+        # Score the documents via cross encoder
+        cross_encoder_inputs = [[query, document.page_content] for document in documents]
+        with trace_stage("rerank"):
+            scores = await asyncio.wrap_future(
+                model_registry.get_cross_encoder_model().predict_future(cross_encoder_inputs)
+            )
+
+        reranked_documents = sorted(
+            zip(documents, scores.tolist()), key=lambda item: item[1], reverse=True
+        )
+        retrieval_cache.put_results(
+            result_key, [(document.id, score) for document, score in reranked_documents]
+        )
+        return reranked_documents
@@ -6,32 +6,59 @@
 ## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
 from aimbase.crud.base import CRUDBaseAIModel
 from aimbase.db.base import BaseAIModel
-from aimbase.initializer import AimbaseInitializer
 from aimbase.routers.sentence_transformers_router import (
     SentenceTransformersRouter,
 )
-from aimbase.dependencies import get_minio
 from aimbase.crud.sentence_transformers_vector import (
     CRUDSentenceTransformersVectorStore,
 )
 from aimbase.crud.vector import CRUDSource
-from aimbase.db.vector import AllMiniVectorStore, SourceModel
+from aimbase.db.vector import AllMiniVectorStore, DocumentModel, SourceModel
 from instarest import (
     AppBase,
-    DeclarativeBase,
     SchemaBase,
-    Initializer,
     get_db,
     RESTRouter,
 )
-
-from aimbase.services.sentence_transformers_inference import (
-    SentenceTransformersInferenceService,
+import os
+import json
+import math
+import asyncio
+from datetime import datetime
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, StrictFloat, conint, conlist
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from api.model_registry import model_registry
+from api.retrieval_cache import retrieval_cache
+from api.answer_cache import answer_cache
+from api.vector_index import apply_search_settings
+from api.vector_snapshot import vector_snapshot_store, search_vector_snapshot
+from api.retrieval_crud import CRUDRetrievalVectorStore
+from api.startup import STARTUP_MODE, initialize_database, get_startup_status
+from api.admission import (
+    MAX_KNN_K,
+    MAX_RERANK_PAIRS,
+    AdmissionRejected,
+    SlotRelease,
+    search_admission,
+    get_client_id,
+    get_admission_status,
 )
+from api.tracing import trace_request, trace_stage, render_metrics
+
+# queries accepted by one batch kNN request
+BATCH_KNN_MAX_QUERIES = int(os.environ.get("BATCH_KNN_MAX_QUERIES", 10000))
+
+# queries encoded, searched and reranked together, then streamed before the next group
+BATCH_KNN_CHUNK_SIZE = int(os.environ.get("BATCH_KNN_CHUNK_SIZE", 256))
 
 # TODO: import to __init__.py for aimbase and update imports here
-Initializer(DeclarativeBase).execute(vector_toggle=True)
-AimbaseInitializer().execute()
+# in lazy startup mode this runs on the startup thread instead, see api.startup
+if STARTUP_MODE == "import":
+    initialize_database()
 
 # built pydantic data transfer schemas automagically
 base_ai_schemas = SchemaBase(BaseAIModel)
@@ -41,23 +68,333 @@ vector_embedding_schemas = SchemaBase(AllMiniVectorStore)
 crud_ai_test = CRUDBaseAIModel(BaseAIModel)
 crud_vector_test = CRUDSentenceTransformersVectorStore(AllMiniVectorStore)
 
-## ************ DEV INITIALIZATION ONLY (if desired to simulate
-#  no internet connection...will auto init on first endpoint hit, but
-#  will not auto-upload to minio) ************ ##
-SentenceTransformersInferenceService(
-    model_name="all-MiniLM-L6-v2",
-    db=next(get_db()),
-    crud=crud_ai_test,
-    s3=get_minio(),
-    prioritize_internet_download=False,
-).dev_init()
-## ************ DEV INITIALIZATION ONLY ************ ##
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that releases its admission slot once the response ends. The
+    generator's own finally never runs if the client disconnects before the first
+    chunk is pulled, so this covers that case.
+
+    **Parameters**
+
+    * `content`: Body iterator, as for StreamingResponse
+    * `release_slot`: Release of the slot the stream holds
+    """
+
+    def __init__(self, content, release_slot: SlotRelease, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release_slot = release_slot
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release_slot()
+
 
 # build ai router automagically
 class EpubsRouter(SentenceTransformersRouter):
     # override to hide all endpoints except knn search
     def _add_endpoints(self):
         self._define_knn_search()
+        self._define_batch_knn_search()
+
+    # override to expose the ANN index's recall / speed settings per query
+    def _define_knn_search(self):
+        class KnnInput(BaseModel):
+            query: str
+            k: conint(ge=1, le=MAX_KNN_K) = 100  # number of nearest neighbors to return, all are reranked
+            titles: list[str] | None = None
+            downloaded_datetime_start: datetime | None = None
+            downloaded_datetime_end: datetime | None = None
+            # the measure the ANN index is built for by default, see VECTOR_INDEX_MEASURES
+            similarity_measure: str = "max_inner_product"
+            # pgvector backend only, the snapshot search is exact
+            ef_search: conint(ge=1, le=1000) | None = None  # hnsw candidate list size, pgvector default 40
+            probes: conint(ge=1) | None = None  # ivfflat lists scanned, pgvector default 1
+
+        class RankedNeighbor(BaseModel):
+            document: self._document_schemas.Entity
+            score: StrictFloat
+
+        # kNN SEARCH
+        @self.router.post(
+            "/knn-search",
+            response_model=list[RankedNeighbor],
+            responses=self.responses,
+            summary="kNN search for similar documents",
+            response_description="List of documents similar to the query",
+        )
+        async def knn_search(
+            request: KnnInput,
+            http_request: Request,
+        ) -> list[RankedNeighbor]:
+            # stage timings are exported at /api/metrics, slow searches are logged with them
+            with trace_request("knn_search"):
+                # shed load with a 429 rather than queue without bound
+                try:
+                    with trace_stage("admission_wait"):
+                        await search_admission.admit(get_client_id(http_request))
+                except AdmissionRejected as e:
+                    raise self._build_overloaded_error(e)
+
+                # encode, kNN and rerank block, so they run on a worker thread that releases the
+                # slot when it is done. a client disconnect cancels the await but not the thread,
+                # and the shield keeps the thread from being dropped before it starts
+                release_slot = SlotRelease(search_admission)
+                return await asyncio.shield(
+                    asyncio.to_thread(self._knn_search, request, RankedNeighbor, release_slot)
+                )
+
+    def _knn_search(self, request, RankedNeighbor, release_slot):
+        # own session, the request's is closed once the handler returns, disconnects included
+        db = next(get_db())
+        try:
+            return self._search_and_rerank(request, db, RankedNeighbor)
+        finally:
+            db.close()
+            release_slot()
+
+    def _search_and_rerank(self, request, db, RankedNeighbor):
+        # the shared models, batched with every other session's encodes and reranks
+        try:
+            with trace_stage("model_init"):
+                embedding_model = model_registry.get_embedding_model()
+                cross_encoder_model = model_registry.get_cross_encoder_model()
+        except Exception:
+            raise self._build_model_not_initialized_error()
+
+        # Calculate embedding for the query
+        with trace_stage("encode"):
+            query_embedding = embedding_model.encode(request.query)
+
+        # Perform kNN search, on the in-process snapshot first like the other retrieval
+        # paths, then on pgvector if that backend is selected or no snapshot is loaded yet
+        documents = self._get_nearest_documents(db, request, query_embedding)
+
+        # Step 1: If no documents are retrieved, return empty list
+        if len(documents) == 0:
+            return []
+
+        # Step 2: Score the documents via cross encoder
+        cross_encoder_inputs = [[request.query, document.page_content] for document in documents]
+
+        with trace_stage("rerank"):
+            scores = cross_encoder_model.predict(
+                cross_encoder_inputs
+            ).tolist()  # need to convert numpy objs to list to be json serializable
+
+        # Step 3: Sort the scores in decreasing order, validating the ORM documents into the
+        # response schema reads any relationships not loaded yet
+        with trace_stage("response_build"):
+            unsorted_neighbors = []
+            for document, score in zip(documents, scores):
+                unsorted_neighbors.append(
+                    RankedNeighbor(document=document, score=score)
+                )
+
+        reranked_neighbors = sorted(
+            unsorted_neighbors, key=lambda item: item.score, reverse=True
+        )
+        return reranked_neighbors
+
+    def _get_nearest_documents(self, db, request, query_embedding) -> list[DocumentModel]:
+        # ORM documents, nearest first, since the response schema is built from them
+        document_ids = search_vector_snapshot(
+            query_embedding,
+            k=request.k,
+            titles=request.titles,
+            downloaded_datetime_start=request.downloaded_datetime_start,
+            downloaded_datetime_end=request.downloaded_datetime_end,
+            similarity_measure=request.similarity_measure,
+        )
+        if document_ids is not None:
+            with trace_stage("document_load"):
+                documents = {
+                    document.id: document
+                    for document in db.execute(
+                        select(DocumentModel)
+                        .where(DocumentModel.id.in_(document_ids))
+                        .options(selectinload(DocumentModel.source))
+                    ).scalars()
+                }
+            return [documents[document_id] for document_id in document_ids if document_id in documents]
+
+        # only lasts for this transaction, so pooled connections keep the defaults
+        apply_search_settings(db, ef_search=request.ef_search, probes=request.probes)
+
+        with trace_stage("knn_sql"):
+            retrieved_embeddings_db = (
+                self.crud_base.get_by_source_metadata_and_nearest_neighbors(
+                    db,
+                    titles=request.titles,
+                    downloaded_datetime_start=request.downloaded_datetime_start,
+                    downloaded_datetime_end=request.downloaded_datetime_end,
+                    vector_query=query_embedding,
+                    k=request.k,
+                    similarity_measure=request.similarity_measure,
+                )
+            )
+
+        # the documents are lazy loaded here
+        with trace_stage("document_load"):
+            return [emb.document for emb in retrieved_embeddings_db]
+
+    def _define_batch_knn_search(self):
+        class BatchKnnQuery(BaseModel):
+            query: str
+            # override the batch wide filters for this query
+            titles: list[str] | None = None
+            downloaded_datetime_start: datetime | None = None
+            downloaded_datetime_end: datetime | None = None
+
+        class BatchKnnInput(BaseModel):
+            queries: conlist(BatchKnnQuery, min_items=1, max_items=BATCH_KNN_MAX_QUERIES)
+            k: conint(ge=1, le=MAX_KNN_K) = 100  # number of nearest neighbors to return per query
+            titles: list[str] | None = None
+            downloaded_datetime_start: datetime | None = None
+            downloaded_datetime_end: datetime | None = None
+            similarity_measure: str = "max_inner_product"
+            ef_search: conint(ge=1, le=1000) | None = None
+            probes: conint(ge=1) | None = None
+
+        # BATCH kNN SEARCH
+        @self.router.post(
+            "/knn-search/batch",
+            response_class=StreamingResponse,
+            responses=self.responses,
+            summary="Batch kNN search for similar documents",
+            response_description=(
+                "NDJSON, one line per query in request order, with its index, query and "
+                "ranked neighbors, or an error"
+            ),
+        )
+        async def batch_knn_search(
+            request: BatchKnnInput,
+            http_request: Request,
+        ):
+            # one search slot for the whole stream, released once when it ends however it ends
+            try:
+                await search_admission.admit(get_client_id(http_request))
+            except AdmissionRejected as e:
+                raise self._build_overloaded_error(e)
+            release_slot = SlotRelease(search_admission)
+
+            # the shared models, waited for off the loop if they are still warming up
+            try:
+                if not model_registry.is_ready():
+                    await asyncio.to_thread(model_registry.warm_up)
+                embedding_model = model_registry.get_embedding_model()
+                cross_encoder_model = model_registry.get_cross_encoder_model()
+            except Exception:
+                release_slot()
+                raise self._build_model_not_initialized_error()
+            except asyncio.CancelledError as e:
+                # the client went away during the warm up, which carries on without it
+                release_slot()
+                raise e
+
+            # a sync generator is iterated on the threadpool, so the loop stays free
+            return AdmittedStreamingResponse(
+                self._stream_batch_knn_search(
+                    request, embedding_model, cross_encoder_model, release_slot
+                ),
+                release_slot=release_slot,
+                media_type="application/x-ndjson",
+            )
+
+    def _stream_batch_knn_search(self, request, embedding_model, cross_encoder_model, release_slot):
+        crud_base = CRUDRetrievalVectorStore(AllMiniVectorStore)
+
+        # fewer queries per chunk as k grows, so each rerank call stays bounded
+        chunk_size = max(1, min(BATCH_KNN_CHUNK_SIZE, MAX_RERANK_PAIRS // request.k))
+
+        # own session, the request's is closed once the handler returns
+        db = next(get_db())
+        try:
+            for start in range(0, len(request.queries), chunk_size):
+                chunk = request.queries[start : start + chunk_size]
+                try:
+                    with trace_request("batch_knn_chunk"):
+                        results = self._search_batch_chunk(
+                            db, crud_base, request, chunk, embedding_model, cross_encoder_model
+                        )
+                except Exception as e:
+                    db.rollback()
+                    results = [{"error": str(e)} for _ in chunk]
+
+                for index, (item, result) in enumerate(zip(chunk, results), start=start):
+                    line = {"index": index, "query": item.query, **result}
+                    yield json.dumps(jsonable_encoder(line)) + "\n"
+        finally:
+            db.close()
+            release_slot()
+
+    def _search_batch_chunk(
+        self, db, crud_base, request, chunk, embedding_model, cross_encoder_model
+    ) -> list[dict]:
+        # one encode for the whole chunk
+        with trace_stage("encode"):
+            query_embeddings = embedding_model.encode([item.query for item in chunk])
+
+        # queries with the same filters share one kNN statement
+        groups = {}
+        for position, item in enumerate(chunk):
+            filters = (
+                tuple(item.titles or request.titles or []),
+                item.downloaded_datetime_start or request.downloaded_datetime_start,
+                item.downloaded_datetime_end or request.downloaded_datetime_end,
+            )
+            groups.setdefault(filters, []).append(position)
+
+        # only lasts for this chunk's transaction, ended by the rollback below
+        apply_search_settings(db, ef_search=request.ef_search, probes=request.probes)
+        neighbors = [[] for _ in chunk]
+        for (titles, start, end), positions in groups.items():
+            documents = crud_base.get_documents_by_source_metadata_and_nearest_neighbors_batch(
+                db,
+                titles=list(titles) or None,
+                downloaded_datetime_start=start,
+                downloaded_datetime_end=end,
+                vector_queries=[query_embeddings[position] for position in positions],
+                k=request.k,
+                similarity_measure=request.similarity_measure,
+            )
+            for position, query_documents in zip(positions, documents):
+                neighbors[position] = query_documents
+        db.rollback()
+
+        # one rerank call for every (query, document) pair in the chunk
+        cross_encoder_inputs = [
+            [item.query, document.page_content]
+            for item, query_documents in zip(chunk, neighbors)
+            for document in query_documents
+        ]
+        with trace_stage("rerank"):
+            scores = (
+                cross_encoder_model.predict(cross_encoder_inputs).tolist()
+                if cross_encoder_inputs
+                else []
+            )
+
+        results = []
+        offset = 0
+        for query_documents in neighbors:
+            query_scores = scores[offset : offset + len(query_documents)]
+            offset += len(query_documents)
+            ranked = sorted(
+                zip(query_documents, query_scores), key=lambda item: item[1], reverse=True
+            )
+            results.append(
+                {"neighbors": [{"document": document, "score": score} for document, score in ranked]}
+            )
+        return results
+
+    def _build_overloaded_error(self, e: AdmissionRejected) -> HTTPException:
+        return HTTPException(
+            status_code=429,
+            detail=e.reason,
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
 
 document_vector_store_router = EpubsRouter(
     model_name="all-MiniLM-L6-v2",
@@ -98,5 +435,31 @@ app_base = AppBase(
 # automagic and version app
 auto_app = app_base.get_autowired_app()
 
+# readiness check, 503 until the DB is initialized and the shared retrieval models are warm
+@auto_app.get("/ready")
+def ready():
+    status = {**model_registry.status(), "startup": get_startup_status()}
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
+# hit rates and memory use of the retrieval cache, and hit rate of the chat answer cache
+@auto_app.get("/cache")
+def cache_stats():
+    return {**retrieval_cache.stats(), "answers": answer_cache.stats()}
+
+# per stage latency histograms of the chat, kNN and batch kNN paths, in the Prometheus text format
+@auto_app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# in flight, queued and shed requests, and the server side caps on k
+@auto_app.get("/admission")
+def admission_status():
+    return get_admission_status()
+
+# search backend and the version of the embedding snapshot in use
+@auto_app.get("/snapshot")
+def snapshot_status():
+    return vector_snapshot_store.status()
+
 # core underlying app
 app = app_base.get_core_app()
\ No newline at end of file
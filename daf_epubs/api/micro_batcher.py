@@ -0,0 +1,113 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+# most items combined into one forward pass, and how long the first request waits for company
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", 64))
+MICRO_BATCH_MAX_WAIT_MS = float(os.environ.get("MICRO_BATCH_MAX_WAIT_MS", 5))
+
+
+class MicroBatcher:
+    """
+    Combines the items of concurrent requests into single calls of batch_func,
+    then hands each request back its own slice of the results.
+
+    batch_func runs on one worker thread, so the model behind it is never called
+    from two threads at once.
+
+    **Parameters**
+
+    * `batch_func`: Takes a list of items and returns a sequence of results, one per item
+    * `max_batch_size`: Most items in one call, a single larger request still runs on its own
+    * `max_wait_ms`: How long to hold a batch open for more requests once the first arrives
+    * `name`: Name of the worker thread
+    """
+
+    def __init__(
+        self,
+        batch_func,
+        max_batch_size: int = MICRO_BATCH_MAX_SIZE,
+        max_wait_ms: float = MICRO_BATCH_MAX_WAIT_MS,
+        name: str = "micro-batcher",
+    ):
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+
+        self.batches = 0
+        self.items = 0
+
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, items: list) -> Future:
+        """
+        Queue items for the next batch. The future resolves to their results, in order.
+        """
+
+        future = Future()
+        if not items:
+            future.set_result([])
+        else:
+            self._requests.put((list(items), future))
+        return future
+
+    def __call__(self, items: list):
+        return self.submit(items).result()
+
+    def report(self) -> str:
+        average = self.items / self.batches if self.batches else 0
+        return f"{self._worker.name}: {self.batches} batches, {average:.1f} items per batch"
+
+    ############################ PRIVATE METHODS ############################
+    def _run(self):
+        pending = None
+        while True:
+            batch = [pending or self._requests.get()]
+            size = len(batch[0][0])
+            pending = None
+
+            # keep the batch open until it is full or the wait is up
+            deadline = time.perf_counter() + self.max_wait_seconds
+            while size < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                # a request that would overflow the batch starts the next one
+                if size + len(request[0]) > self.max_batch_size:
+                    pending = request
+                    break
+
+                batch.append(request)
+                size += len(request[0])
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # skip requests whose callers already gave up
+        batch = [(items, future) for items, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            results = self.batch_func([item for items, _ in batch for item in items])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.items += sum(len(items) for items, _ in batch)
+
+        start = 0
+        for items, future in batch:
+            future.set_result(results[start : start + len(items)])
+            start += len(items)
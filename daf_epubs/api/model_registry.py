@@ -0,0 +1,249 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+from instarest import get_db, LogConfig
+from aimbase.crud.base import CRUDBaseAIModel
+from aimbase.db.base import BaseAIModel
+from aimbase.core.minio import calculate_folder_hash
+from aimbase.dependencies import get_minio
+from aimbase.services.cross_encoder_inference import CrossEncoderInferenceService
+from aimbase.services.sentence_transformers_inference import (
+    SentenceTransformersInferenceService,
+)
+from api.micro_batcher import MicroBatcher
+from api.onnx_backend import INFERENCE_BACKEND, INFERENCE_BACKENDS, load_onnx_model
+from api.startup import wait_for_database
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-TinyBERT-L-6"
+
+logger = LogConfig(LOGGER_NAME="ModelRegistry").build_logger()
+
+
+class ModelHandle:
+    """
+    Shared handle to a loaded model. Concurrent encode and predict calls from any
+    session are combined into batched forward passes on one worker thread per model,
+    which also keeps the fast tokenizers from being used by two threads at once.
+
+    **Parameters**
+
+    * `model_name`: Name the model was loaded under
+    * `model`: Loaded SentenceTransformer or CrossEncoder
+    """
+
+    def __init__(self, model_name: str, model):
+        self.model_name = model_name
+        self.model = model
+
+        # SentenceTransformer only encodes and CrossEncoder only predicts
+        self._encode_batcher = None
+        if hasattr(model, "encode"):
+            self._encode_batcher = MicroBatcher(
+                lambda texts: self.model.encode(texts, batch_size=len(texts)),
+                name=f"{model_name}-encode",
+            )
+
+        self._predict_batcher = None
+        if hasattr(model, "predict"):
+            self._predict_batcher = MicroBatcher(
+                lambda pairs: self.model.predict(pairs, batch_size=len(pairs)),
+                name=f"{model_name}-predict",
+            )
+
+    def encode_future(self, sentences: list[str]) -> Future:
+        """
+        Embeddings of sentences, one row each, once their batch has run.
+        """
+
+        return self._encode_batcher.submit(sentences)
+
+    def predict_future(self, pairs: list[list[str]]) -> Future:
+        """
+        Scores of (query, passage) pairs, once their batch has run.
+        """
+
+        return self._predict_batcher.submit(pairs)
+
+    def encode(self, sentences: str | list[str]):
+        # a single string gives a single embedding, like SentenceTransformer.encode
+        if isinstance(sentences, str):
+            return self.encode_future([sentences]).result()[0]
+
+        return self.encode_future(sentences).result()
+
+    def predict(self, pairs: list[list[str]]):
+        return self.predict_future(pairs).result()
+
+    def report(self) -> str:
+        return ", ".join(
+            batcher.report()
+            for batcher in [self._encode_batcher, self._predict_batcher]
+            if batcher is not None
+        )
+
+
+class ModelRegistry:
+    """
+    Process-wide registry that loads the retrieval models once and hands out
+    the same handles to every session.
+
+    **Parameters**
+
+    * `embedding_model_name`: Sentence transformer used to embed queries
+    * `cross_encoder_model_name`: Cross encoder used to rerank neighbors
+    * `backend`: "torch" for the sentence-transformers models, "onnx" for their int8 ONNX exports
+    """
+
+    def __init__(
+        self,
+        embedding_model_name: str = EMBEDDING_MODEL_NAME,
+        cross_encoder_model_name: str = CROSS_ENCODER_MODEL_NAME,
+        backend: str = INFERENCE_BACKEND,
+    ):
+        if backend not in INFERENCE_BACKENDS:
+            raise ValueError(
+                f"Invalid inference backend {backend}. Supported backends: {INFERENCE_BACKENDS}"
+            )
+
+        self.embedding_model_name = embedding_model_name
+        self.cross_encoder_model_name = cross_encoder_model_name
+        self.backend = backend
+
+        self._handles: dict[str, ModelHandle] = {}
+        self._load_seconds: dict[str, float] = {}
+        self._error: Exception | None = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def warm_up(self) -> None:
+        """
+        Load every model that is not loaded yet. Safe to call from several threads,
+        only the first call does the work.
+        """
+
+        # the models are registered in the DB, which lazy startup may still be creating
+        wait_for_database()
+
+        with self._lock:
+            if self._ready.is_set():
+                return
+
+            db = next(get_db())
+            try:
+                for model_name, service_class in [
+                    (self.embedding_model_name, SentenceTransformersInferenceService),
+                    (self.cross_encoder_model_name, CrossEncoderInferenceService),
+                ]:
+                    if model_name in self._handles:
+                        continue
+
+                    start_time = time.perf_counter()
+                    service = service_class(
+                        model_name=model_name,
+                        db=db,
+                        crud=CRUDBaseAIModel(BaseAIModel),
+                        s3=get_minio(),
+                        prioritize_internet_download=False,
+                    )
+                    _register_baked_model(service)
+                    if self.backend == "onnx":
+                        model = load_onnx_model(service)
+                    else:
+                        service.initialize()
+                        model = service.model
+
+                    self._handles[model_name] = ModelHandle(model_name, model)
+                    self._load_seconds[model_name] = time.perf_counter() - start_time
+                    logger.info(
+                        f"Loaded {model_name} ({self.backend}) in {self._load_seconds[model_name]:.2f}s"
+                    )
+
+                self._error = None
+                self._ready.set()
+            except Exception as e:
+                self._error = e
+                raise e
+            finally:
+                db.close()
+
+    def warm_up_in_background(self) -> threading.Thread:
+        """
+        Start warm_up on a daemon thread, so startup is not blocked while the models load.
+        """
+
+        def run():
+            try:
+                self.warm_up()
+            except Exception as e:
+                logger.error(f"Model warm up failed: {e}")
+
+        thread = threading.Thread(target=run, name="model-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def status(self) -> dict:
+        """
+        Readiness report, with the load time of each model that is warm.
+        """
+
+        return {
+            "ready": self.is_ready(),
+            "backend": self.backend,
+            "models": {
+                model_name: {
+                    "loaded": model_name in self._handles,
+                    "load_seconds": self._load_seconds.get(model_name),
+                }
+                for model_name in [self.embedding_model_name, self.cross_encoder_model_name]
+            },
+            "batching": {
+                model_name: handle.report() for model_name, handle in self._handles.items()
+            },
+            "error": str(self._error) if self._error is not None else None,
+        }
+
+    def get_embedding_model(self) -> ModelHandle:
+        return self._get_handle(self.embedding_model_name)
+
+    def get_cross_encoder_model(self) -> ModelHandle:
+        return self._get_handle(self.cross_encoder_model_name)
+
+    ############################ PRIVATE METHODS ############################
+    def _get_handle(self, model_name: str) -> ModelHandle:
+        # blocks until a warm up in progress finishes, or loads the models now if none was started
+        if not self._ready.is_set():
+            self.warm_up()
+
+        return self._handles[model_name]
+
+
+# shared by the chainlit tool and the API in this process
+model_registry = ModelRegistry()
+
+
+############################ PRIVATE METHODS ############################
+def _register_baked_model(service) -> None:
+    # aimbase only loads from the local cache once the model has a DB row, so a model
+    # baked into the image (see bake_models.py) is registered instead of downloaded again
+    model_cache_path = service.get_model_cache_path()
+    if not os.path.isdir(model_cache_path) or not os.listdir(model_cache_path):
+        return
+
+    if service.get_obj_by_model_name() is not None:
+        return
+
+    service.crud.create(
+        service.db,
+        obj_in=BaseAIModel(
+            model_name=service.model_name,
+            local_cache_path=model_cache_path,
+            sha256=calculate_folder_hash(model_cache_path),
+            uploaded_minio=False,
+        ),
+    )
+    logger.info(f"Registered baked {service.model_name} from {model_cache_path}")
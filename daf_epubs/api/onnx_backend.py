@@ -0,0 +1,261 @@
+# scrape_epubs/src/onnx_backend.py is a copy of this module minus the cross encoder, the
+# two projects are packaged separately. KEEP THEM IN SYNC: query embeddings made here
+# search chunks embedded by the ingest, so any change to the export, pooling or
+# tokenization must land in both files. scrape_epubs/tests/test_onnx_backend.py fails
+# when the shared definitions drift apart.
+import os
+import json
+import shutil
+import numpy as np
+
+# "torch" runs the sentence-transformers models as they are, "onnx" runs int8 quantized
+# ONNX exports of them on onnxruntime's CPU provider
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+INFERENCE_BACKENDS = ["torch", "onnx"]
+
+# 0 lets onnxruntime pick, usually one thread per physical core
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", 0))
+ONNX_OPSET = 14
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_CONFIG_FILE = "onnx_config.json"
+
+
+def get_onnx_dir(model_cache_path: str) -> str:
+    return f"{model_cache_path}-onnx-int8"
+
+
+class OnnxSentenceEncoder:
+    """
+    Drop in for SentenceTransformer.encode, running the exported model, pooling and
+    normalization included, on onnxruntime.
+
+    **Parameters**
+
+    * `onnx_dir`: Directory written by export_sentence_transformer
+    """
+
+    def __init__(self, onnx_dir: str):
+        self.tokenizer, self.session, self.config = _load_onnx_dir(onnx_dir)
+
+    def encode(self, sentences: str | list[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        # a single string gives a single embedding, like SentenceTransformer.encode
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size=batch_size)[0]
+
+        embeddings = []
+        for i in range(0, len(sentences), batch_size):
+            features = self.tokenizer(
+                sentences[i : i + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.config["max_length"],
+                return_tensors="np",
+            )
+            embeddings.append(_run_session(self.session, features))
+
+        if not embeddings:
+            return np.zeros((0, self.config["dimension"]), dtype=np.float32)
+
+        return np.concatenate(embeddings)
+
+
+class OnnxCrossEncoder:
+    """
+    Drop in for CrossEncoder.predict, running the exported model and its
+    activation on onnxruntime.
+
+    **Parameters**
+
+    * `onnx_dir`: Directory written by export_cross_encoder
+    """
+
+    def __init__(self, onnx_dir: str):
+        self.tokenizer, self.session, self.config = _load_onnx_dir(onnx_dir)
+
+    def predict(self, sentences: list[list[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        scores = []
+        for i in range(0, len(sentences), batch_size):
+            batch = sentences[i : i + batch_size]
+            features = self.tokenizer(
+                [pair[0] for pair in batch],
+                [pair[1] for pair in batch],
+                padding=True,
+                truncation="longest_first",
+                max_length=self.config["max_length"],
+                return_tensors="np",
+            )
+            scores.append(_run_session(self.session, features))
+
+        if not scores:
+            return np.zeros(0, dtype=np.float32)
+
+        # one label models give one score per pair, like CrossEncoder.predict
+        scores = np.concatenate(scores)
+        return scores[:, 0] if scores.shape[1] == 1 else scores
+
+
+def export_sentence_transformer(model, onnx_dir: str) -> None:
+    """
+    Export a SentenceTransformer to onnx_dir as an int8 dynamically quantized model,
+    with its tokenizer alongside.
+    """
+
+    import torch
+
+    class SentenceEmbedding(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(
+                {
+                    "input_ids": input_ids,
+                    "attention_mask": attention_mask,
+                    "token_type_ids": token_type_ids,
+                }
+            )["sentence_embedding"]
+
+    _export(
+        SentenceEmbedding(),
+        model.tokenizer,
+        onnx_dir,
+        output_name="sentence_embedding",
+        config={
+            "max_length": model.max_seq_length,
+            "dimension": model.get_sentence_embedding_dimension(),
+        },
+    )
+
+
+def export_cross_encoder(model, onnx_dir: str) -> None:
+    """
+    Export a CrossEncoder to onnx_dir as an int8 dynamically quantized model,
+    with its tokenizer alongside.
+    """
+
+    import torch
+
+    class CrossEncoderScores(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model.model
+            self.activation = model.default_activation_function
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            logits = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                return_dict=True,
+            ).logits
+            return self.activation(logits)
+
+    _export(
+        CrossEncoderScores(),
+        model.tokenizer,
+        onnx_dir,
+        output_name="scores",
+        config={"max_length": model.max_length, "num_labels": model.config.num_labels},
+    )
+
+
+def load_onnx_model(service):
+    """
+    ONNX version of the model behind an aimbase sentence transformers or cross encoder
+    inference service. The model is exported on first use and kept next to the
+    service's model cache, later loads do not need the PyTorch model at all.
+    """
+
+    from aimbase.services.cross_encoder_inference import CrossEncoderInferenceService
+
+    is_cross_encoder = isinstance(service, CrossEncoderInferenceService)
+    onnx_dir = get_onnx_dir(service.get_model_cache_path())
+
+    if not os.path.isfile(os.path.join(onnx_dir, ONNX_MODEL_FILE)):
+        if not service.initialized:
+            service.initialize()
+
+        if is_cross_encoder:
+            export_cross_encoder(service.model, onnx_dir)
+        else:
+            export_sentence_transformer(service.model, onnx_dir)
+
+        # free the PyTorch weights, only the ONNX model is used from here on
+        service.model = None
+
+    return OnnxCrossEncoder(onnx_dir) if is_cross_encoder else OnnxSentenceEncoder(onnx_dir)
+
+
+############################ PRIVATE METHODS ############################
+def _export(module, tokenizer, onnx_dir: str, output_name: str, config: dict) -> None:
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    # build in a temporary directory so a half written export is never loaded
+    build_dir = f"{onnx_dir}.tmp"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    module.eval()
+    features = tokenizer(
+        ["export sample", "a longer export sample"],
+        ["text", "pair text"],
+        padding=True,
+        return_tensors="pt",
+    )
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes[output_name] = {0: "batch"}
+
+    fp32_path = os.path.join(build_dir, "model.fp32.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            tuple(features[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=[output_name],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+        )
+
+    quantize_dynamic(
+        fp32_path, os.path.join(build_dir, ONNX_MODEL_FILE), weight_type=QuantType.QInt8
+    )
+    os.remove(fp32_path)
+
+    tokenizer.save_pretrained(build_dir)
+    with open(os.path.join(build_dir, ONNX_CONFIG_FILE), "w") as file:
+        json.dump(config, file)
+
+    shutil.rmtree(onnx_dir, ignore_errors=True)
+    os.replace(build_dir, onnx_dir)
+
+
+def _load_onnx_dir(onnx_dir: str):
+    import onnxruntime
+    from transformers import AutoTokenizer
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+    session = onnxruntime.InferenceSession(
+        os.path.join(onnx_dir, ONNX_MODEL_FILE),
+        sess_options=options,
+        providers=["CPUExecutionProvider"],
+    )
+
+    with open(os.path.join(onnx_dir, ONNX_CONFIG_FILE)) as file:
+        config = json.load(file)
+
+    return AutoTokenizer.from_pretrained(onnx_dir), session, config
+
+
+def _run_session(session, features) -> np.ndarray:
+    # feed only the inputs the graph kept, unused ones are pruned at export
+    input_names = {graph_input.name for graph_input in session.get_inputs()}
+    return session.run(
+        None,
+        {name: value.astype(np.int64) for name, value in features.items() if name in input_names},
+    )[0]
@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import select
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from instarest import LogConfig
+from instarest.db.session import engine
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 2000))
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get("RESULT_CACHE_TTL_SECONDS", 3600))
+
+# the ingest pipeline notifies this channel each time it commits chunks
+INGEST_NOTIFY_CHANNEL = os.environ.get("INGEST_NOTIFY_CHANNEL", "epubs_ingest")
+LISTEN_RECONNECT_SECONDS = 5
+
+logger = LogConfig(LOGGER_NAME="RetrievalCache").build_logger()
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def build_result_key(
+    query: str,
+    k: int,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+    similarity_measure: str = "max_inner_product",
+    ef_search: int | None = None,
+    probes: int | None = None,
+    hybrid: bool = False,
+    candidate_k: int | None = None,
+) -> tuple:
+    return (
+        normalize_query(query),
+        k,
+        tuple(sorted(title.lower() for title in titles)) if titles else None,
+        downloaded_datetime_start,
+        downloaded_datetime_end,
+        similarity_measure,
+        ef_search,
+        probes,
+        candidate_k if hybrid else None,
+    )
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache that counts hits and misses and the approximate
+    size of what it holds.
+
+    **Parameters**
+
+    * `max_entries`: Least recently used entries are dropped past this size
+    * `ttl_seconds`: Optional time after which an entry counts as a miss
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float | None = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+
+        self._entries = OrderedDict()  # key -> (expires_at, size_bytes, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                self._pop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, size_bytes: int) -> None:
+        expires_at = None
+        if self.ttl_seconds is not None:
+            expires_at = time.monotonic() + self.ttl_seconds
+
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+            self._entries[key] = (expires_at, size_bytes, value)
+            self.size_bytes += size_bytes
+
+            while len(self._entries) > self.max_entries:
+                self._pop(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size_bytes": self.size_bytes,
+            }
+
+    ############################ PRIVATE METHODS ############################
+    def _pop(self, key) -> None:
+        _, size_bytes, _ = self._entries.pop(key)
+        self.size_bytes -= size_bytes
+
+
+class RetrievalCache:
+    """
+    Two tier cache for retrieval: normalized query -> embedding, and
+    (query, k, filters) -> reranked document ids and scores.
+    Both tiers are cleared whenever an ingest run commits new chunks.
+
+    **Parameters**
+
+    * `embedding_cache_size`: Most query embeddings kept
+    * `result_cache_size`: Most reranked results kept
+    * `result_ttl_seconds`: How long a reranked result stays valid
+    """
+
+    def __init__(
+        self,
+        embedding_cache_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+        result_cache_size: int = RESULT_CACHE_SIZE,
+        result_ttl_seconds: float = RESULT_CACHE_TTL_SECONDS,
+    ):
+        self.embeddings = LRUCache(embedding_cache_size)
+        self.results = LRUCache(result_cache_size, ttl_seconds=result_ttl_seconds)
+
+        self.invalidations = 0
+        self._listener = None
+        self._on_invalidate = []
+
+    def get_embedding(self, query: str):
+        return self.embeddings.get(normalize_query(query))
+
+    def put_embedding(self, query: str, embedding) -> None:
+        self.embeddings.put(normalize_query(query), embedding, embedding.nbytes)
+
+    def get_results(self, key: tuple) -> list[tuple] | None:
+        """
+        (document id, score) pairs sorted by decreasing score, if cached.
+        """
+
+        return self.results.get(key)
+
+    def put_results(self, key: tuple, ranked_ids: list[tuple]) -> None:
+        size_bytes = sys.getsizeof(ranked_ids) + sum(
+            sys.getsizeof(pair) + sys.getsizeof(pair[0]) + sys.getsizeof(pair[1])
+            for pair in ranked_ids
+        )
+        self.results.put(key, ranked_ids, size_bytes)
+
+    def add_invalidation_listener(self, callback) -> None:
+        """
+        Call callback after each invalidation, on the thread that invalidated.
+        """
+
+        self._on_invalidate.append(callback)
+
+    def invalidate(self) -> None:
+        self.embeddings.clear()
+        self.results.clear()
+        self.invalidations += 1
+
+        for callback in self._on_invalidate:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Invalidation listener failed: {e}")
+
+    def stats(self) -> dict:
+        embedding_stats = self.embeddings.stats()
+        result_stats = self.results.stats()
+        return {
+            "query_embeddings": embedding_stats,
+            "results": result_stats,
+            "size_bytes": embedding_stats["size_bytes"] + result_stats["size_bytes"],
+            "invalidations": self.invalidations,
+            "listening": self._listener is not None and self._listener.is_alive(),
+        }
+
+    def start_invalidation_listener(self) -> threading.Thread:
+        """
+        LISTEN for ingest commits on a daemon thread and invalidate on each one.
+        """
+
+        if self._listener is None:
+            self._listener = threading.Thread(
+                target=self._listen, name="retrieval-cache-listener", daemon=True
+            )
+            self._listener.start()
+        return self._listener
+
+    ############################ PRIVATE METHODS ############################
+    def _listen(self) -> None:
+        while True:
+            connection = None
+            try:
+                # detached, so the autocommit connection never goes back to the pool
+                connection = engine.raw_connection()
+                connection.detach()
+                connection.driver_connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{INGEST_NOTIFY_CHANNEL}"')
+
+                # anything committed while not listening is unknown, so start clean
+                self.invalidate()
+
+                while True:
+                    if select.select([connection.driver_connection], [], [], 60) == ([], [], []):
+                        continue
+
+                    connection.driver_connection.poll()
+                    if connection.driver_connection.notifies:
+                        connection.driver_connection.notifies.clear()
+                        self.invalidate()
+            except Exception as e:
+                logger.error(f"Ingest listener disconnected, retrying: {e}")
+                time.sleep(LISTEN_RECONNECT_SECONDS)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+
+# shared by the chainlit tool and the API in this process
+retrieval_cache = RetrievalCache()
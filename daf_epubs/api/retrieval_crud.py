@@ -0,0 +1,390 @@
+import os
+import re
+from datetime import datetime
+from uuid import UUID
+from pydantic import BaseModel
+from sqlalchemy import select, func, or_, cast, text, true, values, column, Integer, String, Select
+from sqlalchemy.dialects.postgresql import TSQUERY
+from sqlalchemy.orm import Session
+from aimbase.crud.sentence_transformers_vector import (
+    CRUDSentenceTransformersVectorStore,
+)
+from aimbase.db.vector import AllMiniVectorStore, SourceModel, DocumentModel
+from api.vector_snapshot import search_vector_snapshot
+from api.tracing import trace_stage
+
+SIMILARITY_MEASURES = ["cosine_distance", "l2_distance", "max_inner_product"]
+
+# postgres text search configuration for the lexical side of hybrid search, inlined into
+# the SQL so queries match the expression of the GIN index built by api.vector_index
+TEXT_SEARCH_CONFIG = os.environ.get("TEXT_SEARCH_CONFIG", "english")
+if not re.fullmatch(r"[a-z_]+", TEXT_SEARCH_CONFIG):
+    raise ValueError(f"Invalid text search configuration {TEXT_SEARCH_CONFIG}")
+
+# merge a full text search into the kNN results before the rerank
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "True") == "True"
+
+# candidates taken from each of the vector and lexical searches before fusion
+HYBRID_CANDIDATE_K = int(os.environ.get("HYBRID_CANDIDATE_K", 50))
+
+# reciprocal rank fusion constant, 60 is the value from the original RRF paper
+RRF_K = int(os.environ.get("RRF_K", 60))
+
+
+class RetrievedSource(BaseModel):
+    id: UUID | None = None
+    title: str | None = None
+    public_url: str | None = None
+
+
+class RetrievedDocument(BaseModel):
+    """
+    Detached copy of the DocumentModel columns retrieval uses, with its source.
+    Safe to read after the session that loaded it is closed.
+    """
+
+    id: UUID
+    page_content: str | None = None
+    source: RetrievedSource
+
+
+def build_nearest_neighbors_statement(
+    *,
+    query_embedding: list[float],
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+    similarity_measure: str = "max_inner_product",
+) -> Select:
+    """
+    One query for the k nearest chunks with their documents and sources, selecting only
+    the columns RetrievedDocument needs. Shared by the sync and async retrieval paths.
+    """
+
+    if similarity_measure not in SIMILARITY_MEASURES:
+        raise ValueError(
+            f"Invalid similarity measure. Supported measures: {SIMILARITY_MEASURES}."
+        )
+
+    distance = getattr(AllMiniVectorStore.embedding, similarity_measure)(query_embedding)
+    stmt = _select_document_columns().join(
+        AllMiniVectorStore, AllMiniVectorStore.document_id == DocumentModel.id
+    )
+    stmt = _filter_by_source_metadata(
+        stmt, titles, downloaded_datetime_start, downloaded_datetime_end
+    )
+
+    return stmt.order_by(distance).limit(k)
+
+
+def build_text_search_vector():
+    # text rather than literal_column, so an Index on this expression finds its table
+    return func.to_tsvector(text(f"'{TEXT_SEARCH_CONFIG}'"), DocumentModel.page_content)
+
+
+def build_text_search_query(query: str):
+    # plainto_tsquery ANDs every word, which a question rarely fully matches. OR them
+    # instead and let the rank favour chunks that match more of them
+    and_query = cast(func.plainto_tsquery(text(f"'{TEXT_SEARCH_CONFIG}'"), query), String)
+    return cast(func.replace(and_query, "&", "|"), TSQUERY)
+
+
+def build_text_search_statement(
+    *,
+    query: str,
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+) -> Select:
+    """
+    Full text search of the chunks, best ts_rank_cd first. Catches exact terms such as
+    publication numbers and acronyms that the embeddings match poorly.
+    """
+
+    text_search_vector = build_text_search_vector()
+    text_search_query = build_text_search_query(query)
+
+    stmt = _select_document_columns().where(text_search_vector.op("@@")(text_search_query))
+    stmt = _filter_by_source_metadata(
+        stmt, titles, downloaded_datetime_start, downloaded_datetime_end
+    )
+
+    return stmt.order_by(func.ts_rank_cd(text_search_vector, text_search_query).desc()).limit(k)
+
+
+def reciprocal_rank_fusion(ranked_lists: list[list], k: int, rrf_k: int = RRF_K) -> list:
+    """
+    Merge ranked lists of RetrievedDocument into the k documents with the highest
+    sum of 1 / (rrf_k + rank) across the lists they appear in.
+    """
+
+    scores = {}
+    documents = {}
+    for ranked_list in ranked_lists:
+        for rank, document in enumerate(ranked_list, start=1):
+            scores[document.id] = scores.get(document.id, 0.0) + 1.0 / (rrf_k + rank)
+            documents.setdefault(document.id, document)
+
+    # sorted is stable, so ties keep the order of first appearance, vector results first
+    fused_ids = sorted(scores, key=lambda document_id: scores[document_id], reverse=True)
+    return [documents[document_id] for document_id in fused_ids[:k]]
+
+
+def build_batch_nearest_neighbors_statement(
+    *,
+    query_embeddings: list,
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+    similarity_measure: str = "max_inner_product",
+) -> Select:
+    """
+    build_nearest_neighbors_statement for many query embeddings sharing the same
+    filters, in one round trip. The queries are sent as a VALUES list and each one
+    runs its own kNN as a LATERAL subquery, so it can still use the ANN index.
+    Rows carry the position of their query in query_embeddings as ordinal.
+    """
+
+    if similarity_measure not in SIMILARITY_MEASURES:
+        raise ValueError(
+            f"Invalid similarity measure. Supported measures: {SIMILARITY_MEASURES}."
+        )
+
+    vector_type = AllMiniVectorStore.embedding.type
+    queries = values(
+        column("ordinal", Integer), column("embedding", vector_type), name="queries"
+    ).data(list(enumerate(query_embeddings)))
+
+    # VALUES parameters arrive untyped, so the cast is needed for the distance operator
+    distance = getattr(AllMiniVectorStore.embedding, similarity_measure)(
+        cast(queries.c.embedding, vector_type)
+    )
+    neighbors = (
+        _select_document_columns()
+        .add_columns(distance.label("distance"))
+        .join(AllMiniVectorStore, AllMiniVectorStore.document_id == DocumentModel.id)
+    )
+    neighbors = _filter_by_source_metadata(
+        neighbors, titles, downloaded_datetime_start, downloaded_datetime_end
+    )
+    neighbors = neighbors.order_by(distance).limit(k).lateral("neighbors")
+
+    return (
+        select(queries.c.ordinal, neighbors)
+        .select_from(queries)
+        .join(neighbors, true())
+        .order_by(queries.c.ordinal, neighbors.c.distance)
+    )
+
+
+def build_documents_by_ids_statement(document_ids: list) -> Select:
+    return _select_document_columns().where(DocumentModel.id.in_(document_ids))
+
+
+def rows_to_documents(rows) -> list[RetrievedDocument]:
+    # construct skips validation, the values come straight from typed columns
+    return [
+        RetrievedDocument.construct(
+            id=row.id,
+            page_content=row.page_content,
+            source=RetrievedSource.construct(
+                id=row.source_id, title=row.title, public_url=row.public_url
+            ),
+        )
+        for row in rows
+    ]
+
+
+class CRUDRetrievalVectorStore(CRUDSentenceTransformersVectorStore):
+    """
+    AllMiniVectorStore CRUD for the agent's retrieval, returning RetrievedDocument
+    objects instead of ORM rows so there are no lazy loads per result.
+    """
+
+    def get_documents_by_source_metadata_and_nearest_neighbors(
+        self,
+        db: Session,
+        *,
+        titles: list[str] | None = None,
+        downloaded_datetime_start: datetime | None = None,
+        downloaded_datetime_end: datetime | None = None,
+        vector_query: list[float],
+        k: int = 10,
+        similarity_measure: str = "max_inner_product",
+    ) -> list[RetrievedDocument]:
+        # with the snapshot backend the DB only looks the documents up by primary key
+        document_ids = search_vector_snapshot(
+            vector_query,
+            k=k,
+            titles=titles,
+            downloaded_datetime_start=downloaded_datetime_start,
+            downloaded_datetime_end=downloaded_datetime_end,
+            similarity_measure=similarity_measure,
+        )
+        if document_ids is not None:
+            documents = self.get_documents_by_ids(db, document_ids)
+            return [documents[document_id] for document_id in document_ids if document_id in documents]
+
+        stmt = build_nearest_neighbors_statement(
+            query_embedding=vector_query,
+            k=k,
+            titles=titles,
+            downloaded_datetime_start=downloaded_datetime_start,
+            downloaded_datetime_end=downloaded_datetime_end,
+            similarity_measure=similarity_measure,
+        )
+        with trace_stage("knn_sql"):
+            return rows_to_documents(db.execute(stmt).all())
+
+    def get_documents_by_source_metadata_and_text_search(
+        self,
+        db: Session,
+        *,
+        titles: list[str] | None = None,
+        downloaded_datetime_start: datetime | None = None,
+        downloaded_datetime_end: datetime | None = None,
+        text_query: str,
+        k: int = 10,
+    ) -> list[RetrievedDocument]:
+        stmt = build_text_search_statement(
+            query=text_query,
+            k=k,
+            titles=titles,
+            downloaded_datetime_start=downloaded_datetime_start,
+            downloaded_datetime_end=downloaded_datetime_end,
+        )
+        with trace_stage("text_search_sql"):
+            return rows_to_documents(db.execute(stmt).all())
+
+    def get_documents_by_source_metadata_and_hybrid_search(
+        self,
+        db: Session,
+        *,
+        titles: list[str] | None = None,
+        downloaded_datetime_start: datetime | None = None,
+        downloaded_datetime_end: datetime | None = None,
+        vector_query: list[float],
+        text_query: str,
+        k: int = 10,
+        candidate_k: int = HYBRID_CANDIDATE_K,
+        similarity_measure: str = "max_inner_product",
+    ) -> list[RetrievedDocument]:
+        """
+        Top candidate_k of both the vector and the text search, merged with
+        reciprocal rank fusion down to k documents.
+        """
+
+        source_filters = {
+            "titles": titles,
+            "downloaded_datetime_start": downloaded_datetime_start,
+            "downloaded_datetime_end": downloaded_datetime_end,
+        }
+        vector_documents = self.get_documents_by_source_metadata_and_nearest_neighbors(
+            db,
+            vector_query=vector_query,
+            k=candidate_k,
+            similarity_measure=similarity_measure,
+            **source_filters,
+        )
+        text_documents = self.get_documents_by_source_metadata_and_text_search(
+            db, text_query=text_query, k=candidate_k, **source_filters
+        )
+        return reciprocal_rank_fusion([vector_documents, text_documents], k)
+
+    def get_documents_by_source_metadata_and_nearest_neighbors_batch(
+        self,
+        db: Session,
+        *,
+        titles: list[str] | None = None,
+        downloaded_datetime_start: datetime | None = None,
+        downloaded_datetime_end: datetime | None = None,
+        vector_queries: list,
+        k: int = 10,
+        similarity_measure: str = "max_inner_product",
+    ) -> list[list[RetrievedDocument]]:
+        """
+        Nearest documents of each of vector_queries, in the same order, with
+        one DB round trip for the whole batch.
+        """
+
+        source_filters = {
+            "titles": titles,
+            "downloaded_datetime_start": downloaded_datetime_start,
+            "downloaded_datetime_end": downloaded_datetime_end,
+        }
+
+        # with the snapshot backend the searches run in process and share one id lookup
+        snapshot_results = [
+            search_vector_snapshot(
+                vector_query, k=k, similarity_measure=similarity_measure, **source_filters
+            )
+            for vector_query in vector_queries
+        ]
+        if vector_queries and snapshot_results[0] is not None:
+            documents = self.get_documents_by_ids(
+                db, list({document_id for ids in snapshot_results for document_id in ids})
+            )
+            return [
+                [documents[document_id] for document_id in ids if document_id in documents]
+                for ids in snapshot_results
+            ]
+
+        results = [[] for _ in vector_queries]
+        if not vector_queries:
+            return results
+
+        stmt = build_batch_nearest_neighbors_statement(
+            query_embeddings=vector_queries,
+            k=k,
+            similarity_measure=similarity_measure,
+            **source_filters,
+        )
+        with trace_stage("knn_sql"):
+            rows = db.execute(stmt).all()
+        for row, document in zip(rows, rows_to_documents(rows)):
+            results[row.ordinal].append(document)
+        return results
+
+    def get_documents_by_ids(self, db: Session, document_ids: list) -> dict:
+        """
+        Document id -> RetrievedDocument, for the ids that still exist.
+        """
+
+        with trace_stage("document_load"):
+            rows = db.execute(build_documents_by_ids_statement(document_ids)).all()
+        return {document.id: document for document in rows_to_documents(rows)}
+
+
+############################ PRIVATE METHODS ############################
+def _filter_by_source_metadata(
+    stmt: Select,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+) -> Select:
+    if titles:
+        stmt = stmt.where(
+            or_(*[func.lower(SourceModel.title).contains(title.lower()) for title in titles])
+        )
+
+    if downloaded_datetime_start:
+        stmt = stmt.where(SourceModel.downloaded_datetime >= downloaded_datetime_start)
+
+    if downloaded_datetime_end:
+        stmt = stmt.where(SourceModel.downloaded_datetime <= downloaded_datetime_end)
+
+    return stmt
+
+
+def _select_document_columns() -> Select:
+    # outer join, like the ORM relationship a document without a source is still returned
+    return select(
+        DocumentModel.id,
+        DocumentModel.page_content,
+        SourceModel.id.label("source_id"),
+        SourceModel.title,
+        SourceModel.public_url,
+    ).outerjoin(SourceModel, SourceModel.id == DocumentModel.source_id)
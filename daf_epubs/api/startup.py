@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from instarest import LogConfig
+
+# "import" initializes the DB schema and models when api.base is imported, as it always has.
+# "lazy" leaves both to a background thread started with the app, so the process starts
+# serving right away and reports readiness at /api/ready once they are done
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "import")
+STARTUP_MODES = ["import", "lazy"]
+
+# the dev_init upload of all-MiniLM-L6-v2 to minio, skipped in lazy mode unless set
+DEV_INIT = os.environ.get("DEV_INIT", str(STARTUP_MODE == "import")) == "True"
+
+logger = LogConfig(LOGGER_NAME="Startup").build_logger()
+
+
+class StartupTimings:
+    """
+    Seconds spent in each named phase of startup, logged as each one ends and
+    reported at /api/ready.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._seconds[name] = seconds
+        logger.info(f"Startup phase {name} took {seconds:.2f}s")
+
+    def report(self) -> dict:
+        with self._lock:
+            return dict(self._seconds)
+
+
+startup_timings = StartupTimings()
+
+# set once the schema exists, the models are registered in the DB so they wait for it
+_database_ready = threading.Event()
+_database_error: Exception | None = None
+
+
+def initialize_database(dev_init: bool = DEV_INIT) -> None:
+    """
+    Create the schema and the aimbase tables, and optionally run the all-MiniLM-L6-v2
+    dev_init. Heavy imports stay inside so importing this module is cheap.
+    """
+
+    global _database_error
+
+    if STARTUP_MODE not in STARTUP_MODES:
+        raise ValueError(f"Invalid startup mode {STARTUP_MODE}. Supported modes: {STARTUP_MODES}")
+
+    from instarest import Initializer, DeclarativeBase, get_db
+    from aimbase.initializer import AimbaseInitializer
+
+    try:
+        with startup_timings.phase("db_init"):
+            Initializer(DeclarativeBase).execute(vector_toggle=True)
+            AimbaseInitializer().execute()
+
+        if dev_init:
+            from aimbase.crud.base import CRUDBaseAIModel
+            from aimbase.db.base import BaseAIModel
+            from aimbase.dependencies import get_minio
+            from aimbase.services.sentence_transformers_inference import (
+                SentenceTransformersInferenceService,
+            )
+
+            ## ************ DEV INITIALIZATION ONLY (if desired to simulate
+            #  no internet connection...will auto init on first endpoint hit, but
+            #  will not auto-upload to minio) ************ ##
+            with startup_timings.phase("dev_init"):
+                SentenceTransformersInferenceService(
+                    model_name="all-MiniLM-L6-v2",
+                    db=next(get_db()),
+                    crud=CRUDBaseAIModel(BaseAIModel),
+                    s3=get_minio(),
+                    prioritize_internet_download=False,
+                ).dev_init()
+            ## ************ DEV INITIALIZATION ONLY ************ ##
+
+        _database_error = None
+        _database_ready.set()
+    except Exception as e:
+        _database_error = e
+        raise e
+
+
+def wait_for_database(timeout: float | None = None) -> bool:
+    """
+    Block until initialize_database has finished. Returns immediately in import mode,
+    where it ran before anything could call this.
+    """
+
+    if STARTUP_MODE == "import":
+        return True
+
+    return _database_ready.wait(timeout)
+
+
+def run_startup_in_background(*steps) -> threading.Thread:
+    """
+    In lazy mode, initialize the DB then run each step in order on a daemon thread.
+    In import mode the DB is already initialized, so only the steps run.
+    """
+
+    def run():
+        try:
+            if STARTUP_MODE == "lazy":
+                initialize_database()
+
+            for step in steps:
+                step()
+        except Exception as e:
+            logger.error(f"Startup failed: {e}")
+
+    thread = threading.Thread(target=run, name="startup", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_startup_status() -> dict:
+    return {
+        "mode": STARTUP_MODE,
+        "database_ready": STARTUP_MODE == "import" or _database_ready.is_set(),
+        "database_error": str(_database_error) if _database_error is not None else None,
+        "timings": startup_timings.report(),
+    }
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from instarest import LogConfig
+
+# requests slower than this are logged with their stage timings, and their profile if sampled
+TRACE_SLOW_REQUEST_SECONDS = float(os.environ.get("TRACE_SLOW_REQUEST_SECONDS", 5))
+
+# sample the stacks of every thread while a traced request runs, kept only if it turns out slow
+TRACE_PROFILE = os.environ.get("TRACE_PROFILE", "False") == "True"
+TRACE_PROFILE_INTERVAL_SECONDS = float(os.environ.get("TRACE_PROFILE_INTERVAL_SECONDS", 0.01))
+TRACE_PROFILE_TOP_STACKS = int(os.environ.get("TRACE_PROFILE_TOP_STACKS", 20))
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS_PREFIX = "daf_epubs"
+
+logger = LogConfig(LOGGER_NAME="Tracing").build_logger()
+
+
+class LatencyHistograms:
+    """
+    Thread-safe cumulative histograms of durations, one per set of label values,
+    rendered in the Prometheus text exposition format.
+
+    **Parameters**
+
+    * `name`: Metric name, without the prefix
+    * `description`: HELP text of the metric
+    * `label_names`: Names of the labels every observation is given values for
+    * `buckets`: Upper bounds of the buckets, in seconds
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+
+        # label values -> [bucket counts..., count in +Inf only], sum
+        self._counts = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple, seconds: float) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(label_values, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._sums[label_values] = self._sums.get(label_values, 0.0) + seconds
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, counts in sorted(self._counts.items()):
+                labels = ",".join(
+                    f'{name}="{_escape_label(value)}"' for name, value in zip(self.label_names, label_values)
+                )
+                cumulative = 0
+                for bound, count in zip([*map(str, self.buckets), "+Inf"], counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{labels}}} {self._sums[label_values]}")
+                lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+request_durations = LatencyHistograms(
+    "request_duration_seconds", "End to end duration of traced requests.", ("path",)
+)
+stage_durations = LatencyHistograms(
+    "stage_duration_seconds", "Duration of each stage of traced requests.", ("path", "stage")
+)
+
+
+class RequestTrace:
+    """
+    Stage timings of one request. Stages may nest, e.g. the retrieval tool's stages
+    run inside the chat agent stage, and are listed in the order they finished.
+
+    **Parameters**
+
+    * `path`: Which request path this is, e.g. chat or knn_search
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.start_time = time.perf_counter()
+        self.seconds = None
+        self.stages: list[tuple[str, float]] = []
+        self.profile: Counter | None = None
+
+        # stages of tasks created by the request append here too
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.append((stage, seconds))
+        stage_durations.observe((self.path, stage), seconds)
+
+    def report(self) -> dict:
+        with self._lock:
+            stages = {}
+            for stage, seconds in self.stages:
+                stages[stage] = stages.get(stage, 0.0) + seconds
+
+        return {
+            "path": self.path,
+            "seconds": self.seconds,
+            "stages": {stage: round(seconds, 6) for stage, seconds in stages.items()},
+        }
+
+
+_current_trace: ContextVar[RequestTrace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def trace_request(path: str):
+    """
+    Trace the enclosed request. Stages timed with trace_stage anywhere below it,
+    including in tasks and to_thread calls it starts, are added to the trace.
+    """
+
+    trace = RequestTrace(path)
+    token = _current_trace.set(trace)
+    profiler = _StackSampler() if TRACE_PROFILE else None
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.seconds = time.perf_counter() - trace.start_time
+        request_durations.observe((path,), trace.seconds)
+
+        if profiler is not None:
+            trace.profile = profiler.stop()
+
+        if trace.seconds >= TRACE_SLOW_REQUEST_SECONDS:
+            _log_slow_request(trace)
+
+
+@contextmanager
+def trace_stage(stage: str):
+    """
+    Time the enclosed stage into the current request's trace, if there is one.
+    """
+
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(stage, time.perf_counter() - start_time)
+
+
+def get_current_trace() -> RequestTrace | None:
+    return _current_trace.get()
+
+
+def render_metrics() -> str:
+    lines = [*request_durations.render(), *stage_durations.render()]
+    return "\n".join(lines) + "\n"
+
+
+############################ PRIVATE METHODS ############################
+class _StackSampler:
+    # samples the stack of every other thread until stopped, stdlib only so it is always available
+    def __init__(self, interval: float = TRACE_PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = Counter()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame)
+                self.samples[
+                    ";".join(f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})" for entry in stack)
+                ] += 1
+
+
+def _log_slow_request(trace: RequestTrace) -> None:
+    report = trace.report()
+    if trace.profile:
+        # collapsed stacks, the format flamegraph tools read
+        report["profile"] = [
+            f"{stack} {count}" for stack, count in trace.profile.most_common(TRACE_PROFILE_TOP_STACKS)
+        ]
+    logger.warning(f"Slow request: {json.dumps(report)}")
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
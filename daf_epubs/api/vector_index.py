@@ -0,0 +1,254 @@
+import os
+import sys
+import time
+import threading
+from sqlalchemy import Index, select, func, text
+from sqlalchemy.orm import Session
+from instarest import LogConfig
+from instarest.db.session import engine
+from aimbase.db.vector import AllMiniVectorStore, DocumentModel
+from api.retrieval_crud import TEXT_SEARCH_CONFIG, build_text_search_vector
+
+# "hnsw" needs pgvector 0.5.0 or later, older servers fall back to "ivfflat"
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "hnsw")
+VECTOR_INDEX_TYPES = ["hnsw", "ivfflat"]
+
+# one index per similarity measure, since pgvector only uses an index built for the query's operator.
+# every search path defaults to max_inner_product, all-MiniLM-L6-v2 embeddings are unit length so
+# it ranks the same as cosine_distance with a cheaper operator. queries asking for another measure
+# scan the table unless it is listed here too, e.g. "max_inner_product,cosine_distance"
+VECTOR_INDEX_MEASURES = os.environ.get("VECTOR_INDEX_MEASURES", "max_inner_product").split(",")
+OPERATOR_CLASSES = {
+    "max_inner_product": "vector_ip_ops",
+    "cosine_distance": "vector_cosine_ops",
+    "l2_distance": "vector_l2_ops",
+}
+
+HNSW_M = int(os.environ.get("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 64))
+
+# ivfflat recall drops as rows are added past what its lists were sized for,
+# so it is rebuilt once the table has grown by this factor
+IVFFLAT_REBUILD_GROWTH = float(os.environ.get("IVFFLAT_REBUILD_GROWTH", 2))
+
+# build or check the indexes in the background when the API starts
+VECTOR_INDEX_ON_STARTUP = os.environ.get("VECTOR_INDEX_ON_STARTUP", "True") == "True"
+
+logger = LogConfig(LOGGER_NAME="VectorIndex").build_logger()
+
+
+def get_index_name(index_type: str, similarity_measure: str) -> str:
+    return f"allminivectorstore_embedding_{index_type}_{OPERATOR_CLASSES[similarity_measure]}_idx"
+
+
+def get_text_search_index_name() -> str:
+    return f"documentmodel_page_content_{TEXT_SEARCH_CONFIG}_tsv_idx"
+
+
+def build_search_settings(ef_search: int | None = None, probes: int | None = None) -> list:
+    """
+    Statements that set the per-query recall / speed trade off for the current
+    transaction only. Run them on the same session right before the kNN query.
+    """
+
+    # set_config instead of SET LOCAL, since SET does not take bind parameters
+    statements = []
+    if ef_search is not None:
+        statements.append(select(func.set_config("hnsw.ef_search", str(ef_search), True)))
+    if probes is not None:
+        statements.append(select(func.set_config("ivfflat.probes", str(probes), True)))
+    return statements
+
+
+def apply_search_settings(db: Session, ef_search: int | None = None, probes: int | None = None) -> None:
+    for statement in build_search_settings(ef_search, probes):
+        db.execute(statement)
+
+
+def ensure_vector_indexes(
+    index_type: str = VECTOR_INDEX_TYPE,
+    similarity_measures: list[str] = VECTOR_INDEX_MEASURES,
+    rebuild: bool = False,
+) -> list[str]:
+    """
+    Create the ANN indexes on the AllMiniVectorStore embeddings if they are missing,
+    replace any left invalid by an interrupted build, and rebuild ivfflat indexes the
+    table has outgrown. Indexes are built concurrently so ingest and queries keep running.
+    Returns the names of the indexes that were built.
+    """
+
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(f"Invalid index type {index_type}. Supported types: {VECTOR_INDEX_TYPES}")
+
+    built = []
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if index_type == "hnsw" and not _supports_hnsw(connection):
+            logger.warning("pgvector is older than 0.5.0, using ivfflat instead of hnsw")
+            index_type = "ivfflat"
+
+        row_count = connection.execute(select(func.count()).select_from(AllMiniVectorStore)).scalar()
+
+        for similarity_measure in similarity_measures:
+            index = _build_index(index_type, similarity_measure, row_count)
+            state = _get_index_state(connection, index.name)
+
+            if state is not None and (rebuild or not state["valid"] or _is_outgrown(index_type, state, row_count)):
+                logger.info(f"Dropping {index.name} to rebuild it")
+                index.drop(connection)
+                state = None
+
+            if state is None:
+                start_time = time.perf_counter()
+                index.create(connection)
+                connection.execute(
+                    text(f'COMMENT ON INDEX {_qualified_name(index.name)} IS \'rows={row_count}\'')
+                )
+                logger.info(
+                    f"Built {index.name} over {row_count} rows in {time.perf_counter() - start_time:.1f}s"
+                )
+                built.append(index.name)
+
+        # keep the planner's row estimates current so it picks the index
+        connection.execute(text(f"ANALYZE {_qualified_name(AllMiniVectorStore.__tablename__)}"))
+
+    return built
+
+
+def ensure_text_search_index(rebuild: bool = False) -> list[str]:
+    """
+    Create the GIN full text index on the chunk contents used by hybrid search, on the
+    same expression the text search queries use. Returns the name of the index if built.
+    """
+
+    index = Index(
+        get_text_search_index_name(),
+        build_text_search_vector(),
+        postgresql_using="gin",
+        postgresql_concurrently=True,
+    )
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        state = _get_index_state(connection, index.name)
+        if state is not None and (rebuild or not state["valid"]):
+            logger.info(f"Dropping {index.name} to rebuild it")
+            index.drop(connection)
+            state = None
+
+        if state is not None:
+            return []
+
+        start_time = time.perf_counter()
+        index.create(connection)
+        connection.execute(text(f"ANALYZE {_qualified_name(DocumentModel.__tablename__)}"))
+        logger.info(f"Built {index.name} in {time.perf_counter() - start_time:.1f}s")
+        return [index.name]
+
+
+def ensure_vector_indexes_in_background() -> threading.Thread:
+    """
+    Run ensure_vector_indexes and ensure_text_search_index on a daemon thread,
+    a build over a large table can take minutes.
+    """
+
+    def run():
+        try:
+            ensure_vector_indexes()
+            ensure_text_search_index()
+        except Exception as e:
+            logger.error(f"Vector index maintenance failed: {e}")
+
+    thread = threading.Thread(target=run, name="vector-index", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_vector_index_status() -> list[dict]:
+    statuses = []
+    with engine.connect() as connection:
+        for index_type in VECTOR_INDEX_TYPES:
+            for similarity_measure in OPERATOR_CLASSES:
+                index_name = get_index_name(index_type, similarity_measure)
+                state = _get_index_state(connection, index_name)
+                if state is not None:
+                    statuses.append({"name": index_name, **state})
+
+        state = _get_index_state(connection, get_text_search_index_name())
+        if state is not None:
+            statuses.append({"name": get_text_search_index_name(), **state})
+    return statuses
+
+
+############################ PRIVATE METHODS ############################
+def _build_index(index_type: str, similarity_measure: str, row_count: int) -> Index:
+    if index_type == "hnsw":
+        options = {"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION}
+    else:
+        # pgvector's guidance: rows / 1000 lists up to a million rows, sqrt(rows) past that
+        lists = row_count // 1000 if row_count <= 1_000_000 else int(row_count**0.5)
+        options = {"lists": max(lists, 10)}
+
+    return Index(
+        get_index_name(index_type, similarity_measure),
+        AllMiniVectorStore.embedding,
+        postgresql_using=index_type,
+        postgresql_with=options,
+        postgresql_ops={"embedding": OPERATOR_CLASSES[similarity_measure]},
+        postgresql_concurrently=True,
+    )
+
+
+def _supports_hnsw(connection) -> bool:
+    version = connection.execute(
+        text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    ).scalar()
+    if version is None:
+        return False
+
+    return tuple(int(part) for part in version.split(".")[:2]) >= (0, 5)
+
+
+def _get_index_state(connection, index_name: str) -> dict | None:
+    row = connection.execute(
+        text(
+            "SELECT i.indisvalid, obj_description(c.oid, 'pg_class'), pg_relation_size(c.oid) "
+            "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name"
+        ),
+        {"name": index_name},
+    ).first()
+    if row is None:
+        return None
+
+    valid, comment, size_bytes = row
+    built_rows = None
+    if comment and comment.startswith("rows="):
+        built_rows = int(comment.removeprefix("rows="))
+
+    return {"valid": valid, "built_rows": built_rows, "size_bytes": size_bytes}
+
+
+def _is_outgrown(index_type: str, state: dict, row_count: int) -> bool:
+    # hnsw keeps its recall as rows are inserted
+    if index_type != "ivfflat" or not state["built_rows"]:
+        return False
+
+    return row_count > state["built_rows"] * IVFFLAT_REBUILD_GROWTH
+
+
+def _qualified_name(name: str) -> str:
+    # every aimbase table shares the one schema
+    schema = AllMiniVectorStore.__table__.schema
+    return f'"{schema}"."{name}"' if schema else f'"{name}"'
+
+
+if __name__ == "__main__":
+    # usage: python -m api.vector_index [build|rebuild|status]
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "status":
+        for index_status in get_vector_index_status():
+            print(index_status)
+    else:
+        rebuild = command == "rebuild"
+        print(f"Built: {ensure_vector_indexes(rebuild=rebuild) + ensure_text_search_index(rebuild=rebuild)}")
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import threading
+from uuid import UUID
+from datetime import datetime, timezone
+import numpy as np
+from instarest import LogConfig
+from api.tracing import trace_stage
+
+# "pgvector" runs kNN in the DB, "snapshot" runs it in process on the memory mapped
+# snapshot exported by the ingest job, falling back to pgvector until one exists
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "pgvector")
+SEARCH_BACKENDS = ["pgvector", "snapshot"]
+
+# written by scrape_epubs, see snapshot_exporter.py there for the layout
+VECTOR_SNAPSHOT_DIR = os.environ.get("VECTOR_SNAPSHOT_DIR", "cache/vector_snapshot")
+
+# how often the current symlink is checked for a new snapshot
+VECTOR_SNAPSHOT_CHECK_SECONDS = float(os.environ.get("VECTOR_SNAPSHOT_CHECK_SECONDS", 30))
+
+# rows scored per block, bounds the float32 copy made of the float16 matrix
+VECTOR_SNAPSHOT_BLOCK_ROWS = int(os.environ.get("VECTOR_SNAPSHOT_BLOCK_ROWS", 65536))
+
+# kept in step with scrape_epubs/src/snapshot_exporter.py
+SNAPSHOT_FORMAT = 1
+EMBEDDINGS_FILE = "embeddings.npy"
+NORMS_FILE = "norms.npy"
+DOCUMENT_IDS_FILE = "document_ids.npy"
+SOURCE_INDEX_FILE = "source_index.npy"
+SOURCES_FILE = "sources.json"
+SNAPSHOT_INFO_FILE = "snapshot.json"
+CURRENT_LINK = "current"
+
+logger = LogConfig(LOGGER_NAME="VectorSnapshot").build_logger()
+
+
+class VectorSnapshot:
+    """
+    Read only, memory mapped embedding matrix of one snapshot. The pages are backed by
+    the files, so every worker process mapping the same snapshot shares them.
+
+    **Parameters**
+
+    * `path`: Snapshot directory written by export_vector_snapshot
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, SNAPSHOT_INFO_FILE)) as file:
+            self.info = json.load(file)
+
+        if self.info["format"] != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported snapshot format {self.info['format']} in {path}")
+
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+        self.norms = np.load(os.path.join(path, NORMS_FILE), mmap_mode="r")
+        self.document_ids = np.load(os.path.join(path, DOCUMENT_IDS_FILE), mmap_mode="r")
+        self.source_index = np.load(os.path.join(path, SOURCE_INDEX_FILE), mmap_mode="r")
+
+        with open(os.path.join(path, SOURCES_FILE)) as file:
+            sources = json.load(file)
+
+        # per source arrays, expanded to per row masks through source_index
+        self.source_titles = [(source["title"] or "").lower() for source in sources]
+        self.source_downloaded = np.array(
+            [
+                np.datetime64(source["downloaded_datetime"])
+                if source["downloaded_datetime"]
+                else np.datetime64("NaT")
+                for source in sources
+            ],
+            dtype="datetime64[us]",
+        )
+
+    def __len__(self) -> int:
+        return self.info["rows"]
+
+    def search(
+        self,
+        query_embedding,
+        k: int = 10,
+        titles: list[str] | None = None,
+        downloaded_datetime_start: datetime | None = None,
+        downloaded_datetime_end: datetime | None = None,
+        similarity_measure: str = "max_inner_product",
+    ) -> list[tuple[UUID, float]]:
+        """
+        Exact kNN over the rows whose source passes the title and date filters, with the
+        same filter semantics as the pgvector query. Returns (document id, distance)
+        pairs, nearest first, where distance follows pgvector's operator for the measure.
+        """
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        mask = self._build_row_mask(titles, downloaded_datetime_start, downloaded_datetime_end)
+
+        distances = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), VECTOR_SNAPSHOT_BLOCK_ROWS):
+            end = min(start + VECTOR_SNAPSHOT_BLOCK_ROWS, len(self))
+            dot = self.embeddings[start:end].astype(np.float32) @ query
+            distances[start:end] = _to_distance(
+                dot, self.norms[start:end], np.linalg.norm(query), similarity_measure
+            )
+
+        if mask is not None:
+            distances[~mask] = np.inf
+
+        k = min(k, len(self) if mask is None else int(mask.sum()))
+        if k <= 0:
+            return []
+
+        # partial sort, only the k nearest are ordered
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [
+            (UUID(bytes=self.document_ids[i].tobytes()), float(distances[i]))
+            for i in nearest
+        ]
+
+    ############################ PRIVATE METHODS ############################
+    def _build_row_mask(
+        self,
+        titles: list[str] | None,
+        downloaded_datetime_start: datetime | None,
+        downloaded_datetime_end: datetime | None,
+    ) -> np.ndarray | None:
+        if not titles and not downloaded_datetime_start and not downloaded_datetime_end:
+            return None
+
+        source_mask = np.ones(len(self.source_titles), dtype=bool)
+        if titles:
+            lowered = [title.lower() for title in titles]
+            source_mask &= np.array(
+                [any(title in source_title for title in lowered) for source_title in self.source_titles],
+                dtype=bool,
+            )
+
+        # NaT compares False, like NULL in the SQL filter
+        if downloaded_datetime_start:
+            source_mask &= self.source_downloaded >= _to_datetime64(downloaded_datetime_start)
+        if downloaded_datetime_end:
+            source_mask &= self.source_downloaded <= _to_datetime64(downloaded_datetime_end)
+
+        # rows without a source never pass a source filter
+        source_mask = np.append(source_mask, False)
+        return source_mask[self.source_index]
+
+
+class VectorSnapshotStore:
+    """
+    Holds the current VectorSnapshot and swaps in a new one when the ingest job
+    moves the current symlink. Readers keep the snapshot they were handed, so a swap
+    never changes the matrix under a running search.
+
+    **Parameters**
+
+    * `snapshot_dir`: Directory holding the snapshots and the current symlink
+    * `check_seconds`: Minimum time between checks of the symlink
+    """
+
+    def __init__(self, snapshot_dir: str = VECTOR_SNAPSHOT_DIR, check_seconds: float = VECTOR_SNAPSHOT_CHECK_SECONDS):
+        self.snapshot_dir = snapshot_dir
+        self.check_seconds = check_seconds
+
+        # internal only
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._last_check = 0.0
+        self._on_swap = []
+
+    def add_swap_listener(self, callback) -> None:
+        self._on_swap.append(callback)
+
+    def get(self) -> VectorSnapshot | None:
+        """
+        The current snapshot, or None if none has been exported yet.
+        """
+
+        if time.monotonic() - self._last_check >= self.check_seconds:
+            self._refresh()
+        return self._snapshot
+
+    def status(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            "backend": SEARCH_BACKEND,
+            "version": self._version,
+            "rows": len(snapshot) if snapshot is not None else 0,
+        }
+
+    ############################ PRIVATE METHODS ############################
+    def _refresh(self) -> None:
+        # one thread checks and loads, the others keep using the snapshot they have
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            self._last_check = time.monotonic()
+            link = os.path.join(self.snapshot_dir, CURRENT_LINK)
+            if not os.path.islink(link):
+                return
+
+            version = os.readlink(link)
+            if version == self._version:
+                return
+
+            snapshot = VectorSnapshot(os.path.join(self.snapshot_dir, version))
+
+            # a single reference assignment, searches in flight keep the old mapping
+            self._snapshot, self._version = snapshot, version
+            logger.info(f"Loaded vector snapshot {version} with {len(snapshot)} rows")
+            for callback in self._on_swap:
+                callback()
+        except Exception as e:
+            logger.error(f"Failed to load vector snapshot: {e}")
+        finally:
+            self._lock.release()
+
+
+vector_snapshot_store = VectorSnapshotStore()
+
+
+def search_vector_snapshot(
+    query_embedding,
+    k: int = 10,
+    titles: list[str] | None = None,
+    downloaded_datetime_start: datetime | None = None,
+    downloaded_datetime_end: datetime | None = None,
+    similarity_measure: str = "max_inner_product",
+) -> list[UUID] | None:
+    """
+    Ids of the k nearest documents from the current snapshot, or None if the
+    pgvector backend is selected or no snapshot is available yet.
+    """
+
+    if SEARCH_BACKEND not in SEARCH_BACKENDS:
+        raise ValueError(f"Invalid search backend {SEARCH_BACKEND}. Supported backends: {SEARCH_BACKENDS}")
+
+    if SEARCH_BACKEND != "snapshot":
+        return None
+
+    snapshot = vector_snapshot_store.get()
+    if snapshot is None:
+        return None
+
+    # timed here, so pgvector requests don't report an empty snapshot_search stage
+    with trace_stage("snapshot_search"):
+        neighbors = snapshot.search(
+            query_embedding,
+            k=k,
+            titles=titles,
+            downloaded_datetime_start=downloaded_datetime_start,
+            downloaded_datetime_end=downloaded_datetime_end,
+            similarity_measure=similarity_measure,
+        )
+    return [document_id for document_id, _ in neighbors]
+
+
+############################ PRIVATE METHODS ############################
+def _to_datetime64(value: datetime) -> np.datetime64:
+    # the exported datetimes are naive UTC, as stored in the DB
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+
+def _to_distance(dot: np.ndarray, norms: np.ndarray, query_norm: float, similarity_measure: str) -> np.ndarray:
+    # same values as pgvector's <#>, <=> and <-> operators
+    if similarity_measure == "max_inner_product":
+        return -dot
+    if similarity_measure == "cosine_distance":
+        return 1 - dot / np.maximum(norms * query_norm, np.finfo(np.float32).tiny)
+    if similarity_measure == "l2_distance":
+        return np.sqrt(np.maximum(norms**2 - 2 * dot + query_norm**2, 0))
+
+    raise ValueError(
+        "Invalid similarity measure. Supported measures: 'cosine_distance', 'l2_distance', 'max_inner_product'."
+    )
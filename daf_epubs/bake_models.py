@@ -0,0 +1,48 @@
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+# Run at image build time (see Dockerfile), no DB or minio needed. Set INFERENCE_BACKEND=onnx
+# to also bake the int8 ONNX exports.
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+import time
+from instarest import LogConfig
+from aimbase.services.cross_encoder_inference import CrossEncoderInferenceService
+from aimbase.services.sentence_transformers_inference import (
+    SentenceTransformersInferenceService,
+)
+from api.model_registry import EMBEDDING_MODEL_NAME, CROSS_ENCODER_MODEL_NAME
+from api.onnx_backend import (
+    INFERENCE_BACKEND,
+    get_onnx_dir,
+    export_sentence_transformer,
+    export_cross_encoder,
+)
+
+logger = LogConfig(LOGGER_NAME="BakeModels").build_logger()
+
+
+def bake_models() -> None:
+    """
+    Download the retrieval models into aimbase's local model cache, where the
+    ModelRegistry registers and loads them from on startup instead of downloading.
+    """
+
+    for model_name, service_class, export in [
+        (EMBEDDING_MODEL_NAME, SentenceTransformersInferenceService, export_sentence_transformer),
+        (CROSS_ENCODER_MODEL_NAME, CrossEncoderInferenceService, export_cross_encoder),
+    ]:
+        start_time = time.perf_counter()
+
+        # construct skips the db and crud fields, downloading does not touch them
+        service = service_class.construct(model_name=model_name, logger=logger)
+        service.import_dynamic_dependencies()
+        model = service.download_by_type()
+
+        if INFERENCE_BACKEND == "onnx":
+            export(model, get_onnx_dir(service.get_model_cache_path()))
+
+        logger.info(
+            f"Baked {model_name} into {service.get_model_cache_path()} in {time.perf_counter() - start_time:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    bake_models()
@@ -0,0 +1,124 @@
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+# Uses the same ENVIRONMENT, ENV_VAR_FOLDER and SECRETS settings as main.py,
+# and needs a populated database to query.
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+import time
+import asyncio
+import argparse
+import statistics
+from instarest import get_db
+from aimbase.crud.sentence_transformers_vector import (
+    CRUDSentenceTransformersVectorStore,
+)
+from aimbase.db.vector import AllMiniVectorStore
+from api.model_registry import model_registry
+from api.async_retrieval import aretrieve
+
+SAMPLE_QUERIES = [
+    "What are the fitness assessment requirements?",
+    "Who approves leave for deployed airmen?",
+    "Rules for flying in instrument meteorological conditions",
+    "Space Force satellite operator certification",
+    "How do I file an inspector general complaint?",
+    "Uniform standards for the physical training gear",
+    "Weight and balance requirements for cargo aircraft",
+    "What is the policy on government travel card use?",
+]
+
+
+def blocking_retrieve(query: str, k: int) -> list:
+    """
+    The old path: encode, kNN and rerank all on the calling thread.
+    """
+
+    db = next(get_db())
+    try:
+        query_embedding = model_registry.get_embedding_model().encode(query)
+        retrieved = CRUDSentenceTransformersVectorStore(
+            AllMiniVectorStore
+        ).get_by_source_metadata_and_nearest_neighbors(
+            db, vector_query=query_embedding, k=k, similarity_measure="max_inner_product"
+        )
+        if len(retrieved) == 0:
+            return []
+
+        return model_registry.get_cross_encoder_model().predict(
+            [[query, emb.document.page_content] for emb in retrieved]
+        ).tolist()
+    finally:
+        db.close()
+
+
+async def simulate_user(user_id: int, queries: int, k: int, blocking: bool) -> list[float]:
+    latencies = []
+    for i in range(queries):
+        query = SAMPLE_QUERIES[(user_id + i) % len(SAMPLE_QUERIES)]
+
+        start_time = time.perf_counter()
+        if blocking:
+            blocking_retrieve(query, k)
+        else:
+            await aretrieve(query, k=k)
+        latencies.append(time.perf_counter() - start_time)
+
+        # yield between messages like a real chat session would
+        await asyncio.sleep(0)
+
+    return latencies
+
+
+async def monitor_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """
+    Longest the event loop was stalled past its scheduled wake up, in seconds.
+    """
+
+    max_lag = 0.0
+    while not stop.is_set():
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start_time - interval)
+
+    return max_lag
+
+
+async def run_load_test(users: int, queries: int, k: int, blocking: bool) -> dict:
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_lag(stop))
+
+    start_time = time.perf_counter()
+    results = await asyncio.gather(
+        *[simulate_user(user_id, queries, k, blocking) for user_id in range(users)]
+    )
+    elapsed_seconds = time.perf_counter() - start_time
+
+    stop.set()
+    max_loop_lag = await monitor
+
+    latencies = sorted(latency for user_latencies in results for latency in user_latencies)
+    return {
+        "mode": "blocking" if blocking else "async",
+        "users": users,
+        "requests": len(latencies),
+        "elapsed_seconds": elapsed_seconds,
+        "requests_per_second": len(latencies) / elapsed_seconds,
+        "p50_seconds": statistics.median(latencies),
+        "p95_seconds": latencies[int(0.95 * (len(latencies) - 1))],
+        "max_loop_lag_seconds": max_loop_lag,
+    }
+
+
+if __name__ == "__main__":
+    # usage: python load_test.py --users 50 --queries 5 [--blocking]
+    parser = argparse.ArgumentParser(description="Load test the retrieval path with simultaneous chat users")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=5, help="queries sent by each user")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--blocking", action="store_true", help="run the old blocking path for comparison")
+    args = parser.parse_args()
+
+    # load the models first so they are not part of the measurement
+    model_registry.warm_up()
+
+    report = asyncio.run(run_load_test(args.users, args.queries, args.k, args.blocking))
+    for key, value in report.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
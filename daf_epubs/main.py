@@ -1,39 +1,58 @@
 import os
+import time
+import math
+import asyncio
 
 os.environ["ENVIRONMENT"] = "production"
+import_start_time = time.perf_counter()
+
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAI
-from langchain.chains import LLMMathChain
-from langchain.agents import initialize_agent, Tool, AgentType
 from langchain.tools import BaseTool
 import chainlit as cl
 from chainlit.sync import run_sync
 from typing import TYPE_CHECKING
+from contextlib import nullcontext
 from chainlit.server import app as chainlit_app
 from api.base import auto_app
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 from datetime import datetime
 from instarest import get_db
-
-from aimbase.services.cross_encoder_inference import CrossEncoderInferenceService
-from aimbase.services.sentence_transformers_inference import (
-    SentenceTransformersInferenceService,
+from api.model_registry import model_registry
+from api.async_retrieval import aretrieve
+from api.retrieval_cache import retrieval_cache, build_result_key
+from api.vector_index import (
+    VECTOR_INDEX_ON_STARTUP,
+    apply_search_settings,
+    ensure_vector_indexes_in_background,
+)
+from api.vector_snapshot import SEARCH_BACKEND, vector_snapshot_store
+from api.retrieval_crud import (
+    CRUDRetrievalVectorStore,
+    HYBRID_SEARCH,
+    HYBRID_CANDIDATE_K,
 )
 
-from aimbase.crud.base import CRUDBaseAIModel
-from aimbase.db.base import BaseAIModel
-from aimbase.dependencies import get_minio
-
-from aimbase.crud.sentence_transformers_vector import (
-    CRUDSentenceTransformersVectorStore,
+from api.startup import startup_timings, run_startup_in_background
+from api.answer_cache import ANSWER_CACHE, answer_cache
+from api.admission import (
+    MAX_KNN_K,
+    MAX_CANDIDATE_K,
+    AdmissionRejected,
+    search_admission,
+    chat_admission,
 )
+from api.tracing import trace_request, trace_stage, get_current_trace
+
 from aimbase.crud.vector import CRUDSource
-from aimbase.db.vector import AllMiniVectorStore, SourceModel, DocumentModel
+from aimbase.db.vector import AllMiniVectorStore, SourceModel
 from fastapi.encoders import jsonable_encoder
 
 if TYPE_CHECKING:
     from langchain.agents.agent import AgentExecutor
 
+# in import startup mode this includes the DB init, which is also reported on its own
+startup_timings.record("import", time.perf_counter() - import_start_time)
+
 # loads the GOOGLE_API_KEY env var for local dev
 if not os.environ.get('GOOGLE_API_KEY'):
     try:
@@ -48,6 +67,33 @@ if not os.environ.get('GOOGLE_API_KEY'):
 # if behind a proxy, use the env var DOCS_UI_ROOT_PATH from instarest instead
 chainlit_app.mount("/api", auto_app)
 
+# drop cached retrievals whenever an ingest run commits, stats are reported at /api/cache,
+# along with the cached answers, which are only dropped if the chunks they cited changed
+retrieval_cache.add_invalidation_listener(answer_cache.revalidate)
+retrieval_cache.start_invalidation_listener()
+
+# map the exported embedding snapshot now rather than on the first query, and drop
+# cached retrievals whenever a newer snapshot is swapped in
+if SEARCH_BACKEND == "snapshot":
+    vector_snapshot_store.add_swap_listener(retrieval_cache.invalidate)
+    vector_snapshot_store.get()
+
+
+def warm_up_models():
+    # load the retrieval models once for the whole process, readiness is reported at /api/ready
+    with startup_timings.phase("model_load"):
+        model_registry.warm_up()
+
+
+def maintain_vector_indexes():
+    # build the ANN index on the chunk embeddings if missing, or repair it, without delaying startup
+    if VECTOR_INDEX_ON_STARTUP:
+        ensure_vector_indexes_in_background()
+
+
+# in lazy startup mode the DB is initialized first, on the same thread
+run_startup_in_background(warm_up_models, maintain_vector_indexes)
+
 
 class HumanInputChainlit(BaseTool):
     """Tool that adds the capability to ask user for input."""
@@ -79,6 +125,24 @@ class HumanInputChainlit(BaseTool):
         return res["content"]
 
 
+class KnnInput(BaseModel):
+    query: str
+    k: conint(ge=1, le=MAX_KNN_K) = 10  # number of nearest neighbors to return
+    titles: list[str] | None = None
+    downloaded_datetime_start: datetime | None = None
+    downloaded_datetime_end: datetime | None = None
+    similarity_measure: str = "max_inner_product"
+    ef_search: int | None = None  # hnsw candidate list size, higher is better recall but slower
+    probes: int | None = None  # ivfflat lists scanned, higher is better recall but slower
+    hybrid: bool = HYBRID_SEARCH  # fuse a full text search into the kNN results before the rerank
+    candidate_k: conint(ge=1, le=MAX_CANDIDATE_K) = HYBRID_CANDIDATE_K  # taken from each search before fusion down to k
+
+
+class RankedNeighbor(BaseModel):
+    document: object
+    score: float
+
+
 class EpubsRetrievalChainlit(BaseTool):
     """Tool that adds the capability search DAF Epubs."""
 
@@ -112,7 +176,8 @@ class EpubsRetrievalChainlit(BaseTool):
                 + statement
             )
 
-        ranked_neighbors = self.retrieve(query)
+        with trace_retrieval():
+            ranked_neighbors = self.retrieve(query)
         cl.user_session.set("ranked_neighbors", ranked_neighbors)
         return jsonable_encoder(
             [item.document.page_content + "\n" for item in ranked_neighbors]
@@ -140,96 +205,149 @@ class EpubsRetrievalChainlit(BaseTool):
                 + statement
             )
 
-        ranked_neighbors = self.retrieve(query)
+        with trace_retrieval():
+            ranked_neighbors = await self.aretrieve(query)
         cl.user_session.set("ranked_neighbors", ranked_neighbors)
         return jsonable_encoder(
             [item.document.page_content + "\n" for item in ranked_neighbors]
         )
 
-    def retrieve(self, query: str):
-        class KnnInput(BaseModel):
-            query: str
-            k: int = 10  # number of nearest neighbors to return
-            titles: list[str] | None = None
-            downloaded_datetime_start: datetime | None = None
-            downloaded_datetime_end: datetime | None = None
-            similarity_measure: str = "max_inner_product"
-
-        class RankedNeighbor(BaseModel):
-            document: object
-            score: float
+    async def aretrieve(self, query: str):
+        """
+        Same as retrieve, but the DB query is async and the models run on their
+        batching threads, so other chat sessions are not stalled meanwhile.
+        """
 
         request: KnnInput = KnnInput(query=query)
 
-        # kNN SEARCH and rerank
-        db = next(get_db())
+        # shares the search slots with the API, the chat message was already rate limited
+        with trace_stage("admission_wait"):
+            await search_admission.acquire()
         try:
-            embedding_service = SentenceTransformersInferenceService(
-                model_name="all-MiniLM-L6-v2",
-                db=db,
-                crud=CRUDBaseAIModel(BaseAIModel),
-                s3=get_minio(),
-                prioritize_internet_download=False,
+            reranked_documents = await aretrieve(
+                request.query,
+                k=request.k,
+                titles=request.titles,
+                downloaded_datetime_start=request.downloaded_datetime_start,
+                downloaded_datetime_end=request.downloaded_datetime_end,
+                similarity_measure=request.similarity_measure,
+                ef_search=request.ef_search,
+                probes=request.probes,
+                hybrid=request.hybrid,
+                candidate_k=request.candidate_k,
             )
+        finally:
+            search_admission.release()
+        return [
+            RankedNeighbor(document=document, score=score)
+            for document, score in reranked_documents
+        ]
 
-            embedding_service.initialize()
+    def retrieve(self, query: str):
+        request: KnnInput = KnnInput(query=query)
+        result_key = build_result_key(
+            request.query,
+            request.k,
+            request.titles,
+            request.downloaded_datetime_start,
+            request.downloaded_datetime_end,
+            request.similarity_measure,
+            request.ef_search,
+            request.probes,
+            request.hybrid,
+            request.candidate_k,
+        )
 
-            cross_encoder_service = CrossEncoderInferenceService(
-                model_name="cross-encoder/ms-marco-TinyBERT-L-6",
-                db=db,
-                crud=CRUDBaseAIModel(BaseAIModel),
-                s3=get_minio(),
-                prioritize_internet_download=False,
-            )
+        # kNN SEARCH and rerank
+        crud_base = CRUDRetrievalVectorStore(AllMiniVectorStore)
+        db = next(get_db())
+        try:
+            # a repeated question only needs its documents loaded
+            ranked_ids = retrieval_cache.get_results(result_key)
+            if ranked_ids is not None:
+                documents = crud_base.get_documents_by_ids(
+                    db, [document_id for document_id, _ in ranked_ids]
+                )
+                return [
+                    RankedNeighbor(document=documents[document_id], score=score)
+                    for document_id, score in ranked_ids
+                    if document_id in documents
+                ]
 
-            cross_encoder_service.initialize()
+            # models are shared across sessions and only loaded once per process
+            with trace_stage("model_init"):
+                embedding_model = model_registry.get_embedding_model()
+                cross_encoder_model = model_registry.get_cross_encoder_model()
 
             # Calculate embedding for the query
-            query_embedding = embedding_service.model.encode(request.query)
-
-            crud_base = CRUDSentenceTransformersVectorStore(AllMiniVectorStore)
-            # Perform kNN search
-            retrieved_embeddings_db = (
-                crud_base.get_by_source_metadata_and_nearest_neighbors(
-                    db,
-                    titles=request.titles,
-                    downloaded_datetime_start=request.downloaded_datetime_start,
-                    downloaded_datetime_end=request.downloaded_datetime_end,
-                    vector_query=query_embedding,
-                    k=request.k,
-                    similarity_measure=request.similarity_measure,
+            query_embedding = retrieval_cache.get_embedding(request.query)
+            if query_embedding is None:
+                with trace_stage("encode"):
+                    query_embedding = embedding_model.encode(request.query)
+                retrieval_cache.put_embedding(request.query, query_embedding)
+
+            apply_search_settings(db, ef_search=request.ef_search, probes=request.probes)
+            # Perform kNN search, documents and sources come back in the same query
+            source_filters = {
+                "titles": request.titles,
+                "downloaded_datetime_start": request.downloaded_datetime_start,
+                "downloaded_datetime_end": request.downloaded_datetime_end,
+            }
+            if request.hybrid:
+                # exact terms like publication numbers are found by the text search,
+                # so a small k still reaches the right chunks for the rerank
+                retrieved_documents = (
+                    crud_base.get_documents_by_source_metadata_and_hybrid_search(
+                        db,
+                        vector_query=query_embedding,
+                        text_query=request.query,
+                        k=request.k,
+                        candidate_k=request.candidate_k,
+                        similarity_measure=request.similarity_measure,
+                        **source_filters,
+                    )
+                )
+            else:
+                retrieved_documents = (
+                    crud_base.get_documents_by_source_metadata_and_nearest_neighbors(
+                        db,
+                        vector_query=query_embedding,
+                        k=request.k,
+                        similarity_measure=request.similarity_measure,
+                        **source_filters,
+                    )
                 )
-            )
 
             # Step 1: If no documents are retrieved, return empty list
-            if len(retrieved_embeddings_db) == 0:
+            if len(retrieved_documents) == 0:
+                retrieval_cache.put_results(result_key, [])
                 return []
 
             # Step 2: Score the documents via cross encoder
             cross_encoder_inputs = [
-                [request.query, emb.document.page_content]
-                for emb in retrieved_embeddings_db
+                [request.query, document.page_content]
+                for document in retrieved_documents
             ]
 
-            scores = cross_encoder_service.model.predict(
-                cross_encoder_inputs
-            ).tolist()  # need to convert numpy objs to list to be json serializable
+            with trace_stage("rerank"):
+                scores = cross_encoder_model.predict(
+                    cross_encoder_inputs
+                ).tolist()  # need to convert numpy objs to list to be json serializable
 
             # Step 3: Sort the scores in decreasing order
             unsorted_neighbors = []
-            for emb, score in zip(retrieved_embeddings_db, scores):
-
-                # access the source to force loading data via sqlalchemy
-                _ = emb.document.source
-
-                # append data to list
+            for document, score in zip(retrieved_documents, scores):
                 unsorted_neighbors.append(
-                    RankedNeighbor(document=emb.document, score=score)
+                    RankedNeighbor(document=document, score=score)
                 )
 
             reranked_neighbors = sorted(
                 unsorted_neighbors, key=lambda item: item.score, reverse=True
             )
+            retrieval_cache.put_results(
+                result_key,
+                [(item.document.id, item.score) for item in reranked_neighbors],
+            )
             return reranked_neighbors
         except Exception as e:
             raise e
@@ -237,7 +355,21 @@ class EpubsRetrievalChainlit(BaseTool):
             db.close()
 
 
+def trace_retrieval():
+    # the tool's stages go into the chat's trace, or their own when it is used outside a chat
+    if get_current_trace() is None:
+        return trace_request("retrieval_tool")
+    return nullcontext()
+
+
 def build_agent():
+    # imported on first chat rather than at startup, they pull in the whole google genai stack
+    from langchain_google_genai import GoogleGenerativeAI
+    from langchain.agents import initialize_agent, AgentType
+
+    # from langchain_google_genai import ChatGoogleGenerativeAI
+    # from langchain.chains import LLMMathChain
+    # from langchain.agents import Tool
     # math_llm = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0)
     agent_llm = GoogleGenerativeAI(model="gemini-pro", temperature=0)
     # llm_math_chain = LLMMathChain.from_llm(llm=math_llm, verbose=True)
@@ -264,15 +396,21 @@ def start():
     cl.user_session.set("agent", build_agent())
 
 
-@cl.on_message
-async def main(message: cl.Message):
-    agent = cl.user_session.get("agent")  # type: AgentExecutor
-    answer = await agent.arun(
-        message.content, callbacks=[cl.AsyncLangchainCallbackHandler()]
-    )
+async def embed_question(question: str):
+    # shares the query embedding tier with the retrieval tool
+    embedding = retrieval_cache.get_embedding(question)
+    if embedding is None:
+        with trace_stage("encode"):
+            embeddings = await asyncio.wrap_future(
+                model_registry.get_embedding_model().encode_future([question])
+            )
+        embedding = embeddings[0]
+        retrieval_cache.put_embedding(question, embedding)
+    return embedding
+
 
+async def send_answer(answer: str, ranked_neighbors):
     text_elements = []  # type: List[cl.Text]
-    ranked_neighbors = cl.user_session.get("ranked_neighbors")
     if ranked_neighbors:
 
         # class SourceModel(DeclarativeBase):
@@ -310,9 +448,56 @@ async def main(message: cl.Message):
     await cl.Message(content=answer, elements=text_elements).send()
 
 
+@cl.on_message
+async def main(message: cl.Message):
+    # stage timings are exported at /api/metrics, slow chats are logged with them
+    with trace_request("chat"):
+        # shed load with a short reply rather than queue agent runs without bound
+        try:
+            chat_admission.check_rate(cl.user_session.get("id"))
+            await answer_message(message)
+        except AdmissionRejected as e:
+            await cl.Message(
+                content=f"The service is busy ({e.reason.lower()}), please try again in {math.ceil(e.retry_after)} seconds."
+            ).send()
+
+
+async def answer_message(message: cl.Message):
+    # a near duplicate of an answered question gets the same answer and sources without the agent
+    question_embedding = None
+    if ANSWER_CACHE:
+        question_embedding = await embed_question(message.content)
+        cached_answer = answer_cache.get(question_embedding)
+        if cached_answer is not None:
+            with trace_stage("send_answer"):
+                await send_answer(cached_answer.answer, cached_answer.ranked_neighbors)
+            return
+
+    agent = cl.user_session.get("agent")  # type: AgentExecutor
+
+    # only the sources retrieved for this question, not ones left over from the last
+    cl.user_session.set("ranked_neighbors", None)
+    with trace_stage("admission_wait"):
+        await chat_admission.acquire()
+    try:
+        # the gemini round trips, with the retrieval tool's stages nested inside
+        with trace_stage("agent"):
+            answer = await agent.arun(
+                message.content, callbacks=[cl.AsyncLangchainCallbackHandler()]
+            )
+    finally:
+        chat_admission.release()
+    ranked_neighbors = cl.user_session.get("ranked_neighbors")
+
+    if ANSWER_CACHE:
+        answer_cache.put(question_embedding, message.content, answer, ranked_neighbors)
+
+    with trace_stage("send_answer"):
+        await send_answer(answer, ranked_neighbors)
+
+
 # use chainlit and langchain for this with the underlying tool to pull from daf-epubs
 # attach prefix_api to the chainlit fastapi app and adjust dockerfile
 # add "secrets-extra.env" to readme
 # add page numbers and prompt to build source links with page numbers
-# limit knn k value and overall rate limit
 # ploty cluster explorer?
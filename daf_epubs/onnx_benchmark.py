@@ -0,0 +1,174 @@
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+# Uses the same ENVIRONMENT, ENV_VAR_FOLDER and SECRETS settings as main.py,
+# and needs a populated database for the passages.
+## ************ ENV VAR INIT BEFORE IMPORTS ************ ##
+import os
+import time
+import resource
+import argparse
+import numpy as np
+from instarest import get_db
+from aimbase.crud.base import CRUDBaseAIModel
+from aimbase.db.base import BaseAIModel
+from aimbase.db.vector import DocumentModel
+from aimbase.dependencies import get_minio
+from aimbase.services.cross_encoder_inference import CrossEncoderInferenceService
+from aimbase.services.sentence_transformers_inference import (
+    SentenceTransformersInferenceService,
+)
+from api.model_registry import EMBEDDING_MODEL_NAME, CROSS_ENCODER_MODEL_NAME
+from api.onnx_backend import load_onnx_model
+from load_test import SAMPLE_QUERIES
+
+# int8 quantization moves the outputs a little, more than this means the export is broken
+MIN_EMBEDDING_COSINE = float(os.environ.get("ONNX_MIN_EMBEDDING_COSINE", 0.98))
+MIN_KNN_OVERLAP = float(os.environ.get("ONNX_MIN_KNN_OVERLAP", 0.9))
+MIN_RERANK_SPEARMAN = float(os.environ.get("ONNX_MIN_RERANK_SPEARMAN", 0.9))
+
+
+def load_models(db, backend: str) -> tuple:
+    """
+    (embedding model, cross encoder) for backend, built the same way as ModelRegistry.
+    """
+
+    models = []
+    for model_name, service_class in [
+        (EMBEDDING_MODEL_NAME, SentenceTransformersInferenceService),
+        (CROSS_ENCODER_MODEL_NAME, CrossEncoderInferenceService),
+    ]:
+        service = service_class(
+            model_name=model_name,
+            db=db,
+            crud=CRUDBaseAIModel(BaseAIModel),
+            s3=get_minio(),
+            prioritize_internet_download=False,
+        )
+        if backend == "onnx":
+            models.append(load_onnx_model(service))
+        else:
+            service.initialize()
+            models.append(service.model)
+
+    return tuple(models)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def spearman(a: np.ndarray, b: np.ndarray) -> float:
+    if len(a) < 2:
+        return 1.0
+
+    rank_a = np.argsort(np.argsort(a))
+    rank_b = np.argsort(np.argsort(b))
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+def time_calls(func, inputs: list, repeat: int) -> list[float]:
+    latencies = []
+    for _ in range(repeat):
+        for value in inputs:
+            start_time = time.perf_counter()
+            func(value)
+            latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def percentiles(latencies: list[float]) -> str:
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(0.95 * (len(latencies) - 1))] * 1000
+    return f"p50 {p50:.1f}ms, p95 {p95:.1f}ms"
+
+
+def check_parity(cosines: np.ndarray, overlaps: list[float], correlations: list[float]) -> None:
+    """
+    Fail the run if the onnx backend drifts too far from the torch models.
+    """
+
+    assert cosines.min() >= MIN_EMBEDDING_COSINE, (
+        f"Embedding cosine {cosines.min():.4f} below {MIN_EMBEDDING_COSINE}"
+    )
+    assert np.mean(overlaps) >= MIN_KNN_OVERLAP, (
+        f"kNN overlap {np.mean(overlaps):.3f} below {MIN_KNN_OVERLAP}"
+    )
+    assert np.mean(correlations) >= MIN_RERANK_SPEARMAN, (
+        f"Rerank Spearman {np.mean(correlations):.3f} below {MIN_RERANK_SPEARMAN}"
+    )
+
+
+def run_benchmark(passages: list[str], queries: list[str], k: int, repeat: int) -> None:
+    k = min(k, len(passages))
+
+    db = next(get_db())
+    try:
+        # onnx first, so the peak RSS after it is not inflated by the torch models
+        rss_before = peak_rss_mb()
+        onnx_embedder, onnx_cross_encoder = load_models(db, "onnx")
+        rss_onnx = peak_rss_mb()
+        torch_embedder, torch_cross_encoder = load_models(db, "torch")
+        rss_torch = peak_rss_mb()
+    finally:
+        db.close()
+
+    print(f"Passages: {len(passages)}, queries: {len(queries)}, k: {k}")
+    print(f"Peak RSS: +{rss_onnx - rss_before:.0f}MB after onnx, +{rss_torch - rss_onnx:.0f}MB after torch")
+
+    # embedding parity, both normalized so the dot product is the cosine similarity
+    torch_passages = torch_embedder.encode(passages, batch_size=64)
+    onnx_passages = onnx_embedder.encode(passages, batch_size=64)
+    cosines = np.sum(torch_passages * onnx_passages, axis=1)
+    print(f"Embedding cosine torch vs onnx: mean {cosines.mean():.4f}, min {cosines.min():.4f}")
+
+    # retrieval and rerank parity, with the torch results as the reference
+    overlaps, correlations, top1_agreements = [], [], []
+    for query in queries:
+        torch_top_k = np.argsort(-(torch_passages @ torch_embedder.encode(query)))[:k]
+        onnx_top_k = np.argsort(-(onnx_passages @ onnx_embedder.encode(query)))[:k]
+        overlaps.append(len(set(torch_top_k) & set(onnx_top_k)) / k)
+
+        pairs = [[query, passages[i]] for i in torch_top_k]
+        torch_scores = np.asarray(torch_cross_encoder.predict(pairs))
+        onnx_scores = np.asarray(onnx_cross_encoder.predict(pairs))
+        correlations.append(spearman(torch_scores, onnx_scores))
+        top1_agreements.append(np.argmax(torch_scores) == np.argmax(onnx_scores))
+
+    print(f"kNN overlap@{k}: {np.mean(overlaps):.3f}")
+    print(f"Rerank Spearman: {np.mean(correlations):.3f}, top-1 agreement: {np.mean(top1_agreements):.3f}")
+
+    check_parity(cosines, overlaps, correlations)
+
+    # latency at batch size 1 for the query, and k pairs for the rerank
+    rerank_inputs = [[[query, passage] for passage in passages[:k]] for query in queries]
+    for backend, embedder, cross_encoder in [
+        ("torch", torch_embedder, torch_cross_encoder),
+        ("onnx", onnx_embedder, onnx_cross_encoder),
+    ]:
+        embedder.encode(queries[0])
+        cross_encoder.predict(rerank_inputs[0])
+        print(
+            f"{backend}: encode {percentiles(time_calls(embedder.encode, queries, repeat))}, "
+            f"rerank {percentiles(time_calls(cross_encoder.predict, rerank_inputs, repeat))}"
+        )
+
+
+if __name__ == "__main__":
+    # usage: python onnx_benchmark.py --passages 1000 --k 10
+    parser = argparse.ArgumentParser(description="Compare the onnx backend against the torch models")
+    parser.add_argument("--passages", type=int, default=1000, help="chunks sampled from the DB")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db = next(get_db())
+    try:
+        passages = [
+            row.page_content
+            for row in db.query(DocumentModel.page_content).limit(args.passages).all()
+        ]
+    finally:
+        db.close()
+
+    run_benchmark(passages, SAMPLE_QUERIES, args.k, args.repeat)
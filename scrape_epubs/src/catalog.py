@@ -0,0 +1,105 @@
+import os
+import re
+import json
+import requests
+from datetime import datetime
+from bs4 import BeautifulSoup
+
+CATALOG_BASE_URL = os.environ.get("CATALOG_BASE_URL", "https://www.e-publishing.af.mil")
+CATALOG_PATH = "/DesktopModules/MVC/EPUBS/EPUB/GetPubsBySeriesView/"
+
+# module and tab the ePubs site sends with its own request for the catalog
+CATALOG_HEADERS = {"ModuleId": "449", "TabId": "131"}
+CATALOG_PARAMS = {"orgID": 10141, "catID": 1, "series": -1}
+
+TIMEOUT_SECONDS = 60
+
+# .NET JSON dates look like "/Date(1543503803850)/" once the JSON is decoded
+_DOTNET_DATE_RE = re.compile(r"^/Date\((-?\d+)\)/$")
+
+# the catalog may come back embedded in a script as `publications: [...]` instead of as bare JSON
+_PUBLICATIONS_RE = re.compile(r"publications\s*:\s*(?=\[)")
+
+
+def convert_dotnet_dates(json_object: dict) -> dict:
+    """
+    json object_hook that converts /Date(...)/ values to ISO 8601 strings.
+    """
+
+    for key, value in json_object.items():
+        if isinstance(value, str):
+            match = _DOTNET_DATE_RE.match(value)
+            if match:
+                # Extract the timestamp (in milliseconds) and convert to seconds
+                timestamp = int(match.group(1)) / 1000.0
+                json_object[key] = datetime.utcfromtimestamp(timestamp).isoformat() + "Z"
+    return json_object
+
+
+def parse_catalog_response(text: str) -> list[dict]:
+    """
+    Parse the GetPubsBySeriesView response into the list of publications.
+    """
+
+    decoder = json.JSONDecoder(object_hook=convert_dotnet_dates)
+    try:
+        data = decoder.decode(text)
+    except json.JSONDecodeError:
+        match = _PUBLICATIONS_RE.search(text)
+        if match is None:
+            raise ValueError("No publications found in catalog response")
+
+        # decode just the array, starting at its opening bracket
+        data, _ = decoder.raw_decode(text, match.end())
+
+    if isinstance(data, dict):
+        data = data["publications"]
+
+    return data
+
+
+class CatalogClient:
+    """
+    Plain HTTP client for the ePubs publication catalog.
+
+    **Parameters**
+
+    * `base_url`: Root of the ePubs site. Point it at a local stub server to test.
+    * `session`: Optional requests session, one is created if not given
+    """
+
+    def __init__(self, base_url: str = CATALOG_BASE_URL, session: requests.Session | None = None):
+        self.base_url = base_url.rstrip("/")
+        self.session = session or requests.Session()
+
+    def get_verification_token(self) -> str:
+        """
+        Load the home page for the anti-forgery token. The matching cookie stays on the session.
+        """
+
+        response = self.session.get(self.base_url, timeout=TIMEOUT_SECONDS)
+        response.raise_for_status()
+
+        token_input = BeautifulSoup(response.text, "html.parser").find(
+            "input", attrs={"name": "__RequestVerificationToken"}
+        )
+        if token_input is None or not token_input.get("value"):
+            raise ValueError("No __RequestVerificationToken found on the ePubs home page")
+
+        return token_input["value"]
+
+    def fetch_publications(self) -> list[dict]:
+        token = self.get_verification_token()
+
+        response = self.session.get(
+            f"{self.base_url}{CATALOG_PATH}",
+            headers={**CATALOG_HEADERS, "RequestVerificationToken": token},
+            params=CATALOG_PARAMS,
+            timeout=TIMEOUT_SECONDS,
+        )
+        response.raise_for_status()
+
+        return parse_catalog_response(response.text)
+
+    def close(self) -> None:
+        self.session.close()
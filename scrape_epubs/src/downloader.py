@@ -0,0 +1,158 @@
+import os
+import time
+import hashlib
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from pdf_cache import PdfCache
+from telemetry import IngestTelemetry
+
+# Number of PDFs downloaded at once, also the size of the keep-alive connection pool
+MAX_DOWNLOAD_WORKERS = int(os.environ.get("MAX_DOWNLOAD_WORKERS", 4))
+
+# Set the maximum number of retry attempts
+MAX_RETRIES = 5
+
+# Set the timeout for each retry (20 seconds)
+TIMEOUT_SECONDS = 20
+
+# Wait 1s, 2s, 4s, ... between retries
+BACKOFF_SECONDS = 1
+
+# Write the response to disk in 64KB pieces instead of holding the whole PDF in memory
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def build_session(pool_size=MAX_DOWNLOAD_WORKERS):
+    session = requests.Session()
+
+    # every PDF comes from static.e-publishing.af.mil, so one pool of reusable connections is enough
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def download_pdf(session, pdf_url, pdf_cache: PdfCache):
+    """
+    Fetch pdf_url into pdf_cache, retrying with exponential backoff.
+
+    Sends a conditional GET when a copy is cached, so unchanged PDFs come back as 304.
+    Returns (local_pdf_path, changed), or (None, None) if the download failed. The
+    returned path is pinned in the cache until pdf_cache.release() is called.
+    """
+
+    partial_pdf_path = os.path.join(
+        pdf_cache.cache_dir, f"{hashlib.sha256(pdf_url.encode()).hexdigest()}.part"
+    )
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            headers = pdf_cache.get_conditional_headers(pdf_url)
+            with session.get(
+                pdf_url, headers=headers, timeout=TIMEOUT_SECONDS, stream=True
+            ) as response:
+                if response.status_code == 304:
+                    local_pdf_path = pdf_cache.checkout(pdf_url)
+                    if local_pdf_path is not None:
+                        return local_pdf_path, False
+
+                    # evicted since the request went out, the next attempt asks for the full file
+                    print(f"Cached PDF for {pdf_url} was evicted (Attempt {attempt + 1}/{MAX_RETRIES})")
+                elif response.status_code == 200:
+                    content_hash = hashlib.sha256()
+                    with open(partial_pdf_path, "wb") as pdf_file:
+                        for data in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                            content_hash.update(data)
+                            pdf_file.write(data)
+
+                    return pdf_cache.store(
+                        pdf_url,
+                        partial_pdf_path,
+                        content_hash.hexdigest(),
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                    )
+                else:
+                    print(f"Failed to download PDF from {pdf_url} (Attempt {attempt + 1}/{MAX_RETRIES})")
+        except requests.exceptions.RequestException as e:
+            # Handle connection or timeout errors
+            print(f"An error occurred during the request (Attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+
+        if os.path.exists(partial_pdf_path):
+            os.remove(partial_pdf_path)
+
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(BACKOFF_SECONDS * 2**attempt)
+
+    # If all retries fail
+    print(f"Max retries reached. Could not download PDF from {pdf_url}")
+    return None, None
+
+
+def prefetch_pdfs(
+    json_source_list,
+    pdf_cache: PdfCache,
+    max_workers=MAX_DOWNLOAD_WORKERS,
+    telemetry: IngestTelemetry | None = None,
+):
+    """
+    Download the PDFs for json_source_list into pdf_cache on a bounded pool of threads.
+
+    Yields (source_info, local_pdf_path, changed) in the original order, with
+    local_pdf_path set to None if there is nothing to download or the download
+    failed. Downloads run ahead of the consumer, so partitioning and embedding
+    overlap with them. The caller must pdf_cache.release() each yielded path.
+    The time and bytes of each download are recorded in telemetry if given.
+    """
+
+    session = build_session(pool_size=max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def download_source(source_info):
+        pdf_url = source_info.get("DocumentUrl")
+        if not pdf_url:
+            return None, None
+
+        start_time = time.perf_counter()
+        local_pdf_path, changed = download_pdf(session, pdf_url, pdf_cache)
+        if telemetry is not None:
+            # a 304 only revalidates the cached copy, nothing is transferred
+            download_status = "not_modified"
+            if local_pdf_path is None:
+                download_status = "failed"
+            elif changed:
+                download_status = "downloaded"
+
+            telemetry.record(
+                source_info,
+                download_seconds=time.perf_counter() - start_time,
+                download_bytes=os.path.getsize(local_pdf_path) if changed else 0,
+                download_status=download_status,
+            )
+        return local_pdf_path, changed
+
+    sources = iter(json_source_list)
+    pending = deque()
+
+    def submit_next():
+        source_info = next(sources, None)
+        if source_info is not None:
+            pending.append((source_info, executor.submit(download_source, source_info)))
+
+    try:
+        # keep twice as many downloads queued as workers so they never wait on the consumer
+        for _ in range(max_workers * 2):
+            submit_next()
+
+        while pending:
+            source_info, future = pending.popleft()
+            local_pdf_path, changed = future.result()
+            submit_next()
+            yield source_info, local_pdf_path, changed
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        session.close()
+        pdf_cache.save()
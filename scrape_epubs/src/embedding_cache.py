@@ -0,0 +1,88 @@
+import os
+import hashlib
+import sqlite3
+import numpy as np
+
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite"
+)
+
+# sqlite limits the number of bound parameters per statement
+LOOKUP_BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of chunk embeddings, keyed by a hash of the model name and the
+    normalized chunk text, so unchanged chunks of a revised publication are not re-encoded.
+
+    **Parameters**
+
+    * `model_name`: Name of the embedding model, part of every key
+    * `path`: Location of the sqlite file
+    """
+
+    def __init__(self, model_name: str, path: str = EMBEDDING_CACHE_PATH):
+        self.model_name = model_name
+        self.path = path
+
+        # hit and miss counts for this run, reported by report()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)"
+        )
+        self._connection.commit()
+
+    def build_key(self, text: str) -> str:
+        normalized_text = " ".join(text.split())
+        return hashlib.sha256(
+            f"{self.model_name}\0{normalized_text}".encode()
+        ).hexdigest()
+
+    def get_many(self, texts: list[str]) -> list[np.ndarray | None]:
+        """
+        Look up texts, returning their cached embeddings or None for each miss.
+        """
+
+        keys = [self.build_key(text) for text in texts]
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), LOOKUP_BATCH_SIZE):
+            key_batch = unique_keys[i : i + LOOKUP_BATCH_SIZE]
+            rows = self._connection.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(key_batch))})",
+                key_batch,
+            )
+            for key, embedding in rows:
+                found[key] = np.frombuffer(embedding, dtype=np.float32)
+
+        embeddings = [found.get(key) for key in keys]
+        misses = sum(1 for embedding in embeddings if embedding is None)
+        self.misses += misses
+        self.hits += len(embeddings) - misses
+        return embeddings
+
+    def put_many(self, texts: list[str], embeddings) -> None:
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            [
+                (self.build_key(text), np.asarray(embedding, dtype=np.float32).tobytes())
+                for text, embedding in zip(texts, embeddings)
+            ],
+        )
+        self._connection.commit()
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (
+            f"Embedding cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1%} hit rate)"
+        )
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,229 @@
+import os
+import time
+from uuid import uuid4
+from sqlalchemy import insert, delete, select, func
+from sqlalchemy.orm import Session
+from aimbase.db.vector import DocumentModel, AllMiniVectorStore
+from aimbase.services.sentence_transformers_inference import (
+    SentenceTransformersInferenceService,
+)
+from embedding_cache import EmbeddingCache
+
+# Number of chunks encoded per all-MiniLM-L6-v2 forward pass, across publications
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 256))
+
+# Commit staged rows once there are this many of them...
+COMMIT_ROWS = int(os.environ.get("COMMIT_ROWS", 2048))
+
+# ...or once this many seconds have passed since the last commit
+COMMIT_SECONDS = float(os.environ.get("COMMIT_SECONDS", 30))
+
+# the retrieval API listens here to drop its cached results when chunks change
+INGEST_NOTIFY_CHANNEL = os.environ.get("INGEST_NOTIFY_CHANNEL", "epubs_ingest")
+
+
+class EmbeddingBatchSink:
+    """
+    Collects chunks from many publications into fixed size embedding batches
+    and writes the documents and vectors to the DB with bulk inserts.
+
+    **Parameters**
+
+    * `db`: SQLAlchemy session used for the inserts
+    * `embedding_service`: Initialized all-MiniLM-L6-v2 inference service
+    * `batch_size`: Number of chunks per embedding batch
+    * `commit_rows`: Commit once this many chunks are staged
+    * `commit_seconds`: Commit once this many seconds have passed since the last commit
+    * `embedding_cache`: Optional cache checked before encoding, so only new text reaches the model
+    * `on_embedded`: Optional callback given the keys whose chunks were all just embedded
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        embedding_service: SentenceTransformersInferenceService,
+        batch_size: int = EMBED_BATCH_SIZE,
+        commit_rows: int = COMMIT_ROWS,
+        commit_seconds: float = COMMIT_SECONDS,
+        embedding_cache: EmbeddingCache | None = None,
+        on_embedded=None,
+    ):
+        self.db = db
+        self.embedding_service = embedding_service
+        self.batch_size = batch_size
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.embedding_cache = embedding_cache
+        self.on_embedded = on_embedded
+
+        # throughput counters, reported by report()
+        self.embed_count = 0
+        self.embed_seconds = 0.0
+        self.insert_count = 0
+        self.insert_seconds = 0.0
+
+        # internal only
+        self._pending = []  # (key, source_id, text) waiting to be embedded
+        self._remaining = {}  # key -> number of its chunks not yet embedded
+        self._staged_documents = []
+        self._staged_vectors = []
+        self._staged_keys = []  # keys with every chunk embedded and staged
+        self._replace_keys = {}  # key -> source_id whose chunks go once the key's first row is staged
+        self._replace_source_ids = []  # sources whose existing chunks go in the next commit
+        self._last_commit = time.monotonic()
+
+    def add(self, key, source_id, texts: list[str], replace_existing=False) -> list:
+        """
+        Queue the chunks of one publication, identified by key.
+
+        If replace_existing is set, the chunks already saved for source_id are
+        deleted in the same transaction as the first insert of the new ones.
+        Returns the keys whose chunks were all committed by this call.
+        """
+
+        if not texts:
+            return []
+
+        # the delete is only staged with the key's first row, a commit before that would
+        # otherwise leave the publication with no chunks until its new ones land
+        if replace_existing:
+            self._replace_keys[key] = source_id
+
+        self._remaining[key] = self._remaining.get(key, 0) + len(texts)
+        self._pending.extend((key, source_id, text) for text in texts)
+
+        while len(self._pending) >= self.batch_size:
+            batch = self._pending[: self.batch_size]
+            self._pending = self._pending[self.batch_size :]
+            self._embed(batch)
+
+        if (
+            len(self._staged_documents) >= self.commit_rows
+            or time.monotonic() - self._last_commit >= self.commit_seconds
+        ):
+            return self._commit()
+
+        return []
+
+    def flush(self) -> list:
+        """
+        Embed and commit everything still queued.
+        Returns the keys whose chunks were all committed by this call.
+        """
+
+        if self._pending:
+            batch = self._pending
+            self._pending = []
+            self._embed(batch)
+
+        return self._commit()
+
+    def report(self) -> str:
+        embed_rate = self.embed_count / self.embed_seconds if self.embed_seconds else 0
+        insert_rate = (
+            self.insert_count / self.insert_seconds if self.insert_seconds else 0
+        )
+        return (
+            f"Embedded {self.embed_count} chunks at {embed_rate:.1f} chunks/sec, "
+            f"inserted {self.insert_count} chunks at {insert_rate:.1f} chunks/sec"
+        )
+
+    ############################ PRIVATE METHODS ############################
+    def _embed(self, batch):
+        start_time = time.perf_counter()
+        texts = [text for _, _, text in batch]
+
+        if self.embedding_cache is None:
+            embeddings = self.embedding_service.model.encode(
+                texts, batch_size=self.batch_size
+            )
+        else:
+            embeddings = self.embedding_cache.get_many(texts)
+
+            # encode each distinct uncached text once
+            missing_texts = list(
+                dict.fromkeys(
+                    text for text, embedding in zip(texts, embeddings) if embedding is None
+                )
+            )
+            if missing_texts:
+                missing_embeddings = self.embedding_service.model.encode(
+                    missing_texts, batch_size=self.batch_size
+                )
+                self.embedding_cache.put_many(missing_texts, missing_embeddings)
+
+                encoded = dict(zip(missing_texts, missing_embeddings))
+                embeddings = [
+                    encoded[text] if embedding is None else embedding
+                    for text, embedding in zip(texts, embeddings)
+                ]
+
+        self.embed_seconds += time.perf_counter() - start_time
+        self.embed_count += len(batch)
+
+        embedded_keys = []
+        for (key, source_id, text), embedding in zip(batch, embeddings):
+            if key in self._replace_keys:
+                self._replace_source_ids.append(self._replace_keys.pop(key))
+
+            document_id = uuid4()
+            self._staged_documents.append(
+                {"id": document_id, "page_content": text, "source_id": source_id}
+            )
+            self._staged_vectors.append(
+                {"id": uuid4(), "embedding": embedding, "document_id": document_id}
+            )
+
+            self._remaining[key] -= 1
+            if self._remaining[key] == 0:
+                del self._remaining[key]
+                embedded_keys.append(key)
+
+        self._staged_keys.extend(embedded_keys)
+        if self.on_embedded is not None and embedded_keys:
+            self.on_embedded(embedded_keys)
+
+    def _commit(self):
+        self._last_commit = time.monotonic()
+        if not self._staged_documents and not self._replace_source_ids:
+            return []
+
+        start_time = time.perf_counter()
+        try:
+            if self._replace_source_ids:
+                document_ids = select(DocumentModel.id).where(
+                    DocumentModel.source_id.in_(self._replace_source_ids)
+                )
+                self.db.execute(
+                    delete(AllMiniVectorStore)
+                    .where(AllMiniVectorStore.document_id.in_(document_ids))
+                    .execution_options(synchronize_session=False)
+                )
+                self.db.execute(
+                    delete(DocumentModel)
+                    .where(DocumentModel.source_id.in_(self._replace_source_ids))
+                    .execution_options(synchronize_session=False)
+                )
+
+            # executemany inserts are sent as multi-row VALUES statements by SQLAlchemy
+            if self._staged_documents:
+                self.db.execute(insert(DocumentModel), self._staged_documents)
+                self.db.execute(insert(AllMiniVectorStore), self._staged_vectors)
+
+            # delivered only once the transaction commits
+            self.db.execute(
+                select(func.pg_notify(INGEST_NOTIFY_CHANNEL, str(len(self._staged_documents))))
+            )
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            raise e
+        self.insert_seconds += time.perf_counter() - start_time
+        self.insert_count += len(self._staged_documents)
+
+        committed_keys = self._staged_keys
+        self._replace_source_ids = []
+        self._staged_documents = []
+        self._staged_vectors = []
+        self._staged_keys = []
+        return committed_keys
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+from datetime import datetime
+
+JOURNAL_PATH = os.environ.get("INGEST_JOURNAL_PATH", "cache/ingest_journal.sqlite")
+
+# states a publication moves through during a run, in order
+# pending means its source row has been saved but nothing else has happened yet
+STATES = ["pending", "downloaded", "partitioned", "embedded", "committed"]
+
+
+class IngestJournal:
+    """
+    Durable per-publication journal of an ingest run, so a run that dies part
+    way through can be resumed instead of started over.
+
+    **Parameters**
+
+    * `path`: Location of the sqlite file
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        self.path = path
+        self.run_id = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path)
+
+        # WAL keeps each state change durable without a full sync on every commit
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "run_id INTEGER PRIMARY KEY AUTOINCREMENT, started_at TEXT, finished_at TEXT)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS publications ("
+            "run_id INTEGER, pub_id TEXT, state TEXT, error TEXT, updated_at TEXT, "
+            "PRIMARY KEY (run_id, pub_id))"
+        )
+        self._connection.commit()
+
+    def start_run(self) -> bool:
+        """
+        Resume the last unfinished run, or start a new one.
+        Returns True if a run was resumed.
+        """
+
+        row = self._connection.execute(
+            "SELECT run_id FROM runs WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            self.run_id = row[0]
+            return True
+
+        cursor = self._connection.execute(
+            "INSERT INTO runs (started_at) VALUES (?)", (datetime.now().isoformat(),)
+        )
+        self._connection.commit()
+        self.run_id = cursor.lastrowid
+        return False
+
+    def abandon_unfinished_runs(self) -> None:
+        """
+        Close out unfinished runs whose work no longer exists, e.g. after the DB was wiped.
+        """
+
+        self._connection.execute(
+            "UPDATE runs SET finished_at = ? WHERE finished_at IS NULL",
+            (datetime.now().isoformat(),),
+        )
+        self._connection.commit()
+
+    def finish_run(self) -> None:
+        self._connection.execute(
+            "UPDATE runs SET finished_at = ? WHERE run_id = ?",
+            (datetime.now().isoformat(), self.run_id),
+        )
+        self._connection.commit()
+
+    def get_states(self) -> dict[str, str]:
+        """
+        PubID -> state for every publication journaled in the current run.
+        """
+
+        return dict(
+            self._connection.execute(
+                "SELECT pub_id, state FROM publications WHERE run_id = ?",
+                (self.run_id,),
+            )
+        )
+
+    def mark(self, pub_ids: list[str], state: str, error: str | None = None) -> None:
+        if state not in STATES:
+            raise ValueError(f"Invalid journal state {state}. Supported states: {STATES}")
+
+        if not pub_ids:
+            return
+
+        updated_at = datetime.now().isoformat()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO publications (run_id, pub_id, state, error, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(self.run_id, pub_id, state, error, updated_at) for pub_id in pub_ids],
+        )
+        self._connection.commit()
+
+    def mark_error(self, pub_id: str, error: str) -> None:
+        """
+        Record an error against a publication, keeping its last state.
+        """
+
+        self._connection.execute(
+            "UPDATE publications SET error = ?, updated_at = ? WHERE run_id = ? AND pub_id = ?",
+            (error, datetime.now().isoformat(), self.run_id, pub_id),
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,79 @@
+import os
+import json
+from uuid import UUID
+from source_saver import build_source_title, build_source_id
+
+# Local record of what has been ingested for each PubID, used to only
+# re-ingest publications that are new, changed or rescinded
+MANIFEST_PATH = os.environ.get("INGEST_MANIFEST_PATH", "cache/ingest_manifest.json")
+
+# catalog fields that signal a publication has changed since the last ingest
+MANIFEST_FIELDS = ["LastActionDate", "CertDate", "DocumentUrl"]
+
+
+def build_manifest_entry(json_data, source_id=None):
+    entry = {field: json_data.get(field) for field in MANIFEST_FIELDS}
+    entry["title"] = build_source_title(json_data)
+
+    # rows adopted from before ids came from the PubID keep their old id
+    if source_id is not None:
+        entry["source_id"] = str(source_id)
+    return entry
+
+
+def get_manifest_source_id(pub_id, entry):
+    """
+    Source id saved for the publication, or the one derived from its PubID
+    for entries written before the id was recorded.
+    """
+
+    if entry.get("source_id"):
+        return UUID(entry["source_id"])
+    return build_source_id({"PubID": pub_id})
+
+
+def load_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    # write to a temp file and swap it in so a crash never leaves a half written manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def diff_publications(json_source_list, manifest):
+    """
+    Compare the current catalog against the manifest.
+
+    Returns a tuple of (new, changed, rescinded), where new and changed are
+    lists of catalog entries and rescinded is a dict of PubID -> manifest entry
+    for publications that are no longer in the catalog.
+    """
+
+    new, changed = [], []
+    catalog_ids = set()
+
+    for source_info in json_source_list:
+        pub_id = str(source_info.get("PubID"))
+        catalog_ids.add(pub_id)
+
+        previous = manifest.get(pub_id)
+        if previous is None:
+            new.append(source_info)
+        elif any(previous.get(field) != source_info.get(field) for field in MANIFEST_FIELDS):
+            changed.append(source_info)
+
+    rescinded = {
+        pub_id: entry for pub_id, entry in manifest.items() if pub_id not in catalog_ids
+    }
+
+    return new, changed, rescinded
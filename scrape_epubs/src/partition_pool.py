@@ -0,0 +1,158 @@
+import os
+import time
+import queue
+import multiprocessing
+
+# Partitioning is CPU bound, so default to one worker process per core
+MAX_PARTITION_WORKERS = int(
+    os.environ.get("MAX_PARTITION_WORKERS", os.cpu_count() or 1)
+)
+
+# A single PDF that takes longer than this is abandoned and its worker killed
+PARTITION_TIMEOUT_SECONDS = int(os.environ.get("PARTITION_TIMEOUT_SECONDS", 600))
+
+
+class PartitionPool:
+    """
+    Run a partition function over downloaded PDFs on a pool of worker processes.
+
+    **Parameters**
+
+    * `partition_func`: Module level function taking a local PDF path and returning picklable chunk data
+    * `max_workers`: Number of worker processes. Defaults to the number of cores.
+    * `timeout_seconds`: Per-document timeout. Workers running over it are killed and the pool restarted.
+    """
+
+    def __init__(
+        self,
+        partition_func,
+        max_workers=MAX_PARTITION_WORKERS,
+        timeout_seconds=PARTITION_TIMEOUT_SECONDS,
+    ):
+        self.partition_func = partition_func
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+
+        # internal only
+        # spawn instead of fork since the download threads are running when the pool starts
+        self._context = multiprocessing.get_context("spawn")
+        self._pool = None
+        self._generation = 0
+        self._results = queue.Queue()
+        self._next_task_id = 0
+
+    def imap(self, items):
+        """
+        Partition each (item, local_pdf_path) pair from items, pulling them lazily.
+
+        Yields (item, local_pdf_path, chunk_data) as documents finish, so the order
+        may differ from items. chunk_data is None if local_pdf_path is None, the
+        partition function raised, or the document timed out.
+        """
+
+        items = iter(items)
+        in_flight = {}  # task id -> [item, local_pdf_path, deadline]
+        exhausted = False
+
+        self._start_pool()
+        try:
+            while True:
+                # keep every worker busy, which also means each task starts as soon as it is submitted
+                while not exhausted and len(in_flight) < self.max_workers:
+                    entry = next(items, None)
+                    if entry is None:
+                        exhausted = True
+                        break
+
+                    item, local_pdf_path = entry
+                    if local_pdf_path is None:
+                        yield item, None, None
+                        continue
+
+                    self._submit(in_flight, item, local_pdf_path)
+
+                if not in_flight:
+                    break
+
+                next_deadline = min(task[2] for task in in_flight.values())
+                try:
+                    generation, task_id, chunk_data, error = self._results.get(
+                        timeout=max(0, next_deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    for item, local_pdf_path in self._restart_timed_out(in_flight):
+                        yield item, local_pdf_path, None
+                    continue
+
+                # ignore results from a pool that has since been killed
+                if generation != self._generation or task_id not in in_flight:
+                    continue
+
+                item, local_pdf_path, _ = in_flight.pop(task_id)
+                if error is not None:
+                    print(f"An exception occurred partitioning {local_pdf_path}: {error}")
+
+                yield item, local_pdf_path, chunk_data
+        finally:
+            self._stop_pool()
+
+    ############################ PRIVATE METHODS ############################
+    def _start_pool(self):
+        self._generation += 1
+        self._pool = self._context.Pool(processes=self.max_workers)
+
+    def _stop_pool(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _submit(self, in_flight, item, local_pdf_path):
+        task_id = self._next_task_id
+        self._next_task_id += 1
+        generation = self._generation
+
+        self._pool.apply_async(
+            self.partition_func,
+            (local_pdf_path,),
+            callback=lambda chunk_data: self._results.put(
+                (generation, task_id, chunk_data, None)
+            ),
+            error_callback=lambda error: self._results.put(
+                (generation, task_id, None, error)
+            ),
+        )
+        in_flight[task_id] = [
+            item,
+            local_pdf_path,
+            time.monotonic() + self.timeout_seconds,
+        ]
+
+    def _restart_timed_out(self, in_flight):
+        """
+        Kill the pool to free the stuck workers, then resubmit everything that has not timed out.
+        Returns the (item, local_pdf_path) pairs that timed out.
+        """
+
+        now = time.monotonic()
+        timed_out = [
+            task_id for task_id, task in in_flight.items() if task[2] <= now
+        ]
+        timed_out_items = []
+        for task_id in timed_out:
+            item, local_pdf_path, _ = in_flight.pop(task_id)
+            print(
+                f"Partitioning {local_pdf_path} timed out after {self.timeout_seconds} seconds"
+            )
+            timed_out_items.append((item, local_pdf_path))
+
+        # a pool worker cannot be cancelled on its own, so restart the whole pool
+        self._stop_pool()
+        self._start_pool()
+
+        unfinished = list(in_flight.values())
+        in_flight.clear()
+        for item, local_pdf_path, _ in unfinished:
+            self._submit(in_flight, item, local_pdf_path)
+
+        return timed_out_items
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import threading
+from collections import Counter
+
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", "cache/docs")
+
+# Least recently used PDFs are evicted once the cache grows past this size (default 5GB)
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", 5 * 1024**3))
+
+
+class PdfCache:
+    """
+    Persistent content-addressed cache of downloaded PDFs.
+
+    Files are stored once per content hash under objects/, and index.json maps
+    each URL to the hash, size, ETag and Last-Modified of its last download so
+    the next run can send a conditional GET. Safe to use from download threads.
+
+    **Parameters**
+
+    * `cache_dir`: Directory holding index.json and the objects/ folder
+    * `max_bytes`: Size cap, enforced by evicting the least recently used URLs
+    """
+
+    def __init__(self, cache_dir=PDF_CACHE_DIR, max_bytes=PDF_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        # internal only
+        self._lock = threading.Lock()
+        self._pinned = Counter()  # sha256 -> number of callers still using the file
+        self._index = {}  # url -> {sha256, size, etag, last_modified, last_access}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                self._index = json.load(file)
+
+    def get_conditional_headers(self, url) -> dict:
+        """
+        Headers that let the server answer 304 Not Modified if url is unchanged.
+        Empty if there is no usable cached copy.
+        """
+
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is None or not os.path.exists(self._object_path(entry["sha256"])):
+                return {}
+
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            return headers
+
+    def checkout(self, url) -> str | None:
+        """
+        Mark the cached copy of url as used and pin it until release() is called.
+        Returns its local path, or None if it is not cached.
+        """
+
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is None or not os.path.exists(self._object_path(entry["sha256"])):
+                return None
+
+            entry["last_access"] = time.time()
+            self._pinned[entry["sha256"]] += 1
+            return self._object_path(entry["sha256"])
+
+    def store(self, url, partial_path, sha256, etag=None, last_modified=None):
+        """
+        Move a freshly downloaded file into the cache and pin it until release() is called.
+        Returns (local_path, changed), where changed is False if the content hash
+        matches the previous download of url.
+        """
+
+        with self._lock:
+            previous = self._index.get(url)
+            changed = previous is None or previous["sha256"] != sha256
+
+            object_path = self._object_path(sha256)
+            if os.path.exists(object_path):
+                os.remove(partial_path)
+            else:
+                os.replace(partial_path, object_path)
+
+            self._index[url] = {
+                "sha256": sha256,
+                "size": os.path.getsize(object_path),
+                "etag": etag,
+                "last_modified": last_modified,
+                "last_access": time.time(),
+            }
+            self._pinned[sha256] += 1
+
+            self._evict()
+            self._save()
+            return object_path, changed
+
+    def release(self, local_path):
+        """
+        Unpin a path returned by checkout() or store() so it can be evicted again.
+        """
+
+        sha256 = os.path.splitext(os.path.basename(local_path))[0]
+        with self._lock:
+            self._pinned[sha256] -= 1
+            if self._pinned[sha256] <= 0:
+                del self._pinned[sha256]
+
+    def save(self):
+        with self._lock:
+            self._evict()
+            self._save()
+
+    ############################ PRIVATE METHODS ############################
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_dir, f"{sha256}.pdf")
+
+    def _evict(self):
+        # several URLs may point at the same file, so count each file once
+        sizes = {entry["sha256"]: entry["size"] for entry in self._index.values()}
+        total_bytes = sum(sizes.values())
+
+        for url, entry in sorted(
+            self._index.items(), key=lambda item: item[1]["last_access"]
+        ):
+            if total_bytes <= self.max_bytes:
+                break
+
+            sha256 = entry["sha256"]
+            if sha256 in self._pinned:
+                continue
+
+            del self._index[url]
+            if all(other["sha256"] != sha256 for other in self._index.values()):
+                object_path = self._object_path(sha256)
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+                total_bytes -= sizes[sha256]
+
+    def _save(self):
+        # write to a temp file and swap it in so a crash never leaves a half written index
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._index, file)
+        os.replace(tmp_path, self.index_path)
@@ -1,120 +1,112 @@
-import os
-import requests
-import traceback
-from codecs import decode
+import time
 from unstructured.partition.pdf import partition_pdf as unstructured_partition_pdf
-from unstructured.cleaners.core import clean, clean_ordered_bullets, clean_prefix
 from unstructured.documents.elements import Title
 from unstructured.chunking.title import chunk_by_title
-from aimbase.db.vector import SourceModel, DocumentModel, AllMiniVectorStore
-from aimbase.crud.vector import CRUDSource
-from aimbase.crud.sentence_transformers_vector import (
-    CRUDSentenceTransformersVectorStore,
-)
 from aimbase.services.sentence_transformers_inference import (
     SentenceTransformersInferenceService,
 )
 from aimbase.dependencies import get_minio
 from aimbase.crud.base import CRUDBaseAIModel
 from aimbase.db.base import BaseAIModel
-from instarest import get_db, SchemaBase
+from instarest import get_db
+from source_saver import build_source_title
+from text_cleaner import clean_texts
+from downloader import build_session, download_pdf, prefetch_pdfs
+from pdf_cache import PdfCache
+from partition_pool import PartitionPool
+from ingest_sink import EmbeddingBatchSink
+from embedding_cache import EmbeddingCache
+from journal import IngestJournal
+from telemetry import IngestTelemetry
+from onnx_backend import INFERENCE_BACKEND, INFERENCE_BACKENDS, load_onnx_model
 
-# Create a cache/docs directory if it doesn't exist
-os.makedirs("cache/docs", exist_ok=True)
 
 def download_and_partition_pdf(pdf_url):
-    # Define the local path where you want to save the PDF file
-    local_pdf_path = os.path.join("cache/docs", os.path.basename(pdf_url))
-
-    # Set the maximum number of retry attempts
-    max_retries = 5
-
-    # Set the timeout for each retry (20 seconds)
-    timeout_seconds = 20
-
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(pdf_url, timeout=timeout_seconds)
-
-            if response.status_code == 200:
-                with open(local_pdf_path, "wb") as pdf_file:
-                    pdf_file.write(response.content)
-                break  # Break the loop if the request is successful
-            else:
-                print(f"Failed to download PDF from {pdf_url} (Attempt {attempt + 1}/{max_retries})")
-        except requests.exceptions.RequestException as e:
-            # Handle connection or timeout errors
-            print(f"An error occurred during the request (Attempt {attempt + 1}/{max_retries}): {e}")
-
-    # If all retries fail
-    if attempt == max_retries - 1:
-        print(f"Max retries reached. Could not download PDF from {pdf_url}")
-        return []
-
-    chunks = pdf_pipeline(local_pdf_path)
-
-    # Delete the downloaded PDF file when done
-    os.remove(local_pdf_path)
-
-    return chunks
+    pdf_cache = PdfCache()
 
+    with build_session(pool_size=1) as session:
+        local_pdf_path, _ = download_pdf(session, pdf_url, pdf_cache)
 
-def clean_text(text: str) -> str:
-    text = clean(
-        text,
-        extra_whitespace=True,
-        dashes=True,
-        bullets=True,
-        trailing_punctuation=True,
-        lowercase=True,
-    )
+    if local_pdf_path is None:
+        return []
 
     try:
-        if len(text) > 0:
-            text = clean_ordered_bullets(text)
-
-        if len(text) > 0:
-            text = clean_prefix(text, r"afh 10 222(.+)", ignore_case=True)
-
-        if len(text) > 0:
-            text = clean_prefix(text, r"(\d+)", ignore_case=True)
-
-        if len(text) > 0:
-            text = clean(text, extra_whitespace=True)
-    except Exception as e:
-        print("An exception occurred:", e)
-        traceback.print_exc()
-
-    text = text.replace("\x00", "")
+        return pdf_pipeline(local_pdf_path)
+    finally:
+        # the PDF stays in the cache for the next run
+        pdf_cache.release(local_pdf_path)
 
-    return text
 
+def pdf_pipeline(local_pdf_path, timings: dict | None = None):
+    # seconds of each step and the page count go into timings, if given
+    timings = {} if timings is None else timings
+    start_time = time.perf_counter()
 
-def pdf_pipeline(local_pdf_path):
     # Use unstructured.partition.pdf to partition the PDF document
     elements = unstructured_partition_pdf(
         local_pdf_path,
     )
-    for element in elements:
-        element.apply(clean_text)
+    timings["partition_seconds"] = time.perf_counter() - start_time
+    timings["pages"] = max(
+        (element.metadata.page_number or 0 for element in elements), default=0
+    )
+    start_time = time.perf_counter()
+
+    # clean every element in one batch, same output as element.apply(clean_text)
+    for element, text in zip(elements, clean_texts([element.text for element in elements])):
+        element.text = text
 
     elements = [x for x in elements if x.text != ""]
+    timings["clean_seconds"] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
 
     chunks = chunk_by_title(elements)
+    timings["chunk_seconds"] = time.perf_counter() - start_time
 
     return chunks
 
-def save_json_chunk_data_to_db(json_source_list):
+
+def partition_pdf_to_chunk_data(local_pdf_path):
+    """
+    Run pdf_pipeline inside a partition worker process.
+    Only the chunk text and metadata, and the step timings, are sent back to the parent process.
+    """
+
+    timings = {}
+    chunks = [
+        {"text": chunk.text, "metadata": chunk.metadata.to_dict()}
+        for chunk in pdf_pipeline(local_pdf_path, timings)
+    ]
+    return {"chunks": chunks, "timings": timings}
+
+
+def save_json_chunk_data_to_db(
+    json_source_list,
+    source_ids,
+    replace_pub_ids=frozenset(),
+    reuse_pub_ids=frozenset(),
+    journal: IngestJournal | None = None,
+    on_ingested=None,
+    telemetry: IngestTelemetry | None = None,
+):
+    """
+    Download, chunk and embed each publication in json_source_list, saving the
+    chunks under the source ids from source_ids (PubID -> source id).
+
+    Publications whose PubID is in replace_pub_ids may already have chunks in the
+    DB, which are deleted in the same transaction as the new ones are inserted, so
+    a retry never duplicates chunks. Those in reuse_pub_ids have a complete set of
+    chunks and are skipped if their PDF has not changed.
+
+    Progress is recorded in journal if given, and on_ingested is called with each
+    group of publications as they are committed. Per-publication timings, chunk
+    counts and failures are recorded in telemetry if given. Returns the list of
+    publications that were saved successfully.
+    """
+
     # Iterate through the list of dictionaries and process each document
-    crud_source_model = CRUDSource(SourceModel)
-    crud_vector_store = CRUDSentenceTransformersVectorStore(AllMiniVectorStore)
     db = next(get_db())
 
-    document_schemas = SchemaBase(
-        DocumentModel, optional_fields=["source"]
-    )  # defined by sqlalchemy relationship, just need id
-    DocumentCreateSchema = document_schemas.EntityCreate
-
     embedding_service = SentenceTransformersInferenceService(
         model_name="all-MiniLM-L6-v2",
         db=db,
@@ -123,52 +115,147 @@ def save_json_chunk_data_to_db(json_source_list):
         prioritize_internet_download=False,
     )
 
-    embedding_service.initialize()
+    if INFERENCE_BACKEND not in INFERENCE_BACKENDS:
+        raise ValueError(
+            f"Invalid inference backend {INFERENCE_BACKEND}. Supported backends: {INFERENCE_BACKENDS}"
+        )
+
+    if INFERENCE_BACKEND == "onnx":
+        embedding_service.model = load_onnx_model(embedding_service)
+    else:
+        embedding_service.initialize()
+
+    # chunks from many publications are embedded and inserted together, so a
+    # publication only counts as ingested once the sink reports it committed
+    def mark_journal(pub_ids, state):
+        if journal is not None:
+            journal.mark(pub_ids, state)
+
+    def mark_journal_error(pub_id, error):
+        if journal is not None:
+            journal.mark_error(pub_id, error)
+
+    def record(source_info, **metrics):
+        if telemetry is not None:
+            telemetry.record(source_info, **metrics)
+
+    def record_failure(source_info, stage, error):
+        mark_journal_error(str(source_info.get("PubID")), error)
+        if telemetry is not None:
+            telemetry.record_failure(source_info, stage, error)
+
+    # quantized embeddings differ slightly, so they are cached separately
+    embedding_cache = EmbeddingCache(
+        embedding_service.model_name
+        if INFERENCE_BACKEND == "torch"
+        else f"{embedding_service.model_name}-onnx-int8"
+    )
+    sink = EmbeddingBatchSink(
+        db,
+        embedding_service,
+        embedding_cache=embedding_cache,
+        on_embedded=lambda pub_ids: mark_journal(pub_ids, "embedded"),
+    )
+    queued = {}  # PubID -> source_info
+    ingested = []
+
+    def mark_ingested(source_infos):
+        if not source_infos:
+            return
+
+        mark_journal([str(source_info.get("PubID")) for source_info in source_infos], "committed")
+        for source_info in source_infos:
+            record(source_info, status="committed")
+        ingested.extend(source_infos)
+        if on_ingested is not None:
+            on_ingested(source_infos)
+
+    def mark_committed(pub_ids):
+        source_infos = [queued.pop(pub_id) for pub_id in pub_ids]
+        for source_info in source_infos:
+            print(f"{build_source_title(source_info)} completed successfully")
+        mark_ingested(source_infos)
+
+    pdf_cache = PdfCache()
+
+    def pdfs_to_partition():
+        for source_info, local_pdf_path, changed in prefetch_pdfs(
+            json_source_list, pdf_cache, telemetry=telemetry
+        ):
+            pub_id = str(source_info.get("PubID"))
+            if local_pdf_path is None:
+                record_failure(source_info, "download", "download failed")
+                yield source_info, local_pdf_path
+                continue
+
+            # the chunks already in the DB are still current, no need to partition again
+            if not changed and pub_id in reuse_pub_ids:
+                pdf_cache.release(local_pdf_path)
+                print(f"{build_source_title(source_info)} unchanged, skipped")
+                mark_ingested([source_info])
+                record(source_info, status="unchanged")
+                continue
+
+            mark_journal([pub_id], "downloaded")
+            yield source_info, local_pdf_path
 
     try:
-        for source_info in json_source_list:
-            document_url = source_info.get("DocumentUrl")
-            if document_url:
-                chunks = download_and_partition_pdf(document_url)
+        # downloads run ahead on a thread pool and partitioning runs on a process pool,
+        # so this loop only has to embed and save the chunks as each document finishes
+        partition_pool = PartitionPool(partition_pdf_to_chunk_data)
+        for source_info, local_pdf_path, chunk_data in partition_pool.imap(
+            pdfs_to_partition()
+        ):
+            # the PDF stays in the cache for the next run
+            if local_pdf_path is not None:
+                pdf_cache.release(local_pdf_path)
+
+            pub_id = str(source_info.get("PubID"))
+            if local_pdf_path is not None and chunk_data is None:
+                record_failure(source_info, "partition", "partition failed")
+            if chunk_data is None:
+                continue
 
-            if document_url is None or len(chunks) == 0:
+            chunks = chunk_data["chunks"]
+            record(source_info, chunks=len(chunks), **chunk_data["timings"])
+            if not chunks:
+                record(source_info, status="empty")
                 continue
 
-            # get the source id from db
-            title = decode(
-                f"{source_info.get('Number', '')}: {source_info.get('Title', '')}",
-                "unicode_escape",
-            )
+            mark_journal([pub_id], "partitioned")
 
-            source_obj_list = crud_source_model.get_by_source_metadata(
-                db, titles=[title]
-            )
-            if len(source_obj_list) == 1:
-                source_obj_id = source_obj_list[0].id
-            else:
-                print(
-                    f"Warning: {len(source_obj_list)} sources found in DB for {title}"
+            # queue the chunks to embed and save in db / vector store
+            queued[pub_id] = source_info
+            mark_committed(
+                sink.add(
+                    pub_id,
+                    source_ids[pub_id],
+                    [chunk["text"] for chunk in chunks],
+                    replace_existing=pub_id in replace_pub_ids,
                 )
-
-            # prep the chunks to embed and save in db / vector store
-            document_schema_list = [
-                DocumentCreateSchema(page_content=chunk.text, source_id=source_obj_id)
-                for chunk in chunks
-            ]
-
-            # save
-            crud_vector_store.create_and_calculate_multi(
-                db,
-                docs_in_list=document_schema_list,
-                embedding_service=embedding_service,
             )
 
-            print(f"{title} completed successfully")
+        mark_committed(sink.flush())
+        print(sink.report())
+        print(embedding_cache.report())
+
+        if telemetry is not None:
+            telemetry.set_counters(
+                embed_count=sink.embed_count,
+                embed_seconds=sink.embed_seconds,
+                insert_count=sink.insert_count,
+                insert_seconds=sink.insert_seconds,
+                embedding_cache_hits=embedding_cache.hits,
+                embedding_cache_misses=embedding_cache.misses,
+            )
 
     finally:
+        embedding_cache.close()
         db.close()
 
-    # TODO: delete all embeddings and docs by source id (to filter sources by date to see if any updated)
+    return ingested
+
+    # TODO:
         # store log
         # save page numbers and metadata for unstructured object
         # save published date for source and if parsed successfully
@@ -1,127 +1,147 @@
 import os
 os.environ["SECRETS"] = "True"
-import re
-import time
-from selenium import webdriver
 import time
 import json
-from datetime import datetime
-from source_saver import save_json_source_data_to_db
+from source_saver import (
+    upsert_json_source_data_to_db,
+    delete_sources_and_chunks_by_id,
+)
 from pdf_pipeline import save_json_chunk_data_to_db
+from manifest import (
+    load_manifest,
+    save_manifest,
+    diff_publications,
+    build_manifest_entry,
+    get_manifest_source_id,
+)
+from catalog import CatalogClient
+from journal import IngestJournal
+from telemetry import IngestTelemetry
+from snapshot_exporter import VECTOR_SNAPSHOT_DIR, export_vector_snapshot
 from aimbase.initializer import AimbaseInitializer
 from instarest import Initializer, DeclarativeBase
-
-def convert_date(match):
-    # Extract the timestamp (in milliseconds) and convert to seconds
-    timestamp = int(match.group(1)) / 1000.0
-    # Convert to a datetime object and format as ISO 8601
-    return datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+from instarest.core.config import get_environment_settings
 
 def scraper(argv=None):
-    # Initialize WebDriver
-    driver = webdriver.Chrome(
-        service=webdriver.ChromeService(executable_path="/usr/bin/chromedriver")
-    )
-
-    # Open the target webpage
-    driver.get("https://www.e-publishing.af.mil")
+    # plain HTTP request for the catalog, no browser needed
+    client = CatalogClient()
+    try:
+        publications_data = client.fetch_publications()
+    finally:
+        client.close()
 
-    # Wait for the page to load completely
-    time.sleep(5)
+    # write the parsed catalog to a file
+    with open("publications_data.json", "w") as file:
+        json.dump(publications_data, file, indent=4)
 
-    # Redirect console.log to a JavaScript variable
-    driver.execute_script(
-        """
-    window.logged_data = [];
-    console.log = function() {
-        window.logged_data.push(Array.from(arguments));
-    };
-    """
-    )
+    print("Number of pubs found: ", len(publications_data))
+    return publications_data
 
-    # Execute the AJAX call
-    ajax_script = """
-    var rvtoken = $("input[name='__RequestVerificationToken']").val();
-    $.ajax({
-        url: "/DesktopModules/MVC/EPUBS/EPUB/GetPubsBySeriesView/",
-        method: "Get",
-        headers: {
-            "ModuleId": 449,
-            "TabId": 131,
-            "RequestVerificationToken": rvtoken
-        },
-        data: {
-            "orgID": 10141,
-            "catID": 1,
-            "series": -1
-        }
-    })
-    .done(function (data) {
-        console.log(data);
-    });
-    """
-    driver.execute_script(ajax_script)
-
-    # Wait for the AJAX call to complete
-    time.sleep(5)  # Adjust this wait time as necessary
-
-    # Retrieve the logged data
-    logged_data = driver.execute_script("return window.logged_data;")
-    logged_data_str = json.dumps(logged_data)
-
-    # Close the browser
-    driver.quit()
-
-    # match = re.search(r"data: (\{.*?\})", logged_data_str, re.DOTALL)
-    # Extract the 'publications' array from the logged data using regex
-    match = re.search(r"publications: (\[\{.*?\}\])", logged_data_str, re.DOTALL)
-    publications_raw_data = match.group(1) if match else None
-
-    # with open('publications_json.json', 'w') as file:
-    #     file.write(publications_json)
-
-    # Clean up the extracted JSON string
-    # publications_json = publications_json.replace('\\r\\n', '').replace('\\"', '"')
-    publications_raw_data = publications_raw_data.replace('\\"', '"').replace('\\\\/', '/')
-    
-    # Convert date format
-    publications_raw_data = re.sub(r'\\/Date\((\d+)\)\\/', convert_date, publications_raw_data)
-
-    # weird leftover cleanup
-    publications_raw_data = publications_raw_data.replace('\\\\"', '')
-
-    # Parse and write the cleaned JSON to a file
+def run_scraper(incremental=True):
+    # stage timings, per publication metrics and failures, written as a JSON report at the end
+    telemetry = IngestTelemetry()
     try:
-        publications_data = json.loads(publications_raw_data)
-        with open("publications_data.json", "w") as file:
-            json.dump(publications_data, file, indent=4)
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
+        _run_scraper(incremental, telemetry)
+    except Exception as e:
+        telemetry.write_report(error=repr(e))
+        raise e
 
-    print("Number of pubs found: ", len(publications_data))
-    return publications_data
+    telemetry.write_report()
+    print(f"Time required to complete: {time.perf_counter() - telemetry.start_time} seconds")
 
-def run_scraper():
-    # Start measuring time
-    start_time = time.time()
 
-    publications_data = scraper()
+############################ PRIVATE METHODS ############################
+def _run_scraper(incremental, telemetry: IngestTelemetry):
+    with telemetry.stage("catalog_fetch"):
+        publications_data = scraper()
     # with open("./publications_data.json", 'r') as file:
     #     publications_data = json.load(file)
 
-    Initializer(DeclarativeBase).execute(vector_toggle=True)
-    AimbaseInitializer().execute()
-
-    save_json_source_data_to_db(publications_data)
-    save_json_chunk_data_to_db(publications_data)
-
-    # End measuring time
-    end_time = time.time()
-
-    # Calculate the time required to complete
-    elapsed_time = end_time - start_time
+    with telemetry.stage("db_init"):
+        Initializer(DeclarativeBase).execute(vector_toggle=True)
+        AimbaseInitializer().execute()
+
+    # the initializer wipes the DB in local and staging, so nothing from a previous run survives
+    journal = IngestJournal()
+    if not incremental or get_environment_settings().environment in ["local", "staging"]:
+        manifest = {}
+        journal.abandon_unfinished_runs()
+    else:
+        manifest = load_manifest()
+
+    # pick up where an interrupted run left off
+    if journal.start_run():
+        print(f"Resuming ingest run {journal.run_id}")
+    telemetry.run_id = journal.run_id
+    states = journal.get_states()
+
+    new, changed, rescinded = diff_publications(publications_data, manifest)
+    print(f"New: {len(new)}, changed: {len(changed)}, rescinded: {len(rescinded)}")
+
+    # drop the sources and chunks of anything no longer in the catalog, by id since
+    # a title can be shared by several publications or change between runs
+    with telemetry.stage("rescind"):
+        delete_sources_and_chunks_by_id(
+            [get_manifest_source_id(pub_id, entry) for pub_id, entry in rescinded.items()]
+        )
+    for pub_id in rescinded:
+        manifest.pop(pub_id)
+
+    # publications committed before the interruption only need their manifest entry
+    for source_info in new + changed:
+        if states.get(str(source_info.get("PubID"))) == "committed":
+            manifest[str(source_info.get("PubID"))] = build_manifest_entry(source_info)
+    new = [x for x in new if states.get(str(x.get("PubID"))) != "committed"]
+    changed = [x for x in changed if states.get(str(x.get("PubID"))) != "committed"]
+
+    # sources are upserted on their PubID, so rerunning after an interruption
+    # never duplicates them. changed publications keep their source rows, and
+    # their chunks are only replaced if the PDF itself changed
+    with telemetry.stage("source_upsert"):
+        source_ids = upsert_json_source_data_to_db(
+            new + changed,
+            previous_titles={
+                str(source_info.get("PubID")): manifest[str(source_info.get("PubID"))]["title"]
+                for source_info in changed
+            },
+        )
+    journal.mark(
+        [str(x.get("PubID")) for x in new + changed if str(x.get("PubID")) not in states],
+        "pending",
+    )
 
-    print(f"Time required to complete: {elapsed_time} seconds")
+    # save the manifest as each batch commits, so a crash loses at most one batch
+    def on_ingested(source_infos):
+        for source_info in source_infos:
+            pub_id = str(source_info.get("PubID"))
+            manifest[pub_id] = build_manifest_entry(source_info, source_ids.get(pub_id))
+        save_manifest(manifest)
+
+    # anything journaled may have partial chunks from the interrupted run, so it is
+    # always replaced rather than skipped. publications that fail to download keep
+    # their old manifest entry so they are retried next run
+    changed_pub_ids = {str(source_info.get("PubID")) for source_info in changed}
+    try:
+        # downloads, partitioning, embedding and inserts overlap, so they share one stage
+        with telemetry.stage("ingest"):
+            save_json_chunk_data_to_db(
+                new + changed,
+                source_ids,
+                replace_pub_ids=changed_pub_ids | set(states),
+                reuse_pub_ids=changed_pub_ids - set(states),
+                journal=journal,
+                on_ingested=on_ingested,
+                telemetry=telemetry,
+            )
+        save_manifest(manifest)
+        journal.finish_run()
+
+        # the retrieval API picks up the new snapshot on its next check
+        if VECTOR_SNAPSHOT_DIR:
+            with telemetry.stage("snapshot_export"):
+                export_vector_snapshot()
+    finally:
+        journal.close()
 
 if __name__ == "__main__":
     run_scraper()
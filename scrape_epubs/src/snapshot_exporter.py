@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+from datetime import datetime, timezone
+from sqlalchemy import select, func
+from instarest.db.session import engine
+from aimbase.db.vector import AllMiniVectorStore, DocumentModel, SourceModel
+
+# read by the retrieval API from the same path, unset to skip the export
+VECTOR_SNAPSHOT_DIR = os.environ.get("VECTOR_SNAPSHOT_DIR")
+
+# older snapshots are kept for API workers still reading them until their next check
+VECTOR_SNAPSHOT_KEEP = int(os.environ.get("VECTOR_SNAPSHOT_KEEP", 2))
+
+# rows fetched from the DB per round trip while exporting
+EXPORT_BATCH_ROWS = int(os.environ.get("EXPORT_BATCH_ROWS", 10000))
+
+# bump when the files below change, the API refuses formats it does not know
+SNAPSHOT_FORMAT = 1
+
+# files of one snapshot, all .npy so they can be memory mapped with np.load
+EMBEDDINGS_FILE = "embeddings.npy"  # float16, rows x dimension
+NORMS_FILE = "norms.npy"  # float32 L2 norm of each row, for cosine and l2 distance
+DOCUMENT_IDS_FILE = "document_ids.npy"  # uint8, rows x 16 uuid bytes
+SOURCE_INDEX_FILE = "source_index.npy"  # int32 position of the row's source in sources.json
+SOURCES_FILE = "sources.json"
+SNAPSHOT_INFO_FILE = "snapshot.json"
+CURRENT_LINK = "current"
+
+
+def export_vector_snapshot(snapshot_dir: str = VECTOR_SNAPSHOT_DIR) -> str:
+    """
+    Write every AllMiniVectorStore embedding to a new memory mappable snapshot under
+    snapshot_dir, then point the snapshot_dir/current symlink at it in one atomic
+    rename. Returns the path of the new snapshot.
+    """
+
+    start_time = time.perf_counter()
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    build_dir = os.path.join(snapshot_dir, f"{version}.tmp")
+    os.makedirs(build_dir)
+
+    # one snapshot of the DB for the count and the rows, so they agree
+    with engine.connect().execution_options(
+        isolation_level="REPEATABLE READ", yield_per=EXPORT_BATCH_ROWS
+    ) as connection:
+        row_count = connection.execute(
+            select(func.count())
+            .select_from(AllMiniVectorStore)
+            .join(DocumentModel, DocumentModel.id == AllMiniVectorStore.document_id)
+        ).scalar()
+        dimension = AllMiniVectorStore.embedding.type.dim
+
+        sources = []
+        source_positions = {}  # source id -> position in sources
+        for source in connection.execute(
+            select(SourceModel.id, SourceModel.title, SourceModel.downloaded_datetime)
+        ):
+            source_positions[source.id] = len(sources)
+            sources.append(
+                {
+                    "id": str(source.id),
+                    "title": source.title,
+                    "downloaded_datetime": source.downloaded_datetime.isoformat()
+                    if source.downloaded_datetime
+                    else None,
+                }
+            )
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(build_dir, EMBEDDINGS_FILE), mode="w+", dtype=np.float16, shape=(row_count, dimension)
+        )
+        norms = np.zeros(row_count, dtype=np.float32)
+        document_ids = np.zeros((row_count, 16), dtype=np.uint8)
+        source_index = np.full(row_count, -1, dtype=np.int32)  # -1 for chunks without a source
+
+        rows = connection.execute(
+            select(AllMiniVectorStore.embedding, AllMiniVectorStore.document_id, DocumentModel.source_id)
+            .join(DocumentModel, DocumentModel.id == AllMiniVectorStore.document_id)
+        )
+        position = 0
+        for batch in rows.partitions():
+            batch_embeddings = np.asarray([row.embedding for row in batch], dtype=np.float32)
+            end = position + len(batch)
+            embeddings[position:end] = batch_embeddings
+            norms[position:end] = np.linalg.norm(batch_embeddings, axis=1)
+            for i, row in enumerate(batch, start=position):
+                document_ids[i] = np.frombuffer(row.document_id.bytes, dtype=np.uint8)
+                source_index[i] = source_positions.get(row.source_id, -1)
+            position = end
+
+    embeddings.flush()
+    del embeddings
+    np.save(os.path.join(build_dir, NORMS_FILE), norms)
+    np.save(os.path.join(build_dir, DOCUMENT_IDS_FILE), document_ids)
+    np.save(os.path.join(build_dir, SOURCE_INDEX_FILE), source_index)
+    with open(os.path.join(build_dir, SOURCES_FILE), "w") as file:
+        json.dump(sources, file)
+    with open(os.path.join(build_dir, SNAPSHOT_INFO_FILE), "w") as file:
+        json.dump(
+            {"format": SNAPSHOT_FORMAT, "version": version, "rows": row_count, "dimension": dimension},
+            file,
+        )
+
+    # publish the finished directory, then swap the link, so readers never see a partial snapshot
+    snapshot_path = os.path.join(snapshot_dir, version)
+    os.replace(build_dir, snapshot_path)
+    temporary_link = os.path.join(snapshot_dir, f"{CURRENT_LINK}.tmp")
+    if os.path.lexists(temporary_link):
+        os.remove(temporary_link)
+    os.symlink(version, temporary_link)
+    os.replace(temporary_link, os.path.join(snapshot_dir, CURRENT_LINK))
+
+    _remove_old_snapshots(snapshot_dir, keep=VECTOR_SNAPSHOT_KEEP)
+    print(
+        f"Exported {row_count} embeddings to {snapshot_path} in {time.perf_counter() - start_time:.1f}s"
+    )
+    return snapshot_path
+
+
+############################ PRIVATE METHODS ############################
+def _remove_old_snapshots(snapshot_dir: str, keep: int) -> None:
+    # versions are timestamps, so they sort oldest first
+    versions = sorted(
+        name
+        for name in os.listdir(snapshot_dir)
+        if name != CURRENT_LINK and not os.path.islink(os.path.join(snapshot_dir, name))
+    )
+    current = os.readlink(os.path.join(snapshot_dir, CURRENT_LINK))
+
+    # mapped files stay readable by workers that have them open after they are removed
+    for name in versions[:-keep] if keep > 0 else versions:
+        if name != current:
+            shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
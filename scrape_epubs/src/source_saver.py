@@ -1,8 +1,12 @@
+import os
 from datetime import datetime
-from codecs import decode
-from aimbase.db.vector import SourceModel
+from uuid import UUID, uuid5
+from sqlalchemy import delete, select, func
+from sqlalchemy.dialects.postgresql import insert
+from aimbase.db.vector import SourceModel, DocumentModel, AllMiniVectorStore
 from aimbase.crud.vector import CRUDSource 
 from instarest import SchemaBase, get_db
+from ingest_sink import INGEST_NOTIFY_CHANNEL
 
 source_model_schemas = SchemaBase(
     SourceModel,
@@ -19,12 +23,19 @@ SourceCreateSchema = source_model_schemas.EntityCreate
 
 crud_source_model = CRUDSource(SourceModel)
 
+# source ids are derived from the PubID, so the same publication always maps to the same row
+SOURCE_ID_NAMESPACE = UUID("6f1c2a3e-8d4b-5e7f-9a0b-1c2d3e4f5a6b")
+UPSERT_BATCH_SIZE = int(os.environ.get("SOURCE_UPSERT_BATCH_SIZE", 1000))
+
+def build_source_title(json_data):
+    # Concatenate Number and Title for the title field, the catalog JSON is already decoded
+    return f"{json_data.get('Number', '')}: {json_data.get('Title', '')}"
+
+def build_source_id(json_data) -> UUID:
+    return uuid5(SOURCE_ID_NAMESPACE, str(json_data.get("PubID")))
+
 def map_json_to_model(json_data):
-    # Concatenate Number and Title for the title field
-    title = decode(
-        f"{json_data.get('Number', '')}: {json_data.get('Title', '')}",
-        "unicode_escape",
-    )
+    title = build_source_title(json_data)
 
     # Concatenate other fields into the description
     description_fields = ["PubID", "Prescribe", "LastAction", "ReplacementID",
@@ -40,10 +51,118 @@ def map_json_to_model(json_data):
         public_url=json_data.get("DocumentUrl", "")
     )
 
-def save_json_source_data_to_db(json_list):
+def upsert_json_source_data_to_db(json_list, previous_titles=None) -> dict[str, UUID]:
+    """
+    Insert or update the source row of each publication in bulk, keyed on its PubID.
+    Returns PubID -> source id for every publication in json_list.
+
+    **Parameters**
+
+    * `json_list`: Publications from the catalog
+    * `previous_titles`: Optional PubID -> title last saved for it, used to adopt
+    rows saved before source ids were derived from the PubID
+    """
+
+    if not json_list:
+        return {}
+
+    previous_titles = previous_titles or {}
+
+    db = next(get_db())
+    try:
+        source_ids = _resolve_source_ids(db, json_list, previous_titles)
+
+        rows = [
+            {
+                "id": source_ids[str(json_data.get("PubID"))],
+                **map_json_to_model(json_data).dict(exclude_unset=True),
+            }
+            for json_data in json_list
+        ]
+
+        for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+            stmt = insert(SourceModel).values(rows[i : i + UPSERT_BATCH_SIZE])
+            db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[SourceModel.id],
+                    set_={
+                        column: stmt.excluded[column]
+                        for column in rows[0]
+                        if column != "id"
+                    },
+                )
+            )
+
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db.close()
+
+    return source_ids
+
+
+def delete_sources_and_chunks_by_id(source_ids):
+    """
+    Delete the sources with these ids, along with their documents and embeddings.
+    """
+
+    source_ids = list(source_ids)
+    if not source_ids:
+        return
+
     db = next(get_db())
     try:
-        schema_objects = [map_json_to_model(json_data) for json_data in json_list]
-        crud_source_model.create_all_using_id(db, obj_in_list=schema_objects)
+        document_ids = select(DocumentModel.id).where(
+            DocumentModel.source_id.in_(source_ids)
+        )
+
+        # delete children first to respect the foreign keys
+        for stmt in [
+            delete(AllMiniVectorStore).where(
+                AllMiniVectorStore.document_id.in_(document_ids)
+            ),
+            delete(DocumentModel).where(DocumentModel.source_id.in_(source_ids)),
+            delete(SourceModel).where(SourceModel.id.in_(source_ids)),
+        ]:
+            db.execute(stmt.execution_options(synchronize_session=False))
+
+        # cached retrievals may point at the deleted chunks
+        db.execute(select(func.pg_notify(INGEST_NOTIFY_CHANNEL, "deleted")))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+############################ PRIVATE METHODS ############################
+def _resolve_source_ids(db, json_list, previous_titles) -> dict[str, UUID]:
+    # one query for the whole run instead of one per publication
+    existing_ids = set()
+    ids_by_title = {}
+    for source_id, title in db.execute(select(SourceModel.id, SourceModel.title)):
+        existing_ids.add(source_id)
+        ids_by_title.setdefault(title, []).append(source_id)
+
+    source_ids = {}
+    adopted_ids = set()
+    for json_data in json_list:
+        pub_id = str(json_data.get("PubID"))
+        source_id = build_source_id(json_data)
+
+        # rows saved before ids came from the PubID are adopted by title instead of duplicated
+        if source_id not in existing_ids:
+            title = previous_titles.get(pub_id, build_source_title(json_data))
+            legacy_ids = [x for x in ids_by_title.get(title, []) if x not in adopted_ids]
+            if len(legacy_ids) > 1:
+                print(f"Warning: {len(legacy_ids)} sources found in DB for {title}")
+            if legacy_ids:
+                source_id = legacy_ids[0]
+                adopted_ids.add(source_id)
+
+        source_ids[pub_id] = source_id
+
+    return source_ids
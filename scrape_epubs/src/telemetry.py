@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# one JSON report per run is written here
+INGEST_REPORT_DIR = os.environ.get("INGEST_REPORT_DIR", "cache/ingest_reports")
+
+# publications listed in the report's slowest section
+REPORT_SLOWEST = int(os.environ.get("INGEST_REPORT_SLOWEST", 20))
+
+# bump when the report layout changes
+REPORT_FORMAT = 1
+
+
+class IngestTelemetry:
+    """
+    Stage timings, per-publication metrics and failures of one ingest run, written
+    as a machine readable JSON report at the end of the run. Safe to record into
+    from the download threads.
+
+    **Parameters**
+
+    * `report_dir`: Directory the report is written to
+    """
+
+    def __init__(self, report_dir: str = INGEST_REPORT_DIR):
+        self.report_dir = report_dir
+        self.run_id = None
+        self.started_at = datetime.now(timezone.utc)
+        self.start_time = time.perf_counter()
+
+        # internal only
+        self._lock = threading.Lock()
+        self._stages = {}  # stage -> seconds
+        self._publications = {}  # PubID -> metrics
+        self._counters = {}  # name -> value, from the embedding sink and cache
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a stage of the run, e.g. catalog_fetch.
+        """
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            with self._lock:
+                self._stages[name] = self._stages.get(name, 0.0) + seconds
+            print(f"Ingest stage {name} took {seconds:.1f}s")
+
+    def record(self, source_info: dict, **metrics) -> None:
+        """
+        Merge metrics into the publication's entry, adding to any seconds already recorded.
+        """
+
+        pub_id = str(source_info.get("PubID"))
+        with self._lock:
+            entry = self._publications.setdefault(
+                pub_id,
+                {
+                    "pub_id": pub_id,
+                    "number": source_info.get("Number"),
+                    "url": source_info.get("DocumentUrl"),
+                },
+            )
+            for name, value in metrics.items():
+                if name.endswith("_seconds") and name in entry:
+                    entry[name] += value
+                else:
+                    entry[name] = value
+
+    def record_failure(self, source_info: dict, stage: str, error: str) -> None:
+        self.record(source_info, status="failed", failed_stage=stage, error=error)
+
+    def set_counters(self, **counters) -> None:
+        with self._lock:
+            self._counters.update(counters)
+
+    def build_report(self, error: str | None = None) -> dict:
+        with self._lock:
+            publications = [dict(entry) for entry in self._publications.values()]
+            stages = {name: round(seconds, 3) for name, seconds in self._stages.items()}
+            counters = dict(self._counters)
+
+        downloaded = [entry for entry in publications if entry.get("download_status") == "downloaded"]
+        download_bytes = sum(entry.get("download_bytes", 0) for entry in downloaded)
+        download_seconds = sum(entry.get("download_seconds", 0) for entry in downloaded)
+
+        partitioned = [entry for entry in publications if "partition_seconds" in entry]
+        partition_seconds = sum(entry["partition_seconds"] for entry in partitioned)
+        pages = sum(entry.get("pages", 0) for entry in partitioned)
+
+        statuses = {}
+        for entry in publications:
+            status = entry.get("status", "unknown")
+            statuses[status] = statuses.get(status, 0) + 1
+
+        for entry in publications:
+            entry["total_seconds"] = round(
+                sum(entry.get(name, 0) for name in ["download_seconds", "partition_seconds", "clean_seconds"]),
+                3,
+            )
+
+        return {
+            "format": REPORT_FORMAT,
+            "run_id": self.run_id,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "total_seconds": round(time.perf_counter() - self.start_time, 3),
+            "error": error,
+            "stages": stages,
+            "publications": {"total": len(publications), **statuses},
+            "download": {
+                "count": len(downloaded),
+                "bytes": download_bytes,
+                "seconds": round(download_seconds, 3),
+                # per download thread, the aggregate rate scales with MAX_DOWNLOAD_WORKERS
+                "bytes_per_second": round(download_bytes / download_seconds, 1) if download_seconds else 0,
+                "not_modified": sum(1 for entry in publications if entry.get("download_status") == "not_modified"),
+            },
+            "partition": {
+                "count": len(partitioned),
+                "pages": pages,
+                "seconds": round(partition_seconds, 3),
+                "seconds_per_page": round(partition_seconds / pages, 4) if pages else 0,
+                "clean_seconds": round(sum(entry.get("clean_seconds", 0) for entry in partitioned), 3),
+                "chunk_seconds": round(sum(entry.get("chunk_seconds", 0) for entry in partitioned), 3),
+            },
+            "chunks": sum(entry.get("chunks", 0) for entry in publications),
+            "embed": _rate(counters, "embed"),
+            "insert": _rate(counters, "insert"),
+            "embedding_cache": {
+                "hits": counters.get("embedding_cache_hits", 0),
+                "misses": counters.get("embedding_cache_misses", 0),
+            },
+            "slowest": sorted(publications, key=lambda entry: entry["total_seconds"], reverse=True)[
+                :REPORT_SLOWEST
+            ],
+            "failures": [entry for entry in publications if entry.get("status") == "failed"],
+        }
+
+    def write_report(self, error: str | None = None) -> str:
+        """
+        Write the report to report_dir, returning its path.
+        """
+
+        report = self.build_report(error=error)
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(
+            self.report_dir, f"ingest_report_{self.started_at.strftime('%Y%m%dT%H%M%SZ')}.json"
+        )
+
+        # written aside then renamed, so a reader never sees half a report
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(report, file, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+        print(
+            f"Ingest report written to {path}: {report['publications']}, "
+            f"{report['chunks']} chunks in {report['total_seconds']:.1f}s"
+        )
+        return path
+
+
+############################ PRIVATE METHODS ############################
+def _rate(counters: dict, name: str) -> dict:
+    count = counters.get(f"{name}_count", 0)
+    seconds = counters.get(f"{name}_seconds", 0.0)
+    return {
+        "chunks": count,
+        "seconds": round(seconds, 3),
+        "chunks_per_second": round(count / seconds, 1) if seconds else 0,
+    }
@@ -0,0 +1,182 @@
+import re
+import sys
+import time
+import traceback
+from unstructured.cleaners.core import clean, clean_ordered_bullets, clean_prefix
+from unstructured.nlp.patterns import UNICODE_BULLETS_RE
+
+# Precompiled versions of the patterns used by clean_text, compiled once per process
+# [\xa0\n] becomes a space and then runs of spaces collapse, so replace both in one pass,
+# folding in the dash replacement too since dashes also become spaces
+_DASHES_AND_WHITESPACE_RE = re.compile(r"[ \xa0\n\-\u2013]{2,}|[\xa0\n\-\u2013]")
+_AFH_PREFIX_RE = re.compile(r"afh 10 222(.+)", re.IGNORECASE)
+_NUMBER_PREFIX_RE = re.compile(r"(\d+)", re.IGNORECASE)
+
+
+def clean_text(text: str) -> str:
+    """
+    Reference cleaner built from the unstructured cleaning bricks.
+    clean_texts must produce the same output, see check_parity().
+    """
+
+    text = clean(
+        text,
+        extra_whitespace=True,
+        dashes=True,
+        bullets=True,
+        trailing_punctuation=True,
+        lowercase=True,
+    )
+
+    try:
+        if len(text) > 0:
+            text = clean_ordered_bullets(text)
+
+        if len(text) > 0:
+            text = clean_prefix(text, r"afh 10 222(.+)", ignore_case=True)
+
+        if len(text) > 0:
+            text = clean_prefix(text, r"(\d+)", ignore_case=True)
+
+        if len(text) > 0:
+            text = clean(text, extra_whitespace=True)
+    except Exception as e:
+        print("An exception occurred:", e)
+        traceback.print_exc()
+
+    text = text.replace("\x00", "")
+
+    return text
+
+
+def clean_texts(texts: list[str]) -> list[str]:
+    """
+    Clean a whole list of element texts the same way as clean_text, using
+    precompiled patterns and as few passes over each string as possible.
+    """
+
+    return [_clean_single_pass(text) for text in texts]
+
+
+def _clean_single_pass(text: str) -> str:
+    # lowercase, trailing punctuation, dashes and extra whitespace
+    text = text.lower().strip().rstrip(".,:;")
+    text = _DASHES_AND_WHITESPACE_RE.sub(" ", text).strip()
+
+    # unicode bullets, only when the text starts with one
+    match = UNICODE_BULLETS_RE.match(text)
+    if match is not None:
+        text = text[match.end() :].strip()
+
+    if text:
+        # ordered bullets such as "1.2" or "a.b" at the start of the text
+        tokens = text.split()
+        first_token = tokens[0]
+        if "." in first_token and ".." not in first_token:
+            bullet = first_token.split(".")
+            if not bullet[-1]:
+                del bullet[-1]
+            if len(bullet[0]) <= 2:
+                text = " ".join(tokens[1:])
+
+    if text:
+        match = _AFH_PREFIX_RE.match(text)
+        if match is not None:
+            text = text[match.end() :].lstrip()
+
+    if text:
+        match = _NUMBER_PREFIX_RE.match(text)
+        if match is not None:
+            text = text[match.end() :].lstrip()
+
+    # the final extra whitespace pass of clean_text is not needed, none of the
+    # steps above can leave a newline, a non-breaking space or a double space
+
+    return text.replace("\x00", "")
+
+
+############################ PARITY AND BENCHMARK ############################
+SAMPLE_TEXTS = [
+    "",
+    "   ",
+    "\x00",
+    "1.1 This is a VERY important point.",
+    "a.b This is a very important point",
+    "abc.d not an ordered bullet",
+    "1..2 double dots are left alone",
+    ". lone dot",
+    "AFH 10 222 Volume 12, 1 June 2009",
+    "AFH 10 222",
+    "12345 Leading numbers",
+    "•  Unicode bullet point!",
+    "●● two bullets",
+    "* asterisk bullet",
+    "\uf0b7 private use bullet",
+    "ITEM 1. -BUSINESS",
+    "en–dash and - hyphen -- double",
+    "non\xa0breaking\xa0\xa0spaces\nand\n\nnewlines",
+    "tabs\tand\r\ncarriage returns  ",
+    "trailing punctuation;:,.",
+    "a.- punctuation exposed by a dash",
+    "- leading dash",
+    "(a) parenthesised bullet",
+    "Chapter 2—PROCEDURES",
+    "2.3.1.  Commanders will \x00 ensure compliance.",
+    "  1. Attachment 1",
+]
+
+
+def check_parity(texts: list[str]) -> list[tuple[str, str, str]]:
+    """
+    Compare clean_texts against the clean_text reference.
+    Returns the (text, expected, actual) triples that differ.
+    """
+
+    return [
+        (text, expected, actual)
+        for text, expected, actual in zip(
+            texts, [clean_text(text) for text in texts], clean_texts(texts)
+        )
+        if expected != actual
+    ]
+
+
+def benchmark(texts: list[str], repeat: int = 5) -> tuple[float, float]:
+    """
+    Best-of-repeat seconds to clean texts with clean_text and with clean_texts.
+    """
+
+    reference_seconds, batch_seconds = float("inf"), float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for text in texts:
+            clean_text(text)
+        reference_seconds = min(reference_seconds, time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        clean_texts(texts)
+        batch_seconds = min(batch_seconds, time.perf_counter() - start_time)
+
+    return reference_seconds, batch_seconds
+
+
+if __name__ == "__main__":
+    # usage: python text_cleaner.py [pdf paths...]
+    # checks parity and times both cleaners on the samples plus the elements of any PDFs given
+    texts = list(SAMPLE_TEXTS)
+    if len(sys.argv) > 1:
+        from unstructured.partition.pdf import partition_pdf
+
+        for pdf_path in sys.argv[1:]:
+            texts.extend(element.text for element in partition_pdf(pdf_path))
+
+    mismatches = check_parity(texts)
+    for text, expected, actual in mismatches:
+        print(f"Mismatch for {text!r}: expected {expected!r}, got {actual!r}")
+    print(f"Parity: {len(texts) - len(mismatches)}/{len(texts)} texts match")
+
+    reference_seconds, batch_seconds = benchmark(texts * max(1, 10000 // len(texts)))
+    print(
+        f"clean_text: {reference_seconds:.3f}s, clean_texts: {batch_seconds:.3f}s "
+        f"({reference_seconds / batch_seconds:.1f}x faster)"
+    )
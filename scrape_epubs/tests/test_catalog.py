@@ -0,0 +1,118 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+from catalog import CATALOG_PATH, CatalogClient, parse_catalog_response
+
+TOKEN = "stub-verification-token"
+
+HOME_PAGE = f"""
+<html><body>
+<form><input name="__RequestVerificationToken" type="hidden" value="{TOKEN}" /></form>
+</body></html>
+"""
+
+CATALOG_BODY = r"""[
+    {"PubID": 101, "Number": "AFI 1-1", "Title": "Air Force Standards",
+     "LastActionDate": "/Date(1543503803850)/", "CertDate": "/Date(0)/",
+     "DocumentUrl": "https://example.com/afi1-1.pdf"},
+    {"PubID": 102, "Number": "AFH 10-222", "Title": "Civil Engineer Bare Base",
+     "LastActionDate": "/Date(-86400000)/", "CertDate": null,
+     "DocumentUrl": "https://example.com/afh10-222.pdf"}
+]"""
+
+
+class _StubCatalogHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/":
+            self._send(200, "text/html", HOME_PAGE, {"Set-Cookie": "__RequestVerificationToken=cookie"})
+        elif url.path == "/no-token":
+            self._send(200, "text/html", "<html><body>maintenance</body></html>")
+        elif url.path == CATALOG_PATH:
+            # the real site rejects requests without the token header and its cookie
+            valid = (
+                self.headers.get("RequestVerificationToken") == TOKEN
+                and "__RequestVerificationToken=cookie" in (self.headers.get("Cookie") or "")
+                and parse_qs(url.query).get("orgID") == ["10141"]
+            )
+            if valid:
+                self._send(200, "application/json", CATALOG_BODY)
+            else:
+                self._send(403, "text/plain", "Forbidden")
+        else:
+            self._send(404, "text/plain", "Not found")
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubCatalogHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_publications(stub_url):
+    client = CatalogClient(base_url=stub_url)
+    try:
+        publications = client.fetch_publications()
+    finally:
+        client.close()
+
+    assert [publication["PubID"] for publication in publications] == [101, 102]
+    assert publications[0]["Number"] == "AFI 1-1"
+    assert publications[0]["DocumentUrl"] == "https://example.com/afi1-1.pdf"
+    assert publications[0]["LastActionDate"] == "2018-11-29T15:03:23.850000Z"
+    assert publications[0]["CertDate"] == "1970-01-01T00:00:00Z"
+    assert publications[1]["LastActionDate"] == "1969-12-31T00:00:00Z"
+    assert publications[1]["CertDate"] is None
+
+
+def test_missing_token(stub_url):
+    client = CatalogClient(base_url=f"{stub_url}/no-token")
+    try:
+        with pytest.raises(ValueError):
+            client.fetch_publications()
+    finally:
+        client.close()
+
+
+def test_parse_embedded_publications():
+    text = f"<script>var model = {{ publications: {CATALOG_BODY}, total: 2 }};</script>"
+    assert parse_catalog_response(text) == parse_catalog_response(CATALOG_BODY)
+
+
+def test_parse_wrapped_publications():
+    text = json.dumps({"publications": [{"PubID": 1, "CertDate": "/Date(1000)/"}]})
+    assert parse_catalog_response(text) == [{"PubID": 1, "CertDate": "1970-01-01T00:00:01Z"}]
+
+
+def test_parse_without_publications():
+    with pytest.raises(ValueError):
+        parse_catalog_response("<html>maintenance</html>")
+
+
+def test_titles_keep_non_ascii_characters():
+    # the JSON decoder already turns \u escapes into characters, decoding again garbles them
+    from source_saver import build_source_title
+
+    publications = parse_catalog_response(
+        r'[{"PubID": 1, "Number": "AFI 1-1", "Title": "Standards \u2014 Conduct \\ Discipline"}]'
+    )
+    assert build_source_title(publications[0]) == "AFI 1-1: Standards — Conduct \\ Discipline"
@@ -0,0 +1,43 @@
+import ast
+import os
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+INGEST_BACKEND = os.path.join(SRC_DIR, "onnx_backend.py")
+API_BACKEND = os.path.join(os.path.dirname(os.path.dirname(SRC_DIR)), "daf_epubs", "api", "onnx_backend.py")
+
+# picks the exporter by service type, so it legitimately differs between the copies
+PROJECT_SPECIFIC = {"load_onnx_model"}
+
+
+def top_level_definitions(path: str) -> dict[str, str]:
+    """
+    Name -> AST dump of each top level function, class and constant, so comments
+    and formatting do not count as drift.
+    """
+
+    definitions = {}
+    for node in ast.parse(open(path).read()).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            definitions[node.name] = ast.dump(node)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    definitions[target.id] = ast.dump(node.value)
+    return definitions
+
+
+@pytest.mark.skipif(not os.path.exists(API_BACKEND), reason="daf_epubs is not checked out alongside")
+def test_onnx_backend_matches_api_copy():
+    # the ingest embeds chunks that the API searches with its own query embeddings, so the
+    # export, quantization, tokenization and session code must be the same in both
+    ingest = top_level_definitions(INGEST_BACKEND)
+    api = top_level_definitions(API_BACKEND)
+
+    missing = sorted(set(ingest) - set(api) - PROJECT_SPECIFIC)
+    assert not missing, f"Only in the ingest's onnx_backend.py: {missing}"
+
+    drifted = sorted(
+        name for name in set(ingest) - PROJECT_SPECIFIC if ingest[name] != api[name]
+    )
+    assert not drifted, f"onnx_backend.py copies differ in: {drifted}"
@@ -0,0 +1,65 @@
+import random
+import pytest
+from text_cleaner import SAMPLE_TEXTS, clean_text, clean_texts
+
+# characters the cleaning patterns act on, mixed with plain text
+ALPHABET = list("abcAFH 0123456789.;:,-()*\t\r\n") + [
+    "\xa0",
+    "–",
+    "—",
+    "\x00",
+    "•",
+    "●",
+    "",
+    "afh 10 222",
+    "1.1 ",
+    "a.b ",
+]
+
+EDGE_CASES = [
+    "-",
+    "--",
+    "–––",
+    "\xa0",
+    "\n\n\n",
+    ".",
+    ";:,.",
+    "1",
+    "1.",
+    "1.1",
+    "a.",
+    "afh 10 222 ",
+    "AFH 10 2221",
+    "\x00\x00 leading nulls",
+    "- - - spaced dashes",
+    "•",
+    "• • •",
+    "99 bottles 99",
+    "x" * 10000,
+]
+
+
+def random_texts(seed: int, count: int = 500, max_length: int = 40) -> list[str]:
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+        for _ in range(count)
+    ]
+
+
+def test_sample_texts_match_reference():
+    assert clean_texts(SAMPLE_TEXTS) == [clean_text(text) for text in SAMPLE_TEXTS]
+
+
+def test_edge_cases_match_reference():
+    assert clean_texts(EDGE_CASES) == [clean_text(text) for text in EDGE_CASES]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_texts_match_reference(seed):
+    texts = random_texts(seed)
+    assert clean_texts(texts) == [clean_text(text) for text in texts]
+
+
+def test_empty_list():
+    assert clean_texts([]) == []